@@ -0,0 +1,506 @@
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import random
+import re
+import resource
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from fake_bili_api import start_fake_api
+
+
+# 混合负载的爬取耗时：n_ups个up主，每人items_per_up条动态(图文/视频/纯文本/专栏/转发循环)
+# 模拟接口的专栏接口按cookie以server_article_rate限流，超过时返回-352，客户端限流器需要自适应降速
+# n_cookies个cookie时请求分摊到各个cookie上，专栏的吞吐量随之增长
+def bench_crawl(n_ups=50, items_per_up=12, latency=0.05, server_article_rate=20, article_rate=15,
+                article_burst=5, max_concurrency=32, per_host_concurrency=16, article_workers=8, n_cookies=1):
+    from bili_crawler import crawl_up_uids
+
+    server, api_base = start_fake_api(latency=latency, items_per_up=items_per_up, article_rate=server_article_rate,
+                                      article_burst=article_burst)
+    up_uids = [str(10000 + n) for n in range(n_ups)]
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        up_dynamics = crawl_up_uids(up_uids, [f'SESSDATA=bench{n}' for n in range(n_cookies)],
+                                    max_concurrency=max_concurrency,
+                                    per_host_concurrency=per_host_concurrency, api_base=api_base,
+                                    rate_limits={'space': (1000, 1000), 'article': (article_rate, article_burst)},
+                                    article_workers=article_workers)
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    articles = server.stats.get('/x/article/view', 0) - server.stats.get('throttled', 0)
+    result = {
+        'cookies': n_cookies,
+        'ups': len(up_dynamics),
+        'items': sum(len(items) for items in up_dynamics.values()),
+        'feed_requests': server.stats.get('/x/polymer/web-dynamic/v1/feed/space', 0),
+        'article_requests': server.stats.get('/x/article/view', 0),
+        'throttled': server.stats.get('throttled', 0),
+        'wall_time': round(elapsed, 3),
+        # 原实现逐个请求且每个专栏sleep(15)的理论耗时
+        'sequential_sleep_estimate': round(n_ups * latency + articles * (latency + 15), 1),
+    }
+    print(result)
+    return result
+
+
+# 随机生成中文文本和标签，字表越小命中率越高
+def make_filter_workload(n_rows, n_tags, vocab_size=3000, text_length=80, seed=0):
+    rng = random.Random(seed)
+    vocab = [chr(0x4e00 + n) for n in range(vocab_size)]
+    tags = list({''.join(rng.choices(vocab, k=rng.randint(2, 3))) for _ in range(n_tags)})
+    rows = []
+    for n in range(n_rows):
+        title = ''.join(rng.choices(vocab, k=12))
+        text = ''.join(rng.choices(vocab, k=text_length))
+        rows.append(('bench_up', f'https://www.bilibili.com/opus/{n}', title, '2025-01-01', text, [],
+                     'DYNAMIC_TYPE_WORD'))
+    return rows, tags
+
+
+def _timed(function, *args):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function(*args)
+    return round(time.perf_counter() - start, 3), result
+
+
+# 标签筛选：Aho-Corasick与逐行逐标签子串匹配(等价于原先的LIKE交叉连接)对比
+# 提供数据库参数时，再在数据库里对比原filter_data与filter_data_incremental的全量和增量耗时
+def bench_filter(n_rows=100000, n_tags=1000, new_rows=1000, database=None, user=None, password=None, host=None,
+                 port=None):
+    from bili_filter import AhoCorasick
+
+    rows, tags = make_filter_workload(n_rows + new_rows, n_tags)
+    new, rows = rows[n_rows:], rows[:n_rows]
+    result = {'rows': n_rows, 'tags': len(tags)}
+
+    def naive():
+        return sum(1 for row in rows if any(tag in row[2] or tag in row[4] for tag in tags))
+
+    def automaton():
+        ac = AhoCorasick(tags)
+        return sum(1 for row in rows if ac.find(row[4], ac.find(row[2])))
+
+    result['naive_seconds'], naive_matched = _timed(naive)
+    result['aho_corasick_seconds'], ac_matched = _timed(automaton)
+    assert naive_matched == ac_matched
+    result['matched'] = ac_matched
+
+    if database is not None:
+        import psycopg2
+        import psycopg2.extras
+        from bili_filter import FILTER_STATE_TABLE, ensure_filter_schema, filter_data_incremental
+        from bili_requests_functions import create_table_data, create_table_filtered, create_table_tags, filter_data
+
+        db = (database, user, password, host, port)
+        tables = ('bench_filter_data', 'bench_filter_tags', 'bench_filter_filtered')
+        connect = psycopg2.connect(database=database, user=user, password=password, host=host, port=port)
+        cursor = connect.cursor()
+
+        def insert_rows(batch):
+            psycopg2.extras.execute_values(
+                cursor, 'INSERT INTO bench_filter_data (up_name, detail_url, title, time, text, pics, type) '
+                        'VALUES %s', batch, page_size=5000)
+            connect.commit()
+
+        cursor.execute(f'DROP TABLE IF EXISTS {", ".join(tables)}')
+        connect.commit()
+        with contextlib.redirect_stdout(io.StringIO()):
+            create_table_data(*db, tables[0])
+            create_table_tags(*db, tables[1])
+            create_table_filtered(*db, tables[2])
+        # 清掉上次中断留下的筛选进度
+        ensure_filter_schema(cursor, tables[0])
+        cursor.execute(f'DELETE FROM {FILTER_STATE_TABLE} WHERE table_filtered = %s', (tables[2],))
+        psycopg2.extras.execute_values(cursor, 'INSERT INTO bench_filter_tags (tag) VALUES %s',
+                                       [(tag,) for tag in tags])
+        insert_rows(rows)
+        result['sql_like_full_seconds'], _ = _timed(filter_data, *db, *tables)
+        cursor.execute('DELETE FROM bench_filter_filtered')
+        connect.commit()
+        result['incremental_full_seconds'], _ = _timed(filter_data_incremental, *db, *tables)
+        insert_rows(new)
+        result['sql_like_after_new_rows_seconds'], _ = _timed(filter_data, *db, *tables)
+        result['incremental_after_new_rows_seconds'], _ = _timed(filter_data_incremental, *db, *tables)
+        cursor.execute(f'DROP TABLE IF EXISTS {", ".join(tables)}')
+        cursor.execute(f'DELETE FROM {FILTER_STATE_TABLE} WHERE table_filtered = %s', (tables[2],))
+        connect.commit()
+        cursor.close()
+        connect.close()
+    print(result)
+    return result
+
+
+# 随机生成B站接口里出现的各种时间字符串
+def make_date_workload(n_dates, seed=0):
+    rng = random.Random(seed)
+    makers = [
+        lambda: f'{rng.randint(2015, 2025)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}',
+        lambda: f'{rng.randint(2015, 2025)}年{rng.randint(1, 12):02d}月{rng.randint(1, 28):02d}日',
+        lambda: f'{rng.randint(1, 12):02d}月{rng.randint(1, 28):02d}日',
+        lambda: f'{rng.randint(1, 59)}分钟前',
+        lambda: f'{rng.randint(1, 23)}小时前',
+        lambda: f'{rng.randint(1, 6)}天前',
+        lambda: f'昨天 {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}',
+    ]
+    return [rng.choice(makers)() for _ in range(n_dates)]
+
+
+# 原实现：逐个格式re.match，先格式化为RFC 822字符串，写库时再strptime回date，每次都重新取当前时间
+def _legacy_parse_and_format_date(date_str):
+    shanghai = timezone(timedelta(hours=8))
+    if re.match(r'^\d{4}-\d{2}-\d{2}$', date_str):
+        dt = datetime.strptime(date_str, '%Y-%m-%d')
+    elif re.match(r'^\d{4}年\d{2}月\d{2}日$', date_str):
+        dt = datetime.strptime(date_str, '%Y年%m月%d日')
+    elif re.match(r'^\d{2}月\d{2}日$', date_str):
+        dt = datetime.strptime(f'{datetime.now(shanghai).year}年{date_str}', '%Y年%m月%d日')
+    elif re.match(r'^\d+分钟前$', date_str):
+        dt = datetime.now(shanghai) - timedelta(minutes=int(re.search(r'\d+', date_str).group()))
+    elif re.match(r'^\d+小时前$', date_str):
+        dt = datetime.now(shanghai) - timedelta(hours=int(re.search(r'\d+', date_str).group()))
+    elif re.match(r'^\d+天前$', date_str):
+        dt = datetime.now(shanghai) - timedelta(days=int(re.search(r'\d+', date_str).group()))
+    elif re.match(r'^昨天\s+\d{2}:\d{2}$', date_str):
+        dt = datetime.now(shanghai) - timedelta(days=1)
+    else:
+        raise ValueError(date_str)
+    return dt.astimezone(timezone.utc).strftime('%a, %d %b %Y %H:%M:%S %z')
+
+
+# 日期解析：原先的逐个re.match加字符串往返，与bili_dates一次匹配、共用当前时间对比
+def bench_dates(n_dates=1000000):
+    from bili_dates import format_rfc822, now_shanghai, parse_date
+
+    dates = make_date_workload(n_dates)
+
+    def legacy():
+        return [datetime.strptime(_legacy_parse_and_format_date(date_str), '%a, %d %b %Y %H:%M:%S %z').date()
+                for date_str in dates]
+
+    def fast():
+        now = now_shanghai()
+        return [parse_date(date_str, now).date() for date_str in dates]
+
+    def fast_rfc822():
+        now = now_shanghai()
+        return [format_rfc822(parse_date(date_str, now)) for date_str in dates]
+
+    legacy_time, _ = _timed(legacy)
+    fast_time, _ = _timed(fast)
+    rfc822_time, _ = _timed(fast_rfc822)
+    result = {
+        'dates': n_dates,
+        'legacy_to_date': legacy_time,
+        'parse_date_to_date': fast_time,
+        'parse_date_to_rfc822': rfc822_time,
+        'speedup': round(legacy_time / fast_time, 1),
+    }
+    print(result)
+    return result
+
+
+# 随机生成n_ups个up主的动态，图文/视频/纯文本/专栏循环，每条带几张图片
+def make_render_workload(n_ups, items_per_up=12, text_length=200, seed=0):
+    from bili_models import Dynamic
+
+    rng = random.Random(seed)
+    vocab = [chr(0x4e00 + n) for n in range(3000)]
+    types = ('DYNAMIC_TYPE_DRAW', 'DYNAMIC_TYPE_AV', 'DYNAMIC_TYPE_WORD', 'DYNAMIC_TYPE_ARTICLE')
+    up_dynamics = {}
+    for up in range(n_ups):
+        up_uid = str(10000 + up)
+        dynamics = []
+        for n in range(items_per_up):
+            data_type = types[n % len(types)]
+            data_id = f'BV1{up:05d}{n:04d}' if data_type == 'DYNAMIC_TYPE_AV' else str(up * 1000000 + n)
+            pics = [f'https://i0.hdslb.com/bfs/{up}/{n}/{k}.jpg' for k in range(rng.randint(1, 4))]
+            dynamics.append(Dynamic.create(f'up主{up}', data_type, data_id, ''.join(rng.choices(vocab, k=12)),
+                                           ''.join(rng.choices(vocab, k=text_length)), pics,
+                                           1735660800 - up * 1000 - n * 60))
+        up_dynamics[up_uid] = dynamics
+    return up_dynamics
+
+
+# 读出目录下所有rss，去掉lastBuildDate后用于比较两种写法的输出
+def _read_feeds(directory):
+    feeds = {}
+    for name in os.listdir(directory):
+        with open(os.path.join(directory, name), 'rb') as f:
+            feeds[name] = re.sub(rb'<lastBuildDate>.*</lastBuildDate>', b'', f.read())
+    return feeds
+
+
+# 直接写rss：feedgen与直接拼接xml在不同进程数下每秒生成的feed数，每次都在空目录中从头生成
+def bench_render(n_ups=1000, items_per_up=12, workers=None, chunk_size=16):
+    from bili_render import render_feeds
+
+    up_dynamics = make_render_workload(n_ups, items_per_up)
+    workers = workers or sorted({1, 2, 4, os.cpu_count() or 1})
+    cwd = os.getcwd()
+    result = {'feeds': n_ups, 'items_per_feed': items_per_up}
+    outputs = {}
+    try:
+        for fast in (False, True):
+            for worker_count in workers:
+                with tempfile.TemporaryDirectory() as directory:
+                    os.chdir(directory)
+                    elapsed, _ = _timed(render_feeds, up_dynamics, worker_count, chunk_size, 100, fast)
+                    outputs[fast] = _read_feeds('xml_files')
+                    os.chdir(cwd)
+                name = 'fast' if fast else 'feedgen'
+                result[f'{name}_{worker_count}_workers_feeds_per_sec'] = round(n_ups / elapsed, 1)
+    finally:
+        os.chdir(cwd)
+    result['identical'] = outputs[False] == outputs[True]
+    print(result)
+    return result
+
+
+# 全文搜索：bili_search的FTS5索引与逐行子串匹配(等价于LIKE全表扫描)的单次查询耗时对比
+# 搜索词为从正文中随机截取的2~4个字，两种方法的命中数必须一致
+def bench_search(n_rows=200000, n_queries=200, limit=50):
+    from bili_search import SearchIndex, build_match_query
+
+    rows, _ = make_filter_workload(n_rows, 0)
+    rng = random.Random(1)
+    queries = []
+    for _ in range(n_queries):
+        text = rng.choice(rows)[4]
+        start = rng.randrange(len(text) - 4)
+        queries.append(text[start:start + rng.randint(2, 4)])
+    result = {'rows': n_rows, 'queries': n_queries}
+    with tempfile.TemporaryDirectory() as directory:
+        index = SearchIndex(os.path.join(directory, 'search.sqlite3'))
+        start = time.perf_counter()
+        index.connect.execute('BEGIN')
+        index.add_rows(rows)
+        index.connect.execute('COMMIT')
+        result['index_seconds'] = round(time.perf_counter() - start, 3)
+        result['index_mb'] = round(os.path.getsize(os.path.join(directory, 'search.sqlite3')) / 1024 / 1024, 1)
+        fts_times = []
+        scan_times = []
+        for query in queries:
+            match = build_match_query(query)
+            start = time.perf_counter()
+            found = index.search(match, limit=limit)
+            fts_times.append(time.perf_counter() - start)
+            count = index.connect.execute('SELECT COUNT(*) FROM docs WHERE docs MATCH ?', (match,)).fetchone()[0]
+            start = time.perf_counter()
+            matched = [row for row in rows if query in row[2] or query in row[4]]
+            scan_times.append(time.perf_counter() - start)
+            assert count == len(matched) and len(found) == min(limit, count), query
+        index.close()
+    result['fts_p50_ms'] = round(_percentile(fts_times, 0.5) * 1000, 2)
+    result['fts_p99_ms'] = round(_percentile(fts_times, 0.99) * 1000, 2)
+    result['scan_p50_ms'] = round(_percentile(scan_times, 0.5) * 1000, 2)
+    result['scan_p99_ms'] = round(_percentile(scan_times, 0.99) * 1000, 2)
+    print(result)
+    return result
+
+
+# nearest-rank分位数
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+# 一个阶段的结果：总耗时、每秒处理的数量，以及该阶段单次操作(直方图的原始观测值)的p50/p99
+def _stage_result(seconds, count, observations):
+    return {'seconds': round(seconds, 3), 'count': count,
+            'per_sec': round(count / seconds, 1) if seconds else None,
+            'p50_ms': round(_percentile(observations, 0.5) * 1000, 2) if observations else None,
+            'p99_ms': round(_percentile(observations, 0.99) * 1000, 2) if observations else None,
+            'samples': len(observations)}
+
+
+# 当前代码的commit，用于对比不同提交的结果
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# 完整流程(爬取 → 写库 → 筛选 → 生成rss)，与main.py一次性流程的各步骤相同，接口为本地模拟接口
+# 提供数据库参数时写库和筛选使用Postgres(bench_pipeline_*表，测试前后删除)，否则使用嵌入式SQLite(见bili_storage)
+# 每个阶段输出总耗时、吞吐量和单次操作的p50/p99(爬取为每个up主，写库为每次批量写入，筛选为每次筛选，
+# 生成rss为每个feed)，以及整个进程(含渲染子进程)的峰值内存；output为结果追加写入的jsonl文件
+# 合成数据和标签都是固定的，同样的参数在不同提交之间可以直接对比
+def bench_pipeline(n_ups=200, items_per_up=12, latency=0.05, jitter=0.01, server_article_rate=20, article_rate=15,
+                   article_burst=5, n_cookies=1, n_tags=200, render_workers=1, rss_limit=200, fixtures=None,
+                   database=None, user=None, password=None, host=None, port=None, output=None):
+    from bili_crawler import crawl_up_uids
+    from bili_metrics import record_observations
+    from bili_render import render_feeds
+
+    if fixtures is not None:
+        fixtures = os.path.abspath(fixtures)
+    server, api_base = start_fake_api(latency=latency, jitter=jitter, items_per_up=items_per_up,
+                                      article_rate=server_article_rate, article_burst=article_burst,
+                                      fixtures=fixtures)
+    up_uids = [str(10000 + n) for n in range(n_ups)]
+    # 合成动态的正文形如"up10000的第3条动态"，一部分标签能命中
+    tags = [f'第{n}条' for n in range(0, n_tags * 2, 2)]
+    db = (database, user, password, host, port)
+    tables = ('bench_pipeline_data', 'bench_pipeline_tags', 'bench_pipeline_filtered')
+    stages = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory, record_observations() as observed:
+        os.chdir(directory)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                up_dynamics = crawl_up_uids(up_uids, [f'SESSDATA=bench{n}' for n in range(n_cookies)],
+                                            max_concurrency=32, per_host_concurrency=16, api_base=api_base,
+                                            rate_limits={'space': (1000, 1000),
+                                                         'article': (article_rate, article_burst)},
+                                            article_workers=8)
+                items = sum(len(dynamics) for dynamics in up_dynamics.values())
+                stages['crawl'] = _stage_result(time.perf_counter() - start, items,
+                                                observed['bili_crawl_up_seconds'].get((), []))
+
+                if database is not None:
+                    from bili_storage import PostgresStorage
+                    _drop_pipeline_tables(db, tables)
+                    store = PostgresStorage(*db, *tables)
+                else:
+                    from bili_storage import SqliteStorage
+                    store = SqliteStorage(*tables, os.path.join(directory, 'bench.sqlite3'))
+                store.ensure_schema()
+                store.set_tags(tags)
+                start = time.perf_counter()
+                for up_uid in up_uids:
+                    if up_dynamics.get(up_uid):
+                        store.add(up_dynamics[up_uid])
+                store.flush()
+                stages['store'] = _stage_result(time.perf_counter() - start, items,
+                                                observed['bili_db_flush_seconds'].get((), []))
+
+                start = time.perf_counter()
+                matched = store.filter()
+                stages['filter'] = _stage_result(time.perf_counter() - start, items,
+                                                 [value for values in observed['bili_filter_seconds'].values()
+                                                  for value in values])
+                stages['filter']['matched'] = matched
+
+                start = time.perf_counter()
+                render_feeds(up_dynamics, workers=render_workers, fast=True)
+                store.stream_rss(limit=rss_limit)
+                store.close()
+                if database is not None:
+                    _drop_pipeline_tables(db, tables)
+                stages['render'] = _stage_result(time.perf_counter() - start, len(up_dynamics) + 1,
+                                                 observed['bili_render_seconds'].get(('up',), []))
+        finally:
+            os.chdir(cwd)
+            server.shutdown()
+    http = {endpoint: {'p50_ms': round(_percentile(values, 0.5) * 1000, 2),
+                       'p99_ms': round(_percentile(values, 0.99) * 1000, 2), 'requests': len(values)}
+            for (endpoint,), values in observed['bili_http_request_seconds'].items()}
+    # Linux上ru_maxrss的单位为KB
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    result = {
+        'benchmark': 'pipeline',
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'params': {'ups': n_ups, 'items_per_up': items_per_up, 'latency': latency, 'jitter': jitter,
+                   'server_article_rate': server_article_rate, 'cookies': n_cookies, 'tags': n_tags,
+                   'render_workers': render_workers, 'fixtures': fixtures is not None,
+                   'storage': 'postgres' if database is not None else 'sqlite'},
+        'stages': stages,
+        'http': http,
+        'throttled': server.stats.get('throttled', 0),
+        'peak_rss_mb': round(peak_rss / 1024, 1),
+        'children_peak_rss_mb': round(children_rss / 1024, 1),
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if output:
+        with open(output, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(result, ensure_ascii=False) + '\n')
+    return result
+
+
+# 删除测试表和对应的筛选进度
+def _drop_pipeline_tables(db, tables):
+    import psycopg2
+    from bili_filter import FILTER_STATE_TABLE
+
+    database, user, password, host, port = db
+    connect = psycopg2.connect(database=database, user=user, password=password, host=host, port=port)
+    with connect.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {", ".join(tables)}')
+        # 清掉筛选进度，下次从头筛选
+        cursor.execute('SELECT to_regclass(%s)', (FILTER_STATE_TABLE,))
+        if cursor.fetchone()[0] is not None:
+            cursor.execute(f'DELETE FROM {FILTER_STATE_TABLE} WHERE table_filtered = %s', (tables[2],))
+    connect.commit()
+    connect.close()
+
+
+BENCHMARKS = {
+    'crawl': bench_crawl,
+    'filter': bench_filter,
+    'dates': bench_dates,
+    'render': bench_render,
+    'pipeline': bench_pipeline,
+    'search': bench_search,
+}
+
+# 命令行入口，argv为None时读取sys.argv；也由 main.py bench 调用
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='BiliUPRss 性能测试')
+    parser.add_argument('name', choices=sorted(BENCHMARKS))
+    parser.add_argument('--ups', type=int, default=50)
+    parser.add_argument('--cookies', type=int, default=1)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--tags', type=int, default=1000)
+    parser.add_argument('--dates', type=int, default=1000000)
+    parser.add_argument('--workers', type=int, nargs='+')
+    # pipeline用：模拟接口的延迟、每个cookie的专栏限速、录制样本的目录，以及结果追加写入的jsonl文件
+    parser.add_argument('--items-per-up', type=int, default=12)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--article-rate', type=float, default=20)
+    parser.add_argument('--fixtures')
+    parser.add_argument('--output')
+    # 数据库参数，不提供时跳过需要数据库的部分
+    parser.add_argument('--database')
+    parser.add_argument('--user')
+    parser.add_argument('--password')
+    parser.add_argument('--host')
+    parser.add_argument('--port')
+    args = parser.parse_args(argv)
+    db = {'database': args.database, 'user': args.user, 'password': args.password, 'host': args.host,
+          'port': args.port}
+    if args.name == 'crawl':
+        bench_crawl(n_ups=args.ups, n_cookies=args.cookies)
+    elif args.name == 'filter':
+        bench_filter(n_rows=args.rows, n_tags=args.tags, **db)
+    elif args.name == 'dates':
+        bench_dates(n_dates=args.dates)
+    elif args.name == 'render':
+        bench_render(n_ups=args.ups, workers=args.workers)
+    elif args.name == 'search':
+        bench_search(n_rows=args.rows)
+    elif args.name == 'pipeline':
+        bench_pipeline(n_ups=args.ups, items_per_up=args.items_per_up, latency=args.latency,
+                       server_article_rate=args.article_rate, n_cookies=args.cookies, n_tags=args.tags,
+                       render_workers=args.workers[0] if args.workers else 1, fixtures=args.fixtures,
+                       output=args.output, **db)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import json
+import os
+
+# 命令行(main.py)的配置：默认值 < 配置文件(json) < 环境变量
+# 配置文件由 -c/--config 或 BILI_CONFIG 环境变量指定，都没有时读取当前目录下的bili.json(存在时)
+CONFIG_PATH = 'bili.json'
+DEFAULTS = {
+    # 爬虫用，user_cookies可以填写多个cookie，请求分摊到各个cookie上(每个cookie单独限流)，逐个爬取时只用第一个；
+    # 为空时不带cookie请求
+    'up_uids': [],
+    'user_cookies': [],
+    # 接口地址，None为B站接口；可填写fake_bili_api.py的地址(如 http://127.0.0.1:8000)在本地测试，只用于并发爬取
+    'api_base': None,
+    # 并发爬取所有up主(全局并发上限，单个host的并发上限)，为False时逐个爬取
+    'concurrent_crawl': True,
+    'max_concurrency': 16,
+    'per_host_concurrency': 8,
+    # 增量爬取(只取游标之后的新动态)，backfill为True时沿offset翻页补爬历史动态
+    'incremental': True,
+    'backfill': False,
+    # 断点续爬，见bili_work_queue
+    'resumable': True,
+    'crawl_batch_size': 50,
+    'max_attempts': 5,
+    'retry_dead_letters': False,
+    # 接口响应缓存(专栏永久缓存，动态列表缓存60秒)
+    'use_response_cache': True,
+    # 存储后端：'postgres'或'sqlite'(sqlite_path为None时使用bili_storage.STORAGE_PATH)
+    'storage_backend': 'postgres',
+    'sqlite_path': None,
+    # Postgres的数据表按发布月份分区；保留期(天，None为不归档)和归档目录(None时使用bili_retention.ARCHIVE_DIR)
+    'partition_data': False,
+    'retention_days': None,
+    'archive_dir': None,
+    # 数据库用，环境变量与flask_demo.py相同(BILI_DB_NAME等)
+    'database': '',
+    'user': '',
+    'password': '',
+    'host': '',
+    'port': '',
+    'table_data': 'bili_dynamics',
+    'table_tags': 'bili_tags',
+    'table_filtered': 'bili_dynamics_filtered',
+    # 写库后同步全文索引
+    'use_search_index': True,
+    # 筛选后的rss保留的条目数
+    'rss_limit': 200,
+    # 直接写rss用(进程数，None为CPU核数；fast为True时不经过feedgen直接拼接xml)
+    'render_workers': None,
+    'fast_render': True,
+    # 图片代理，见README
+    'media_base_url': '',
+    # 常驻调度用(轮询间隔的上下限，秒；是否定期筛选)
+    'min_interval': 300,
+    'max_interval': 6 * 3600,
+    'scheduler_filter': False,
+    # serve用
+    'serve_host': '0.0.0.0',
+    'serve_port': 5000,
+}
+# 默认值为None的配置项的类型
+CONFIG_TYPES = {
+    'api_base': str,
+    'sqlite_path': str,
+    'retention_days': int,
+    'archive_dir': str,
+    'render_workers': int,
+}
+# 与flask_demo.py共用的环境变量，其余配置项的环境变量为 BILI_<配置项大写>
+ENV_NAMES = {
+    'database': 'BILI_DB_NAME',
+    'user': 'BILI_DB_USER',
+    'password': 'BILI_DB_PASSWORD',
+    'host': 'BILI_DB_HOST',
+    'port': 'BILI_DB_PORT',
+}
+_TRUE = ('1', 'true', 'yes', 'on')
+_FALSE = ('0', 'false', 'no', 'off', '')
+
+
+def env_name(key):
+    return ENV_NAMES.get(key, f'BILI_{key.upper()}')
+
+
+# 把环境变量的字符串转为配置项的类型；列表为逗号分隔，或以[开头的json数组(cookie里有逗号时)
+def parse_env_value(key, value):
+    kind = CONFIG_TYPES.get(key, type(DEFAULTS[key]))
+    if kind is bool:
+        if value.strip().lower() in _TRUE:
+            return True
+        if value.strip().lower() in _FALSE:
+            return False
+        raise ValueError(f'{env_name(key)}应为true/false: {value!r}')
+    if kind is list:
+        if value.lstrip().startswith('['):
+            return json.loads(value)
+        return [item.strip() for item in value.split(',') if item.strip()]
+    if key in CONFIG_TYPES and not value.strip():
+        return None
+    return kind(value)
+
+
+# 读取配置，path为None时按BILI_CONFIG环境变量、bili.json的顺序查找；配置文件里不认识的配置项报错
+def load_config(path=None, environ=None):
+    environ = os.environ if environ is None else environ
+    config = dict(DEFAULTS)
+    path = path or environ.get('BILI_CONFIG') or (CONFIG_PATH if os.path.exists(CONFIG_PATH) else None)
+    if path:
+        with open(path, 'r', encoding='utf-8') as f:
+            values = json.load(f)
+        unknown = sorted(set(values) - set(DEFAULTS))
+        if unknown:
+            raise ValueError(f'{path} 中有未知的配置项: {", ".join(unknown)}')
+        config.update(values)
+    for key in DEFAULTS:
+        value = environ.get(env_name(key))
+        if value is not None:
+            config[key] = parse_env_value(key, value)
+    return config
@@ -0,0 +1,234 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from bili_credentials import CredentialPool
+from bili_cursors import advance_cursor, is_known_item, is_pinned_item
+from bili_http_cache import article_cache_key
+from bili_metrics import CRAWL_UP_SECONDS, HTTP_REQUEST_SECONDS, HTTP_REQUESTS
+from bili_rate_limit import ThrottledError, is_throttled
+from bili_requests_functions import (API_BASE, get_article_detail_url, get_article_headers, get_space_headers,
+                                     get_space_items_url, parse_article_content, parse_dynamic_item)
+
+
+# 所有并发请求共享的keep-alive会话，连接池大小与并发上限一致
+def create_session(pool_maxsize):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# 并发爬虫：多个up主同时爬取，全局并发和单个host并发分别限流
+# 专栏详情放入单独的队列由article_workers个协程请求，与其他up主的动态列表请求重叠进行
+# cursors为各up主的高水位(见bili_cursors)，爬取后原地更新；errors记录爬取失败的up主 {up_uid: 异常}
+# user_cookie可以是一个或多个cookie；传入credentials(CredentialPool)时使用该cookie池，可在多次爬取之间共用
+class Crawler:
+    def __init__(self, user_cookie, max_concurrency=16, per_host_concurrency=8, api_base=API_BASE,
+                 rate_limits=None, article_workers=4, max_retries=3, timeout=10, cursors=None, backfill=False,
+                 max_pages=5, backfill_pages=None, response_cache=None, credentials=None, errors=None):
+        self.max_concurrency = max_concurrency
+        self.per_host_concurrency = per_host_concurrency
+        self.api_base = api_base
+        # 每个cookie按接口的令牌桶限流，取代原先专栏的sleep(15)
+        self.credentials = credentials if credentials is not None else CredentialPool(user_cookie, rate_limits)
+        self.article_workers = article_workers
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.cursors = cursors if cursors is not None else {}
+        self.errors = errors if errors is not None else {}
+        # backfill时忽略游标，沿offset/has_more翻页，最多backfill_pages页(None为不限)
+        self.backfill = backfill
+        # 增量爬取时最多向后翻的页数，防止游标丢失的动态太久远时一直翻页
+        self.max_pages = max_pages
+        self.backfill_pages = backfill_pages
+        # 可选的响应缓存(bili_http_cache.ResponseCache)，命中时不消耗限流令牌
+        self.response_cache = response_cache
+        self.session = None
+        self.executor = None
+        self.semaphore = None
+        self.host_semaphores = {}
+        self.article_queue = None
+
+    # 带限流和全局/单host并发限制的GET请求，requests在线程池中执行，不阻塞事件循环
+    # make_headers(cookie, user_agent)生成请求头，每次请求从cookie池取一个cookie
+    # endpoint对应限流器里的接口名，被风控时降速并换一个cookie重试
+    async def fetch_json(self, url, make_headers, endpoint, cache_key=None):
+        entry = None
+        if self.response_cache is not None:
+            cache_key = cache_key or url
+            entry = self.response_cache.lookup(cache_key)
+            if entry is not None and entry['fresh']:
+                HTTP_REQUESTS.inc(endpoint=endpoint, result='cached')
+                return entry['payload']
+        host = urlsplit(url).netloc
+        if host not in self.host_semaphores:
+            self.host_semaphores[host] = asyncio.Semaphore(self.per_host_concurrency)
+        loop = asyncio.get_running_loop()
+        for _ in range(self.max_retries + 1):
+            # 等待令牌时不占用并发名额
+            credential = await self.credentials.acquire(endpoint)
+            headers = make_headers(credential.cookie, credential.user_agent)
+            if self.response_cache is not None:
+                headers = self.response_cache.conditional_headers(entry, headers)
+            try:
+                async with self.semaphore, self.host_semaphores[host]:
+                    with HTTP_REQUEST_SECONDS.time(endpoint=endpoint):
+                        response = await loop.run_in_executor(
+                            self.executor, partial(self.session.get, url, headers=headers, timeout=self.timeout))
+                payload = None if response.status_code in (304, 412) else response.json()
+            except BaseException:
+                HTTP_REQUESTS.inc(endpoint=endpoint, result='error')
+                self.credentials.release(credential)
+                raise
+            throttled = is_throttled(response.status_code, payload)
+            self.credentials.report(credential, endpoint, throttled)
+            if response.status_code == 304 and entry is not None:
+                HTTP_REQUESTS.inc(endpoint=endpoint, result='not_modified')
+                self.response_cache.refresh(cache_key, endpoint)
+                return entry['payload']
+            HTTP_REQUESTS.inc(endpoint=endpoint, result='throttled' if throttled else 'ok')
+            if not throttled:
+                if self.response_cache is not None and payload.get('code') == 0:
+                    self.response_cache.store(cache_key, endpoint, payload, response.headers.get('ETag'),
+                                              response.headers.get('Last-Modified'))
+                return payload
+        raise ThrottledError(f'{url} 多次触发风控')
+
+    # 专栏队列的消费者
+    async def article_worker(self):
+        while True:
+            up_name, up_uid, data_id, data_type, future = await self.article_queue.get()
+            # up主翻页失败时专栏已被取消
+            if future.cancelled():
+                self.article_queue.task_done()
+                continue
+            try:
+                content = await self.fetch_json(get_article_detail_url(data_id, api_base=self.api_base),
+                                                partial(get_article_headers, data_id), 'article',
+                                                article_cache_key(data_id))
+                if not future.done():
+                    future.set_result(parse_article_content(up_name, data_id, data_type, content, up_uid))
+                print('获取了一个专栏动态')
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.article_queue.task_done()
+
+    # 爬取单个up主，返回值与get_name_id_title_time_text_pics_list一致，但只包含游标之后的新动态
+    async def crawl_up(self, up_uid):
+        start = time.perf_counter()
+        cursor = self.cursors.get(up_uid)
+        new_cursor = cursor
+        if self.backfill:
+            max_pages = self.backfill_pages
+        elif cursor:
+            max_pages = self.max_pages
+        else:
+            # 首次爬取只取第一页，更早的动态交给backfill
+            max_pages = 1
+        up_name = None
+        offset = ''
+        pages = 0
+        # 专栏先占位，放入队列请求，最后按原顺序填回
+        name_id_title_time_text_pics_type_list = []
+        try:
+            while True:
+                data = await self.fetch_json(get_space_items_url(up_uid, offset, api_base=self.api_base),
+                                             partial(get_space_headers, up_uid), 'space')
+                page = data.get('data') or {}
+                items = page.get('items') or []
+                if not items:
+                    break
+                if up_name is None:
+                    up_name = items[0]['modules']['module_author']['name']
+                reached_known = False
+                for item in items:
+                    # 遇到已爬取的动态就停止，置顶动态除外
+                    if not self.backfill and is_known_item(item, cursor):
+                        if is_pinned_item(item):
+                            continue
+                        reached_known = True
+                        break
+                    new_cursor = advance_cursor(new_cursor, item)
+                    data_type = item['type']
+                    # 专栏需要重新请求
+                    if data_type == 'DYNAMIC_TYPE_ARTICLE':
+                        future = asyncio.get_running_loop().create_future()
+                        await self.article_queue.put((up_name, up_uid, item['basic']['rid_str'], data_type, future))
+                        name_id_title_time_text_pics_type_list.append(future)
+                    else:
+                        dynamic = parse_dynamic_item(item, up_name, up_uid)
+                        if dynamic is not None:
+                            name_id_title_time_text_pics_type_list.append(dynamic)
+                pages += 1
+                offset = page.get('offset') or ''
+                if reached_known or not page.get('has_more') or not offset or (max_pages and pages >= max_pages):
+                    break
+        except BaseException:
+            # 翻页失败时取消已放入队列的专栏
+            for item in name_id_title_time_text_pics_type_list:
+                if isinstance(item, asyncio.Future):
+                    item.cancel()
+            raise
+        if not name_id_title_time_text_pics_type_list:
+            print(f'{up_uid}没有新动态')
+        # 等待全部专栏完成后再抛出第一个异常，不留下没有取回结果的future
+        futures = [item for item in name_id_title_time_text_pics_type_list if isinstance(item, asyncio.Future)]
+        results = iter(await asyncio.gather(*futures, return_exceptions=True))
+        name_id_title_time_text_pics_type_list = [next(results) if isinstance(item, asyncio.Future) else item
+                                                  for item in name_id_title_time_text_pics_type_list]
+        for item in name_id_title_time_text_pics_type_list:
+            if isinstance(item, BaseException):
+                raise item
+        # 全部请求成功后才推进游标
+        if new_cursor:
+            self.cursors[up_uid] = new_cursor
+        CRAWL_UP_SECONDS.observe(time.perf_counter() - start)
+        return name_id_title_time_text_pics_type_list
+
+    # 并发爬取全部up主，单个up主失败不影响其他up主
+    async def crawl(self, up_uids):
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.host_semaphores = {}
+        self.session = create_session(self.max_concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        self.article_queue = asyncio.Queue()
+        workers = [asyncio.create_task(self.article_worker()) for _ in range(self.article_workers)]
+        try:
+            results = await asyncio.gather(*(self.crawl_up(up_uid) for up_uid in up_uids), return_exceptions=True)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            self.executor.shutdown(wait=False)
+            self.session.close()
+        up_dynamics = {}
+        for up_uid, result in zip(up_uids, results):
+            if isinstance(result, Exception):
+                print(f'{up_uid}爬取失败: {result!r}')
+                self.errors[up_uid] = result
+                continue
+            up_dynamics[up_uid] = result
+        return up_dynamics
+
+
+# 并发爬取多个up主，返回{up_uid: Dynamic列表}
+# user_cookie可以是一个cookie或cookie列表，请求分摊到各个cookie上
+# rate_limits形如 {'article': (每秒请求数, 突发容量)}，是每个cookie的速率，覆盖bili_rate_limit中的默认值
+# 传入cursors时只爬取新动态并原地更新cursors；backfill为True时沿offset翻页爬取历史动态
+# 爬取失败的up主不在返回值里，传入errors时把失败原因写入errors
+def crawl_up_uids(up_uids, user_cookie, max_concurrency=16, per_host_concurrency=8, api_base=API_BASE,
+                  rate_limits=None, article_workers=4, cursors=None, backfill=False, max_pages=5,
+                  backfill_pages=None, response_cache=None, credentials=None, errors=None):
+    crawler = Crawler(user_cookie, max_concurrency=max_concurrency, per_host_concurrency=per_host_concurrency,
+                      api_base=api_base, rate_limits=rate_limits, article_workers=article_workers,
+                      cursors=cursors, backfill=backfill, max_pages=max_pages, backfill_pages=backfill_pages,
+                      response_cache=response_cache, credentials=credentials, errors=errors)
+    return asyncio.run(crawler.crawl(up_uids))
@@ -0,0 +1,119 @@
+import asyncio
+import threading
+import time
+
+from bili_rate_limit import RateLimiter
+
+# 连续被风控多少次后暂停使用该cookie，以及暂停时长的初始值和上限(秒)，每多一次风控暂停时间翻倍
+# 并发请求被风控时往往同时返回，阈值不宜太小
+THROTTLE_THRESHOLD = 5
+BASE_COOLDOWN = 30
+MAX_COOLDOWN = 1800
+
+_user_agents = None
+_user_agents_lock = threading.Lock()
+
+
+# 随机的User-Agent；fake_useragent在第一次调用时才导入，数据文件每个进程只加载一次
+def random_user_agent():
+    global _user_agents
+    with _user_agents_lock:
+        if _user_agents is None:
+            from fake_useragent import UserAgent
+            _user_agents = UserAgent()
+    return _user_agents.random
+
+
+# 一个cookie及与之固定搭配的User-Agent，各自有独立的限流器和风控统计
+class Credential:
+    def __init__(self, cookie, user_agent, rate_limits=None):
+        self.cookie = cookie
+        self.user_agent = user_agent
+        self.rate_limiter = RateLimiter(rate_limits)
+        self.requests = 0
+        self.in_flight = 0
+        self.throttles = 0
+        self.consecutive_throttles = 0
+        self.cooldown_until = 0.0
+
+    def throttle_rate(self):
+        return self.throttles / self.requests if self.requests else 0.0
+
+
+# cookie池：请求分摊到多个cookie上，每个cookie按自己的令牌桶限流，总吞吐量随cookie数增长
+# 每次选择不在冷却中、令牌最早可用(其次进行中的请求最少、风控率最低)的cookie；连续被风控的cookie暂停使用一段时间，
+# 没有其他可用的cookie时不暂停，只靠限流器降速
+class CredentialPool:
+    def __init__(self, cookies, rate_limits=None, throttle_threshold=THROTTLE_THRESHOLD, base_cooldown=BASE_COOLDOWN,
+                 max_cooldown=MAX_COOLDOWN):
+        if isinstance(cookies, str):
+            cookies = [cookies]
+        self.credentials = [Credential(cookie, random_user_agent(), rate_limits) for cookie in dict.fromkeys(cookies)]
+        if not self.credentials:
+            raise ValueError('至少需要一个cookie')
+        self.throttle_threshold = throttle_threshold
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.credentials)
+
+    # 选出下一个请求使用的cookie；全部在冷却中时返回(None, 需要等待的秒数)
+    def choose(self, endpoint):
+        now = time.monotonic()
+        with self.lock:
+            available = [credential for credential in self.credentials if credential.cooldown_until <= now]
+            if not available:
+                return None, min(credential.cooldown_until for credential in self.credentials) - now
+            credential = min(available, key=lambda credential: (
+                credential.rate_limiter.bucket(endpoint).wait_time(), credential.in_flight,
+                credential.throttle_rate()))
+            credential.in_flight += 1
+            return credential, 0
+
+    # 取得一个cookie并等待它的令牌，之后必须调用report或release
+    async def acquire(self, endpoint):
+        while True:
+            credential, wait = self.choose(endpoint)
+            if credential is not None:
+                try:
+                    await credential.rate_limiter.acquire(endpoint)
+                except BaseException:
+                    self.release(credential)
+                    raise
+                return credential
+            await asyncio.sleep(wait)
+
+    # 请求没有得到响应(网络错误等)时归还cookie，不计入统计
+    def release(self, credential):
+        with self.lock:
+            credential.in_flight -= 1
+
+    # 根据响应结果调整该cookie的速率和冷却状态
+    def report(self, credential, endpoint, throttled):
+        credential.rate_limiter.report(endpoint, throttled)
+        with self.lock:
+            credential.requests += 1
+            credential.in_flight -= 1
+            if not throttled:
+                credential.consecutive_throttles = 0
+                return
+            credential.throttles += 1
+            credential.consecutive_throttles += 1
+            excess = credential.consecutive_throttles - self.throttle_threshold
+            now = time.monotonic()
+            others = any(other is not credential and other.cooldown_until <= now for other in self.credentials)
+            if excess >= 0 and others:
+                cooldown = min(self.max_cooldown, self.base_cooldown * 2 ** excess)
+                credential.cooldown_until = now + cooldown
+                print(f'第{self.credentials.index(credential) + 1}个cookie连续{credential.consecutive_throttles}次'
+                      f'触发风控，暂停使用{cooldown}秒')
+
+    # 每个cookie的请求数、风控次数和是否在冷却中
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            return [{'requests': credential.requests, 'throttles': credential.throttles,
+                     'throttle_rate': round(credential.throttle_rate(), 3),
+                     'cooling_down': credential.cooldown_until > now} for credential in self.credentials]
@@ -0,0 +1,47 @@
+import json
+import os
+
+# 每个up主已爬取到的最新动态(高水位)，形如 {up_uid: {'id_str': ..., 'pub_ts': ...}}
+CURSORS_PATH = os.path.join('state', 'cursors.json')
+
+
+# 读取游标，文件不存在时视为首次爬取
+def load_cursors(path=CURSORS_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+# 写入游标，先写临时文件再替换，避免中途退出留下损坏的文件
+def save_cursors(cursors, path=CURSORS_PATH):
+    output_dir = os.path.dirname(path)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(cursors, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+    print(f'游标已保存到 {path}')
+
+
+# 判断一条原始动态是否已经爬取过
+def is_known_item(item, cursor):
+    if not cursor:
+        return False
+    pub_ts = item['modules']['module_author'].get('pub_ts') or 0
+    return item['id_str'] == cursor['id_str'] or pub_ts < cursor['pub_ts']
+
+
+# 置顶动态可能很旧，不能作为停止条件
+def is_pinned_item(item):
+    module_tag = item['modules'].get('module_tag') or {}
+    return module_tag.get('text') == '置顶'
+
+
+# 用本次爬到的动态推进高水位
+def advance_cursor(cursor, item):
+    pub_ts = item['modules']['module_author'].get('pub_ts') or 0
+    if cursor is None or pub_ts > cursor['pub_ts']:
+        return {'id_str': item['id_str'], 'pub_ts': pub_ts}
+    return cursor
@@ -0,0 +1,58 @@
+import re
+from datetime import date, datetime, timedelta, timezone
+
+# 北京时间，没有夏令时，用固定偏移代替pytz
+SHANGHAI = timezone(timedelta(hours=8), 'Asia/Shanghai')
+
+# 所有支持的格式合成一个正则，一次匹配即可确定格式
+_DATE_PATTERN = re.compile(r'''
+    (?P<iso_year>\d{4})-(?P<iso_month>\d{2})-(?P<iso_day>\d{2})         # 2024-03-25
+    | (?:(?P<cn_year>\d{4})年)?(?P<cn_month>\d{2})月(?P<cn_day>\d{2})日  # 2024年03月25日 / 03月25日
+    | (?P<ago>\d+)(?P<unit>分钟|小时|天)前                                # n分钟前 / n小时前 / n天前
+    | 昨天\s+(?P<hour>\d{2}):(?P<minute>\d{2})                          # 昨天 20:34
+    | (?P<just_now>刚刚)
+''', re.X)
+_UNITS = {'分钟': timedelta(minutes=1), '小时': timedelta(hours=1), '天': timedelta(days=1)}
+
+_WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+# 当前北京时间，同一批数据应只取一次，作为相对时间("n小时前")的参照
+def now_shanghai():
+    return datetime.now(SHANGHAI)
+
+
+# 把B站的各种时间表示转为带时区的datetime
+# 支持时间戳、date/datetime对象以及_DATE_PATTERN中的字符串，没有时区的时间视为北京时间
+def parse_date(value, now=None):
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, SHANGHAI)
+    if isinstance(value, datetime):
+        return value if value.tzinfo is not None else value.replace(tzinfo=SHANGHAI)
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day, tzinfo=SHANGHAI)
+    match = _DATE_PATTERN.fullmatch(value.strip())
+    if match is None:
+        raise ValueError(f'无法解析的日期格式: {value}')
+    groups = match.groupdict()
+    if groups['iso_year']:
+        return datetime(int(groups['iso_year']), int(groups['iso_month']), int(groups['iso_day']), tzinfo=SHANGHAI)
+    if now is None:
+        now = now_shanghai()
+    if groups['cn_month']:
+        year = int(groups['cn_year']) if groups['cn_year'] else now.year
+        return datetime(year, int(groups['cn_month']), int(groups['cn_day']), tzinfo=SHANGHAI)
+    if groups['ago']:
+        return now - int(groups['ago']) * _UNITS[groups['unit']]
+    if groups['hour']:
+        yesterday = now - timedelta(days=1)
+        return yesterday.replace(hour=int(groups['hour']), minute=int(groups['minute']), second=0, microsecond=0)
+    return now
+
+
+# RFC 822格式(UTC)，用于rss的pubDate/lastBuildDate，不受locale影响
+def format_rfc822(dt):
+    dt = dt.astimezone(timezone.utc)
+    return (f'{_WEEKDAYS[dt.weekday()]}, {dt.day:02d} {_MONTHS[dt.month - 1]} {dt.year} '
+            f'{dt.hour:02d}:{dt.minute:02d}:{dt.second:02d} +0000')
@@ -0,0 +1,246 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+
+from bili_dates import now_shanghai
+from bili_filter import ensure_filter_schema, lock_seq_shared
+from bili_metrics import DB_FLUSH_SECONDS, DB_ROWS
+from bili_requests_functions import (CREATE_TABLE_DATA_SQL, CREATE_TABLE_FILTERED_SQL, CREATE_TABLE_TAGS_SQL,
+                                     backfill_uid_columns, ensure_uid_columns)
+from bili_retention import (CREATE_TABLE_DATA_PARTITIONED_SQL, convert_to_partitioned, ensure_partitions,
+                            ensure_urls_table, is_partitioned, month_start, urls_table)
+
+# 本进程已经建过的表，同一张表只建一次
+_created_tables = set()
+_created_tables_lock = threading.Lock()
+
+
+# 攒批写入的公共部分：所有up主的动态先放进缓冲区，攒够batch_size条或距上次写入超过flush_interval秒时一次性写入
+# 子类实现insert_rows(rows)，返回新插入的行数；search_index为bili_search.SearchIndex时，每次写入后调用sync_search_index
+# 把新行同步到全文索引(默认不做任何事)
+class BufferedWriter(ABC):
+    def __init__(self, table_data, batch_size=1000, flush_interval=5.0, search_index=None):
+        self.table_data = table_data
+        self.search_index = search_index
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.last_flush = time.monotonic()
+        self.inserted = 0
+        self.conflicted = 0
+        # 后台线程按时间阈值写入
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._flush_periodically, daemon=True)
+        self.thread.start()
+
+    # 加入一个up主的动态列表，缓冲区满时立即写入
+    def add(self, name_id_title_time_text_pics_type_list):
+        now = now_shanghai()
+        rows = [dynamic.to_row(now) for dynamic in name_id_title_time_text_pics_type_list]
+        with self.lock:
+            self.buffer.extend(rows)
+            full = len(self.buffer) >= self.batch_size
+        if full:
+            self.flush()
+
+    # 把缓冲区一次性写入，返回新插入的行数
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                rows, self.buffer = self.buffer, []
+                self.last_flush = time.monotonic()
+            if not rows:
+                return 0
+            start = time.perf_counter()
+            try:
+                inserted = self.insert_rows(rows)
+            except Exception:
+                # 写入失败时放回缓冲区，下次再写
+                with self.lock:
+                    self.buffer[:0] = rows
+                raise
+            DB_FLUSH_SECONDS.observe(time.perf_counter() - start)
+            DB_ROWS.inc(inserted, result='inserted')
+            DB_ROWS.inc(len(rows) - inserted, result='conflicted')
+            self.inserted += inserted
+            self.conflicted += len(rows) - inserted
+            print(f'数据成功写入数据库，新增{inserted}条，已存在{len(rows) - inserted}条')
+            if inserted and self.search_index is not None:
+                self.sync_search_index()
+            return inserted
+
+    @abstractmethod
+    def insert_rows(self, rows):
+        pass
+
+    def sync_search_index(self):
+        pass
+
+    def _flush_periodically(self):
+        while not self.stop_event.wait(min(self.flush_interval, 1.0)):
+            if self.buffer and time.monotonic() - self.last_flush >= self.flush_interval:
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(f'定时写入失败: {e!r}')
+
+    # 停止后台线程并写入剩余数据
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# 批量写Postgres，连接来自连接池，整个进程复用，不再每个up主、每个步骤新建连接
+# partitioned为True时数据表按pub_ts的月份分区(旧表在ensure_schema时转换)，写入前按需建立当月的分区
+class DynamicsWriter(BufferedWriter):
+    def __init__(self, database, user, password, host, port, table_data, batch_size=1000, flush_interval=5.0,
+                 minconn=1, maxconn=4, search_index=None, partitioned=False):
+        import psycopg2.pool
+        self.pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, database=database, user=user,
+                                                         password=password, host=host, port=port)
+        self.partitioned = partitioned
+        self.partition_months = set()
+        self.insert_sql, self.insert_template = self._insert_sql(table_data, partitioned)
+        super().__init__(table_data, batch_size, flush_interval, search_index)
+
+    # 返回(插入语句, execute_values的模板)；先插入detail_url表去重(见bili_retention)，已归档的动态不会重新写入，
+    # 同一批里重复的detail_url只写入一条；分区表的主键包含pub_ts；VALUES里的列没有类型，模板里写明
+    @staticmethod
+    def _insert_sql(table_data, partitioned):
+        import psycopg2.sql
+        conflict = '(detail_url, pub_ts)' if partitioned else '(detail_url)'
+        insert_sql = psycopg2.sql.SQL('''
+            WITH new_rows (up_name, detail_url, title, time, text, pics, type, up_uid, pub_ts) AS (VALUES %s),
+            new_urls AS (
+                INSERT INTO {table_urls} (detail_url) SELECT detail_url FROM new_rows
+                ON CONFLICT DO NOTHING
+                RETURNING detail_url
+            )
+            INSERT INTO {table_data} (up_name, detail_url, title, time, text, pics, type, up_uid, pub_ts)
+            SELECT DISTINCT ON (detail_url) new_rows.* FROM new_rows JOIN new_urls USING (detail_url)
+            ON CONFLICT {conflict} DO NOTHING
+            RETURNING detail_url
+        ''').format(table_data=psycopg2.sql.Identifier(table_data),
+                    table_urls=psycopg2.sql.Identifier(urls_table(table_data)), conflict=psycopg2.sql.SQL(conflict))
+        return insert_sql, '(%s, %s, %s, %s::date, %s, %s::text[], %s, %s, %s::timestamptz)'
+
+    # 建表，旧表补上seq、up_uid和pub_ts列，建立筛选和/rss/query用的索引，每个进程每张表只执行一次
+    # 回填是全表UPDATE，只在刚补上up_uid/pub_ts列时执行一次，之后由migrate显式执行
+    # 筛选、全文索引同步和flask都假定表结构已经建立，不再执行DDL
+    def ensure_schema(self, table_tags=None, table_filtered=None):
+        import psycopg2.sql
+        tables = [(CREATE_TABLE_DATA_SQL, 'table_data', self.table_data)]
+        if table_tags:
+            tables.append((CREATE_TABLE_TAGS_SQL, 'table_tags', table_tags))
+        if table_filtered:
+            tables.append((CREATE_TABLE_FILTERED_SQL, 'table_filtered', table_filtered))
+        with _created_tables_lock:
+            tables = [table for table in tables if (table[1], table[2]) not in _created_tables]
+            if not tables:
+                return
+            connect = self.pool.getconn()
+            try:
+                if tables[0][1] == 'table_data':
+                    self._prepare_partitions(connect)
+                    if self.partitioned:
+                        tables[0] = (CREATE_TABLE_DATA_PARTITIONED_SQL,) + tables[0][1:]
+                added = False
+                with connect.cursor() as cursor:
+                    for create_sql, kind, table in tables:
+                        create_sql = psycopg2.sql.SQL(create_sql)
+                        cursor.execute(create_sql.format(**{kind: psycopg2.sql.Identifier(table)}))
+                        if kind != 'table_tags':
+                            added = ensure_uid_columns(cursor, table) or added
+                    if tables[0][1] == 'table_data':
+                        # 旧表补上seq列，建立筛选状态表和去重用的detail_url表
+                        ensure_filter_schema(cursor, self.table_data)
+                        ensure_urls_table(cursor, self.table_data)
+                    if any(kind == 'table_filtered' for _, kind, _ in tables):
+                        from bili_query import ensure_query_indexes
+                        ensure_query_indexes(cursor, self.table_data, table_filtered)
+                    if added:
+                        backfilled = backfill_uid_columns(cursor, self.table_data, table_filtered)
+                        print(f'旧数据回填了up_uid/pub_ts，共{backfilled}条')
+                connect.commit()
+            finally:
+                self.pool.putconn(connect)
+            for _, kind, table in tables:
+                _created_tables.add((kind, table))
+        print('数据表创建成功/已存在')
+
+    # 回填旧数据的up_uid/pub_ts(见backfill_uid_columns)，写入新动态后旧数据能对应上uid时执行
+    def migrate(self, table_filtered=None):
+        connect = self.pool.getconn()
+        try:
+            with connect.cursor() as cursor:
+                backfilled = backfill_uid_columns(cursor, self.table_data, table_filtered)
+            connect.commit()
+        except Exception:
+            connect.rollback()
+            raise
+        finally:
+            self.pool.putconn(connect)
+        print(f'旧数据回填了up_uid/pub_ts，共{backfilled}条')
+        return backfilled
+
+    # partitioned时把已有的普通数据表转为分区表；数据表已经是分区表时(另一个进程转换过)也按分区表写入
+    def _prepare_partitions(self, connect):
+        import psycopg2.sql
+        with connect.cursor() as cursor:
+            cursor.execute('SELECT to_regclass(%s)', (psycopg2.sql.Identifier(self.table_data).as_string(cursor),))
+            exists = cursor.fetchone()[0] is not None
+            partitioned = exists and is_partitioned(cursor, self.table_data)
+        connect.commit()
+        if self.partitioned and exists and not partitioned:
+            convert_to_partitioned(connect, self.table_data)
+        elif partitioned and not self.partitioned:
+            self.partitioned = True
+            self.insert_sql, self.insert_template = self._insert_sql(self.table_data, True)
+
+    def insert_rows(self, rows):
+        import psycopg2.extras
+        connect = self.pool.getconn()
+        try:
+            months = {month_start(row[8]) for row in rows} - self.partition_months if self.partitioned else ()
+            with connect.cursor() as cursor:
+                # 见bili_filter.lock_seq_shared
+                lock_seq_shared(cursor, self.table_data)
+                if months:
+                    ensure_partitions(cursor, self.table_data, sorted(months))
+                inserted = psycopg2.extras.execute_values(cursor, self.insert_sql, rows, self.insert_template,
+                                                          page_size=self.batch_size, fetch=True)
+            connect.commit()
+            self.partition_months.update(months)
+        except Exception:
+            connect.rollback()
+            raise
+        finally:
+            self.pool.putconn(connect)
+        return len(inserted)
+
+    # 把数据表的新行同步到全文索引，失败时只打印，下次写入时会从上次的进度继续
+    def sync_search_index(self):
+        connect = self.pool.getconn()
+        try:
+            self.search_index.sync(connect, self.table_data)
+        except Exception as e:
+            connect.rollback()
+            print(f'同步全文索引失败: {e!r}')
+        finally:
+            self.pool.putconn(connect)
+
+    # 写入剩余数据并关闭连接池
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.pool.closeall()
@@ -0,0 +1,109 @@
+import hashlib
+import html
+import json
+import os
+import re
+import tempfile
+
+# 每个feed上次生成时的条目哈希，用于跳过没有变化的重建
+FEED_STATE_DIR = os.path.join('state', 'feeds')
+
+_ITEM_PATTERN = re.compile(r'    <item>\n.*?    </item>\n', re.S)
+_GUID_PATTERN = re.compile(r'<guid[^>]*>(.*?)</guid>', re.S)
+_CHANNEL_END = '  </channel>\n</rss>\n'
+
+
+# 条目内容的哈希，与lastBuildDate无关
+def hash_entries(entries):
+    data = json.dumps(entries, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def _feed_state_path(path):
+    return os.path.join(FEED_STATE_DIR, f'{os.path.basename(path)}.json')
+
+
+# 读取上次生成时的哈希，文件被删掉时视为需要重建
+def load_feed_hash(path):
+    state_path = _feed_state_path(path)
+    if not os.path.exists(path) or not os.path.exists(state_path):
+        return None
+    with open(state_path, 'r', encoding='utf-8') as f:
+        return json.load(f).get('hash')
+
+
+def save_feed_hash(path, entries_hash):
+    write_file_atomic(_feed_state_path(path), json.dumps({'hash': entries_hash}).encode('utf-8'))
+
+
+# 先写同目录下的临时文件，fsync后再替换，读者不会读到写了一半的文件，断电后也不会留下空文件
+# with块正常结束时替换path，抛出异常或调用discard()时删除临时文件；file为打开的临时文件，可以边生成边写入
+class AtomicFile:
+    def __init__(self, path, mode='wb', encoding=None, newline=None):
+        output_dir = os.path.dirname(path) or '.'
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        self.path = path
+        fd, self.tmp_path = tempfile.mkstemp(dir=output_dir, prefix=f'.{os.path.basename(path)}.', suffix='.tmp')
+        self.file = os.fdopen(fd, mode, encoding=encoding, newline=newline)
+        self.done = False
+
+    def commit(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.chmod(self.tmp_path, 0o644)
+        os.replace(self.tmp_path, self.path)
+        self.done = True
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        self.done = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.done:
+            return
+        if exc_type is None:
+            try:
+                self.commit()
+                return
+            except BaseException:
+                self.discard()
+                raise
+        self.discard()
+
+
+def write_file_atomic(path, data):
+    with AtomicFile(path) as f:
+        f.file.write(data)
+
+
+# 已有feed中所有条目的guid
+def get_feed_guids(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'r', encoding='utf-8') as f:
+        return {html.unescape(guid) for guid in _GUID_PATTERN.findall(f.read())}
+
+
+# 把只包含新条目的feed合并进已有文件：频道信息(含lastBuildDate)取新的，条目为旧条目在前、新条目在后
+# (与feedgen的add_entry一致，越新的条目越靠后)，超过max_entries时丢弃最旧的条目
+def merge_feed(path, new_feed, max_entries=None):
+    new_text = new_feed.decode('utf-8')
+    if not os.path.exists(path):
+        old_items = []
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            old_items = _ITEM_PATTERN.findall(f.read())
+    new_items = _ITEM_PATTERN.findall(new_text)
+    items = old_items + new_items
+    if max_entries and len(items) > max_entries:
+        items = items[len(items) - max_entries:]
+    first_item = new_text.find('    <item>\n')
+    head = new_text[:first_item] if first_item != -1 else new_text[:new_text.rfind(_CHANNEL_END)]
+    return (head + ''.join(items) + _CHANNEL_END).encode('utf-8')
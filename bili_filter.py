@@ -0,0 +1,187 @@
+import hashlib
+import time
+from collections import deque
+
+from bili_metrics import FILTER_ROWS, FILTER_SECONDS
+
+# 记录每张筛选表已经处理到数据表的哪一行(seq)，以及当时的标签集合
+FILTER_STATE_TABLE = 'bili_filter_state'
+
+
+# Aho-Corasick自动机，一次扫描文本即可找出所有命中的标签
+# 与原先的LIKE不同，标签里的%和_按普通字符匹配
+class AhoCorasick:
+    def __init__(self, words):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+        for word in words:
+            if not word:
+                continue
+            state = 0
+            for ch in word:
+                next_state = self.goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][ch] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                state = next_state
+            self.output[state] = self.output[state] + (word,)
+        # 按层次遍历建立失败指针，并把失败指针上的输出合并进来
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and ch not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(ch, 0)
+                self.fail[next_state] = fail
+                self.output[next_state] = self.output[next_state] + self.output[fail]
+
+    # 返回文本中出现过的标签集合
+    def find(self, text, matched=None):
+        if matched is None:
+            matched = set()
+        if not text:
+            return matched
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                matched.update(output[state])
+        return matched
+
+
+# 给已有的数据表补上seq列和索引，并建立筛选状态表；ALTER TABLE即使不需要加列也会锁住整张表，只在建表时执行一次
+def ensure_filter_schema(cursor, table_data):
+    import psycopg2.sql
+    cursor.execute(psycopg2.sql.SQL('ALTER TABLE {table_data} ADD COLUMN IF NOT EXISTS seq BIGSERIAL').format(
+        table_data=psycopg2.sql.Identifier(table_data)))
+    cursor.execute(psycopg2.sql.SQL('CREATE INDEX IF NOT EXISTS {index} ON {table_data} (seq)').format(
+        index=psycopg2.sql.Identifier(f'{table_data}_seq_idx'), table_data=psycopg2.sql.Identifier(table_data)))
+    cursor.execute(psycopg2.sql.SQL('''CREATE TABLE IF NOT EXISTS {state_table} (
+        table_filtered CHARACTER VARYING PRIMARY KEY,
+        last_seq BIGINT,
+        tags_hash CHARACTER VARYING
+    )''').format(state_table=psycopg2.sql.Identifier(FILTER_STATE_TABLE)))
+
+
+# seq在插入时分配而不是在提交时，多个进程同时写入时seq较小的行可能晚于seq较大的行提交
+# 写入数据表的事务先取得数据表的共享advisory锁；读取seq上界前短暂取得排他锁，等正在写入的事务全部提交，
+# 之后再分配的seq都大于上界，按seq增量处理的一方(筛选、全文索引)只处理到上界就不会漏掉晚提交的行
+def lock_seq_shared(cursor, table_data):
+    cursor.execute('SELECT pg_advisory_xact_lock_shared(hashtext(%s))', (table_data,))
+
+
+# 已提交的最大seq，见lock_seq_shared
+def committed_seq(cursor, table_data):
+    import psycopg2.sql
+    cursor.execute('SELECT pg_advisory_lock(hashtext(%s))', (table_data,))
+    try:
+        cursor.execute(psycopg2.sql.SQL('SELECT COALESCE(MAX(seq), 0) FROM {table_data}').format(
+            table_data=psycopg2.sql.Identifier(table_data)))
+        return cursor.fetchone()[0]
+    except BaseException:
+        cursor.connection.rollback()
+        raise
+    finally:
+        cursor.execute('SELECT pg_advisory_unlock(hashtext(%s))', (table_data,))
+
+
+# 增量筛选：只处理上次筛选之后新插入的行，用Aho-Corasick在进程内匹配标签，只写入有变化的结果
+# 标签表变化时重新筛选全部数据；表结构(seq列、筛选状态表等)由DynamicsWriter.ensure_schema建立，这里不执行DDL
+def filter_data_incremental(database, user, password, host, port, table_data, table_tags, table_filtered,
+                            batch_size=5000):
+    import psycopg2.extras
+    import psycopg2.sql
+    start = time.perf_counter()
+    connect = psycopg2.connect(database=database, user=user, password=password, host=host, port=port)
+    cursor = connect.cursor()
+    upper_seq = committed_seq(cursor, table_data)
+
+    cursor.execute(psycopg2.sql.SQL('SELECT tag FROM {table_tags}').format(
+        table_tags=psycopg2.sql.Identifier(table_tags)))
+    tags = sorted(row[0] for row in cursor.fetchall())
+    tags_hash = hashlib.sha1('\n'.join(tags).encode('utf-8')).hexdigest()
+    cursor.execute(psycopg2.sql.SQL('SELECT last_seq, tags_hash FROM {state_table} WHERE table_filtered = %s').format(
+        state_table=psycopg2.sql.Identifier(FILTER_STATE_TABLE)), (table_filtered,))
+    state = cursor.fetchone()
+    state_matches = state is not None and state[1] == tags_hash
+    if state_matches:
+        last_seq = state[0]
+    else:
+        # 首次筛选或标签变化，清空筛选表后全部重新筛选
+        last_seq = 0
+        cursor.execute(psycopg2.sql.SQL('DELETE FROM {table_filtered}').format(
+            table_filtered=psycopg2.sql.Identifier(table_filtered)))
+        print('标签有变化，重新筛选全部数据')
+    automaton = AhoCorasick(tags)
+
+    # 内容没有变化的行不更新
+    insert_sql = psycopg2.sql.SQL("""
+        INSERT INTO {table_filtered} AS f (up_name, detail_url, title, time, text, pics, type, up_uid, pub_ts, tags)
+        VALUES %s
+        ON CONFLICT (detail_url) DO UPDATE SET
+            up_name = EXCLUDED.up_name,
+            title = EXCLUDED.title,
+            time = EXCLUDED.time,
+            text = EXCLUDED.text,
+            pics = EXCLUDED.pics,
+            type = EXCLUDED.type,
+            up_uid = EXCLUDED.up_uid,
+            pub_ts = EXCLUDED.pub_ts,
+            tags = EXCLUDED.tags
+        WHERE (f.up_name, f.title, f.time, f.text, f.pics, f.type, f.up_uid, f.pub_ts, f.tags)
+            IS DISTINCT FROM (EXCLUDED.up_name, EXCLUDED.title, EXCLUDED.time, EXCLUDED.text, EXCLUDED.pics,
+                              EXCLUDED.type, EXCLUDED.up_uid, EXCLUDED.pub_ts, EXCLUDED.tags)
+    """).format(table_filtered=psycopg2.sql.Identifier(table_filtered))
+
+    # 服务端游标分批读取新行
+    reader = connect.cursor(name=f'{table_filtered}_filter_reader')
+    reader.itersize = batch_size
+    reader.execute(psycopg2.sql.SQL("""
+        SELECT seq, up_name, detail_url, title, time, text, pics, type, up_uid, pub_ts
+        FROM {table_data}
+        WHERE seq > %s AND seq <= %s
+        ORDER BY seq
+    """).format(table_data=psycopg2.sql.Identifier(table_data)), (last_seq, upper_seq))
+    scanned = 0
+    matched_rows = 0
+    results = []
+    for seq, up_name, detail_url, title, date, text, pics, type, up_uid, pub_ts in reader:
+        scanned += 1
+        matched = automaton.find(text, automaton.find(title))
+        if not matched:
+            continue
+        results.append((up_name, detail_url, title, date, text, pics, type, up_uid, pub_ts, sorted(matched)))
+        if len(results) >= batch_size:
+            psycopg2.extras.execute_values(cursor, insert_sql, results, page_size=batch_size)
+            matched_rows += len(results)
+            results = []
+    if results:
+        psycopg2.extras.execute_values(cursor, insert_sql, results, page_size=batch_size)
+        matched_rows += len(results)
+    reader.close()
+    last_seq = max(last_seq, upper_seq)
+
+    cursor.execute(psycopg2.sql.SQL('''
+        INSERT INTO {state_table} (table_filtered, last_seq, tags_hash) VALUES (%s, %s, %s)
+        ON CONFLICT (table_filtered) DO UPDATE SET last_seq = EXCLUDED.last_seq, tags_hash = EXCLUDED.tags_hash
+    ''').format(state_table=psycopg2.sql.Identifier(FILTER_STATE_TABLE)), (table_filtered, last_seq, tags_hash))
+    connect.commit()
+    cursor.close()
+    connect.close()
+    FILTER_SECONDS.observe(time.perf_counter() - start, mode='incremental' if state_matches else 'full')
+    FILTER_ROWS.inc(scanned, result='scanned')
+    FILTER_ROWS.inc(matched_rows, result='matched')
+    print(f'筛选数据已插入到新表，扫描{scanned}条，命中{matched_rows}条')
+    return matched_rows
@@ -0,0 +1,128 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# 接口响应的磁盘缓存，保存在sqlite里，按最近访问时间淘汰
+CACHE_PATH = os.path.join('state', 'http_cache.sqlite3')
+# 各接口的缓存时间(秒)，None为永久缓存(专栏发布后不会再变)
+DEFAULT_CACHE_TTLS = {
+    'space': 60,
+    'article': None,
+}
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+# 专栏详情按rid_str缓存，与请求地址里的其他参数无关
+def article_cache_key(data_id):
+    return f'article:{data_id}'
+
+
+class ResponseCache:
+    def __init__(self, path=CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES, ttls=None):
+        output_dir = os.path.dirname(path)
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULT_CACHE_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.lock = threading.Lock()
+        self.connect = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connect.execute('PRAGMA journal_mode=WAL')
+        self.connect.execute('PRAGMA synchronous=NORMAL')
+        self.connect.execute('''CREATE TABLE IF NOT EXISTS http_cache (
+            key TEXT PRIMARY KEY,
+            body BLOB,
+            etag TEXT,
+            last_modified TEXT,
+            expires_at REAL,
+            last_access REAL,
+            size INTEGER
+        )''')
+        self.connect.execute('CREATE INDEX IF NOT EXISTS http_cache_last_access ON http_cache (last_access)')
+        self.total_bytes = self.connect.execute('SELECT COALESCE(SUM(size), 0) FROM http_cache').fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evictions = 0
+
+    # 查询缓存，返回 {'payload', 'etag', 'last_modified', 'fresh'}，没有缓存时返回None
+    # 过期的缓存仍然返回，用于发起条件请求
+    def lookup(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.connect.execute(
+                'SELECT body, etag, last_modified, expires_at FROM http_cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            body, etag, last_modified, expires_at = row
+            fresh = expires_at is None or expires_at > now
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.connect.execute('UPDATE http_cache SET last_access = ? WHERE key = ?', (now, key))
+        return {'payload': json.loads(body), 'etag': etag, 'last_modified': last_modified, 'fresh': fresh}
+
+    # 过期缓存带上If-None-Match/If-Modified-Since，服务端未变化时返回304
+    def conditional_headers(self, entry, headers):
+        if entry is None:
+            return headers
+        headers = dict(headers)
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def _expires_at(self, endpoint, now):
+        ttl = self.ttls.get(endpoint, 0)
+        return None if ttl is None else now + ttl
+
+    # 写入一条成功的响应
+    def store(self, key, endpoint, payload, etag=None, last_modified=None):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        now = time.time()
+        with self.lock:
+            old = self.connect.execute('SELECT size FROM http_cache WHERE key = ?', (key,)).fetchone()
+            self.connect.execute(
+                'INSERT OR REPLACE INTO http_cache (key, body, etag, last_modified, expires_at, last_access, size) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, body, etag, last_modified, self._expires_at(endpoint, now), now, len(body)))
+            self.total_bytes += len(body) - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    # 304时延长缓存有效期
+    def refresh(self, key, endpoint):
+        now = time.time()
+        with self.lock:
+            self.revalidated += 1
+            self.connect.execute('UPDATE http_cache SET expires_at = ?, last_access = ? WHERE key = ?',
+                                 (self._expires_at(endpoint, now), now, key))
+
+    # 按最近访问时间淘汰，直到总大小降到上限的90%
+    def _evict(self):
+        target = self.max_bytes * 0.9
+        while self.total_bytes > target:
+            rows = self.connect.execute(
+                'SELECT key, size FROM http_cache ORDER BY last_access LIMIT 100').fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self.connect.execute('DELETE FROM http_cache WHERE key = ?', (key,))
+                self.total_bytes -= size
+                self.evictions += 1
+                if self.total_bytes <= target:
+                    break
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'revalidated': self.revalidated,
+                'evictions': self.evictions, 'bytes': self.total_bytes}
+
+    def close(self):
+        with self.lock:
+            self.connect.close()
@@ -0,0 +1,211 @@
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+from bili_credentials import random_user_agent
+from bili_models import get_mime_type
+
+# 图片的磁盘缓存：文件按内容的sha256存放在objects下，地址到文件的对应关系和最近访问时间记录在sqlite里
+MEDIA_DIR = os.path.join('state', 'media')
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+# 只代理B站图床，避免被当作开放代理
+ALLOWED_HOSTS = ('hdslb.com',)
+# B站图床按Referer防盗链
+MEDIA_REFERER = 'https://www.bilibili.com/'
+
+
+# 判断图片地址是否允许代理
+def is_allowed_url(url):
+    parts = urlsplit(url)
+    host = (parts.hostname or '').lower()
+    return parts.scheme in ('http', 'https') and any(host == allowed or host.endswith(f'.{allowed}')
+                                                     for allowed in ALLOWED_HOSTS)
+
+
+# 图片地址在代理中的路径(host加路径)，与media_source_url互为逆运算
+def media_path(url):
+    parts = urlsplit(url)
+    return f'{parts.netloc}{parts.path}'
+
+
+def media_source_url(path):
+    return f'https://{path}'
+
+
+class MediaCache:
+    def __init__(self, directory=MEDIA_DIR, max_bytes=DEFAULT_MAX_BYTES, timeout=10):
+        # flask的send_file按应用目录解析相对路径，这里统一使用绝对路径
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        os.makedirs(os.path.join(self.directory, 'objects'), exist_ok=True)
+        self.lock = threading.Lock()
+        # 同一地址同时只下载一次
+        self.fetch_locks = {}
+        self.session = requests.Session()
+        self.connect = sqlite3.connect(os.path.join(self.directory, 'index.sqlite3'), check_same_thread=False,
+                                       isolation_level=None, timeout=30)
+        self.connect.execute('PRAGMA journal_mode=WAL')
+        self.connect.execute('PRAGMA synchronous=NORMAL')
+        self.connect.execute('''CREATE TABLE IF NOT EXISTS media (
+            url TEXT PRIMARY KEY,
+            digest TEXT,
+            size INTEGER,
+            mime_type TEXT,
+            last_access REAL
+        )''')
+        self.connect.execute('CREATE INDEX IF NOT EXISTS media_last_access ON media (last_access)')
+        self.connect.execute('CREATE INDEX IF NOT EXISTS media_digest ON media (digest)')
+        self.total_bytes = self._total_bytes()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # 内容相同的图片只算一份
+    def _total_bytes(self):
+        return self.connect.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM media GROUP BY digest)').fetchone()[0]
+
+    def object_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest[:2], digest)
+
+    # 查询缓存，返回 {'path', 'digest', 'size', 'mime_type', 'cached'}，没有缓存(或文件已被其他进程淘汰)时返回None
+    def lookup(self, url):
+        with self.lock:
+            row = self.connect.execute('SELECT digest, size, mime_type FROM media WHERE url = ?', (url,)).fetchone()
+            if row is not None and not os.path.exists(self.object_path(row[0])):
+                self.connect.execute('DELETE FROM media WHERE url = ?', (url,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connect.execute('UPDATE media SET last_access = ? WHERE url = ?', (time.time(), url))
+        digest, size, mime_type = row
+        return {'path': self.object_path(digest), 'digest': digest, 'size': size, 'mime_type': mime_type,
+                'cached': True}
+
+    # 带Referer下载图片并写入缓存，下载失败时抛出requests.RequestException
+    def fetch(self, url):
+        response = self.session.get(url, headers={'Referer': MEDIA_REFERER, 'User-Agent': random_user_agent()},
+                                    timeout=self.timeout)
+        response.raise_for_status()
+        body = response.content
+        mime_type = response.headers.get('Content-Type', '').split(';', 1)[0].strip()
+        if not mime_type.startswith('image/'):
+            mime_type = get_mime_type(url)
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(body)
+            os.replace(tmp_path, path)
+        with self.lock:
+            shared = self.connect.execute('SELECT 1 FROM media WHERE digest = ? LIMIT 1', (digest,)).fetchone()
+            self.connect.execute(
+                'INSERT OR REPLACE INTO media (url, digest, size, mime_type, last_access) VALUES (?, ?, ?, ?, ?)',
+                (url, digest, len(body), mime_type, time.time()))
+            if shared is None:
+                self.total_bytes += len(body)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+        return {'path': path, 'digest': digest, 'size': len(body), 'mime_type': mime_type, 'cached': False}
+
+    # 有缓存时直接返回，否则下载
+    def get(self, url):
+        with self.lock:
+            fetch_lock = self.fetch_locks.setdefault(url, threading.Lock())
+        try:
+            with fetch_lock:
+                media = self.lookup(url)
+                if media is None:
+                    media = self.fetch(url)
+                return media
+        finally:
+            with self.lock:
+                self.fetch_locks.pop(url, None)
+
+    # 按最近访问时间淘汰，直到总大小降到上限的90%；其他进程也在写入，先重新统计总大小
+    def _evict(self):
+        target = self.max_bytes * 0.9
+        self.total_bytes = self._total_bytes()
+        while self.total_bytes > target:
+            rows = self.connect.execute('SELECT url, digest, size FROM media ORDER BY last_access LIMIT 100').fetchall()
+            if not rows:
+                break
+            for url, digest, size in rows:
+                self.connect.execute('DELETE FROM media WHERE url = ?', (url,))
+                self.evictions += 1
+                # 没有其他地址引用同样的内容时才删除文件
+                if self.connect.execute('SELECT 1 FROM media WHERE digest = ? LIMIT 1', (digest,)).fetchone() is None:
+                    try:
+                        os.remove(self.object_path(digest))
+                    except FileNotFoundError:
+                        pass
+                    self.total_bytes -= size
+                if self.total_bytes <= target:
+                    break
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'bytes': self.total_bytes}
+
+    def close(self):
+        with self.lock:
+            self.connect.close()
+        self.session.close()
+
+
+# 生成rss时把图片地址换成flask的/media代理地址，附件填上真实的大小和类型
+# base_url为flask服务对外的地址；prefetch为True时写入rss的同时下载图片，为False时只使用已有的缓存
+# 可以传给进程池，每个进程各自打开缓存；cache为已经打开的MediaCache时直接使用
+class MediaProxy:
+    def __init__(self, base_url, directory=MEDIA_DIR, max_bytes=DEFAULT_MAX_BYTES, prefetch=True, cache=None):
+        self.base_url = base_url.rstrip('/')
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.prefetch = prefetch
+        self._cache = cache
+        self._cache_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_cache'] = None
+        del state['_cache_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cache_lock = threading.Lock()
+
+    @property
+    def cache(self):
+        with self._cache_lock:
+            if self._cache is None:
+                self._cache = MediaCache(self.directory, self.max_bytes)
+            return self._cache
+
+    # 代理地址，不允许代理的地址原样返回
+    def url(self, url):
+        if not is_allowed_url(url):
+            return url
+        return f'{self.base_url}/media/{media_path(url)}'
+
+    # rss附件 (地址, 大小, 类型)，图片下载失败时大小为0、类型按后缀猜测
+    def enclosure(self, url):
+        media = None
+        if is_allowed_url(url):
+            try:
+                media = self.cache.get(url) if self.prefetch else self.cache.lookup(url)
+            except (requests.RequestException, OSError) as e:
+                print(f'图片下载失败 {url}: {e!r}')
+        if media is None:
+            return self.url(url), 0, get_mime_type(url)
+        return self.url(url), media['size'], media['mime_type']
@@ -0,0 +1,218 @@
+import bisect
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# 爬取/写库/筛选进程把指标写到这个目录，flask的/metrics接口合并输出
+METRICS_DIR = os.path.join('state', 'metrics')
+# 耗时直方图默认的分桶(秒)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, labels, extra=''):
+    parts = [f'{name}="{_escape_label(value)}"' for name, value in zip(labelnames, labels)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# 计数器，labels按labelnames的顺序传入关键字参数
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(f'{self.name}{_format_labels(self.labelnames, key)}', value)
+                    for key, value in sorted(self.values.items())]
+
+
+# 直方图，记录分布、总和和次数
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # {labels: [各分桶的计数..., 总和, 次数]}
+        self.values = {}
+        # record_observations期间保存每次观测的原始值 {labels: [值...]}
+        self.recorded = None
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+            if self.recorded is not None:
+                self.recorded.setdefault(key, []).append(value)
+
+    # 记录with块的耗时
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, counts in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    le = f'le="{_format_value(bound)}"'
+                    samples.append((f'{self.name}_bucket{_format_labels(self.labelnames, key, le)}', cumulative))
+                samples.append((f'{self.name}_bucket{_format_labels(self.labelnames, key, 'le="+Inf"')}', counts[-1]))
+                samples.append((f'{self.name}_sum{_format_labels(self.labelnames, key)}', counts[-2]))
+                samples.append((f'{self.name}_count{_format_labels(self.labelnames, key)}', counts[-1]))
+        return samples
+
+
+def _register(cls, name, documentation, labelnames, **kwargs):
+    with _registry_lock:
+        if name not in _registry:
+            _registry[name] = cls(name, documentation, labelnames, **kwargs)
+        return _registry[name]
+
+
+# 注册(或取得已注册的)计数器
+def counter(name, documentation, labelnames=()):
+    return _register(Counter, name, documentation, labelnames)
+
+
+# 注册(或取得已注册的)直方图
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+
+# with块内保存所有直方图的原始观测值，产出 {指标名: {labels: [值...]}}，供性能测试计算分位数
+@contextmanager
+def record_observations():
+    with _registry_lock:
+        histograms = [metric for metric in _registry.values() if isinstance(metric, Histogram)]
+    recorded = {}
+    for metric in histograms:
+        with metric.lock:
+            metric.recorded = recorded[metric.name] = {}
+    try:
+        yield recorded
+    finally:
+        for metric in histograms:
+            with metric.lock:
+                metric.recorded = None
+
+
+# 本进程所有指标的Prometheus文本格式
+def render_metrics():
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in metrics:
+        samples = metric.samples()
+        if not samples:
+            continue
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        lines.extend(f'{name} {_format_value(value)}' for name, value in samples)
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+# 把本进程的指标写入METRICS_DIR/{name}.prom，先写临时文件再替换
+def write_metrics_file(name='crawler', directory=METRICS_DIR):
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f'.{name}.', suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(render_metrics())
+    os.replace(tmp_path, os.path.join(directory, f'{name}.prom'))
+
+
+# 其他进程写入的指标，每个文件一段文本
+def read_metrics_files(directory=METRICS_DIR):
+    if not os.path.isdir(directory):
+        return []
+    texts = []
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.prom'):
+            with open(os.path.join(directory, filename), 'r', encoding='utf-8') as f:
+                texts.append(f.read())
+    return texts
+
+
+# 合并多段Prometheus文本，同名指标只保留一组HELP/TYPE，标签相同的样本(来自不同进程)相加
+def merge_metrics(*texts):
+    families = {}
+    for text in texts:
+        name = None
+        for line in text.splitlines():
+            if line.startswith(('# HELP ', '# TYPE ')):
+                name = line.split(' ', 3)[2]
+                family = families.setdefault(name, {'HELP': None, 'TYPE': None, 'samples': {}})
+                family[line[2:6]] = family[line[2:6]] or line
+            elif line and name is not None:
+                series, value = line.rsplit(' ', 1)
+                samples = families[name]['samples']
+                value = float(value)
+                samples[series] = samples.get(series, 0) + (int(value) if value.is_integer() else value)
+    lines = []
+    for family in families.values():
+        lines.extend(line for line in (family['HELP'], family['TYPE']) if line)
+        lines.extend(f'{series} {_format_value(value)}' for series, value in family['samples'].items())
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+# 流水线各阶段的指标
+HTTP_REQUEST_SECONDS = histogram('bili_http_request_seconds', '接口请求耗时(秒)', ('endpoint',))
+HTTP_REQUESTS = counter('bili_http_requests_total', '接口请求数，result为ok/throttled/error/cached/not_modified',
+                        ('endpoint', 'result'))
+CRAWL_UP_SECONDS = histogram('bili_crawl_up_seconds', '爬取单个up主的耗时(秒)')
+DYNAMICS_PARSED = counter('bili_dynamics_parsed_total', '解析出的动态数', ('type',))
+DB_ROWS = counter('bili_db_rows_total', '写入数据表的行数，result为inserted/conflicted', ('result',))
+DB_FLUSH_SECONDS = histogram('bili_db_flush_seconds', '一次批量写入的耗时(秒)')
+FILTER_SECONDS = histogram('bili_filter_seconds', '筛选耗时(秒)', ('mode',))
+FILTER_ROWS = counter('bili_filter_rows_total', '筛选的行数，result为scanned/matched', ('result',))
+RENDER_SECONDS = histogram('bili_render_seconds', '生成单个rss的耗时(秒)', ('feed',))
+FEEDS = counter('bili_feeds_total', '生成rss的次数，result为written/unchanged', ('feed', 'result'))
+QUERY_CACHE = counter('bili_query_cache_total', '动态查询接口的缓存命中情况，result为hit/miss',
+                      ('result',))
+FEED_RESPONSES = counter('bili_feed_responses_total', 'rss接口的响应数', ('route', 'status'))
+MEDIA_RESPONSES = counter('bili_media_responses_total', '图片代理的响应数，result为hit/miss/error', ('result',))
+ARCHIVED_ROWS = counter('bili_archived_rows_total', '超过保留期被归档并移出表的行数', ('table',))
+WORK_QUEUE_TASKS = counter('bili_work_queue_tasks_total', '爬取任务的结果，result为done/retry/dead', ('result',))
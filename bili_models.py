@@ -0,0 +1,90 @@
+import os
+import sys
+from dataclasses import dataclass
+from datetime import datetime
+
+from bili_dates import SHANGHAI, format_rfc822, parse_date
+
+# 各类型动态的详情页地址，{}为动态id/专栏cv号/视频bvid
+DYNAMIC_URLS = {
+    'DYNAMIC_TYPE_DRAW': 'https://www.bilibili.com/opus/{}',
+    'DYNAMIC_TYPE_WORD': 'https://www.bilibili.com/opus/{}',
+    'DYNAMIC_TYPE_AV': 'https://www.bilibili.com/video/{}',
+    'DYNAMIC_TYPE_ARTICLE': 'https://www.bilibili.com/read/cv{}',
+}
+PLAYER_URL = 'https://player.bilibili.com/player.html?aid=&bvid={}&cid=&p=1&as_wide=1&high_quality=1&danmaku=0&t=0'
+
+
+# 拿到图片后缀，确定附件的解析方式(可能多余)
+def get_mime_type(url):
+    # 分析图片后缀
+    _, ext = os.path.splitext(url)
+    mime_types = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png', '.gif': 'image/gif',
+                  '.bmp': 'image/bmp', '.webp': 'image/webp'}
+    return mime_types.get(ext.lower(), 'application/octet-stream')
+
+
+# 一条动态，解析时生成一次，之后写库、生成rss都直接使用
+# id: 图文/纯文本为动态id，专栏为cv号，视频为bvid；text: 视频为简介；pics: 视频为封面
+# pub_ts为发布时间戳，没有时间戳时使用原始的时间time(字符串或数据库里的date)；up_uid为up主的uid，旧数据里可能没有
+@dataclass(frozen=True, slots=True)
+class Dynamic:
+    up_name: str
+    type: str
+    id: str
+    url: str
+    title: str
+    text: str
+    pics: tuple
+    pub_ts: int | None = None
+    time: object = None
+    up_uid: str | None = None
+
+    # 由爬取到的各字段生成，up主名和类型在大量动态之间共用同一个字符串
+    @classmethod
+    def create(cls, up_name, type, id, title, text, pics=(), pub_ts=None, time=None, up_uid=None):
+        return cls(sys.intern(up_name), sys.intern(type), id, DYNAMIC_URLS[type].format(id), title, text,
+                   tuple(pics), pub_ts, time, sys.intern(str(up_uid)) if up_uid else None)
+
+    # 由数据库里的一行生成，id取自detail_url的最后一段；有pub_ts列(带时区的发布时间)时优先使用
+    @classmethod
+    def from_row(cls, row):
+        url = row['detail_url']
+        data_id = url.rstrip('/').rsplit('/', 1)[-1].removeprefix('cv')
+        published = row.get('pub_ts')
+        up_uid = row.get('up_uid')
+        return cls(sys.intern(row['up_name']), sys.intern(row['type']), data_id, url, row['title'], row['text'],
+                   tuple(row['pics'] or ()), int(published.timestamp()) if published else None, row['time'],
+                   sys.intern(up_uid) if up_uid else None)
+
+    # 带时区的发布时间，优先使用时间戳；now为同一批动态共用的当前时间，用于解析"n小时前"这类相对时间
+    def published_at(self, now=None):
+        if self.pub_ts:
+            return datetime.fromtimestamp(self.pub_ts, SHANGHAI)
+        return parse_date(self.time, now)
+
+    # 数据表的一行 (up_name, detail_url, title, time, text, pics, type, up_uid, pub_ts)
+    # time为北京时间的日期，pub_ts为带时区的发布时间
+    def to_row(self, now=None):
+        published = self.published_at(now)
+        return (self.up_name, self.url, self.title, published.date(), self.text, list(self.pics), self.type,
+                self.up_uid, published)
+
+    # rss条目的各字段；media为bili_media.MediaProxy时图片使用代理地址，附件带真实的大小和类型
+    def to_entry(self, now=None, media=None):
+        pics = self.pics if media is None else [media.url(pic) for pic in self.pics]
+        if self.type == 'DYNAMIC_TYPE_AV':
+            # 使用 iframe 嵌入视频播放器，再附上封面图片
+            description = (f'{self.text}<br><iframe width="560" height="315" src="{PLAYER_URL.format(self.id)}"'
+                           f' frameborder="0" allowfullscreen></iframe>')
+            description += ''.join(f'<br><img src="{pic}">' for pic in pics[:1])
+            enclosures = []
+        else:
+            # 在 description 中嵌入图片，并添加图片附件
+            description = self.text + ''.join(f'<br><img src="{pic}">' for pic in pics)
+            if media is None:
+                enclosures = [(pic, 0, get_mime_type(pic)) for pic in self.pics]
+            else:
+                enclosures = [media.enclosure(pic) for pic in self.pics]
+        return {'id': self.url, 'title': self.title, 'link': self.url, 'description': description,
+                'enclosures': enclosures, 'pubDate': format_rfc822(self.published_at(now))}
@@ -0,0 +1,158 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+
+import psycopg2.extras
+import psycopg2.sql
+
+from bili_dates import parse_date
+from bili_filter import FILTER_STATE_TABLE
+from bili_requests_functions import get_row_entry, parse_and_format_date
+from bili_rss import RSS_TAIL, render_channel, render_item
+
+DYNAMIC_TYPES = ('DYNAMIC_TYPE_DRAW', 'DYNAMIC_TYPE_WORD', 'DYNAMIC_TYPE_AV', 'DYNAMIC_TYPE_ARTICLE')
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+
+# 把请求参数整理成规范的查询条件，同样的条件不论参数顺序都得到同一个缓存键
+# args为werkzeug的MultiDict，参数不合法时抛出ValueError；up为up主名，uid为up主的uid
+def normalize_query(args):
+    types = tuple(sorted(set(args.getlist('type'))))
+    for data_type in types:
+        if data_type not in DYNAMIC_TYPES:
+            raise ValueError(f'不支持的动态类型: {data_type}')
+    since = args.get('since')
+    if since:
+        since = date.fromisoformat(since)
+    limit = int(args.get('limit', DEFAULT_LIMIT))
+    if not 0 < limit <= MAX_LIMIT:
+        raise ValueError(f'limit需要在1到{MAX_LIMIT}之间')
+    uids = tuple(sorted(set(args.getlist('uid'))))
+    for uid in uids:
+        if not uid.isdigit():
+            raise ValueError(f'uid需要是数字: {uid}')
+    return {
+        'ups': tuple(sorted(set(args.getlist('up')))),
+        'types': types,
+        'tags': tuple(sorted(set(args.getlist('tag')))),
+        'since': since,
+        'limit': limit,
+        'uids': uids,
+    }
+
+
+def query_cache_key(query):
+    return tuple(query[key] for key in ('ups', 'types', 'tags', 'since', 'limit', 'uids'))
+
+
+# 动态查询用到的索引，在DynamicsWriter.ensure_schema里与ensure_uid_columns(按uid、类型和时间读取用的索引)一起建立
+def ensure_query_indexes(cursor, table_data, table_filtered):
+    # NULL排在前面的旧索引与查询的排序不一致
+    cursor.execute(psycopg2.sql.SQL('DROP INDEX IF EXISTS {index}').format(
+        index=psycopg2.sql.Identifier(f'{table_data}_up_name_pub_ts_idx')))
+    indexes = [
+        (table_data, f'{table_data}_up_name_pub_ts_nl_idx', psycopg2.sql.SQL('(up_name, pub_ts DESC NULLS LAST)')),
+        (table_data, f'{table_data}_up_name_seq_idx', psycopg2.sql.SQL('(up_name, seq)')),
+        (table_data, f'{table_data}_up_uid_seq_idx', psycopg2.sql.SQL('(up_uid, seq)')),
+        (table_filtered, f'{table_filtered}_tags_idx', psycopg2.sql.SQL('USING GIN (tags)')),
+    ]
+    for table, index, columns in indexes:
+        cursor.execute(psycopg2.sql.SQL('CREATE INDEX IF NOT EXISTS {index} ON {table} {columns}').format(
+            index=psycopg2.sql.Identifier(index), table=psycopg2.sql.Identifier(table), columns=columns))
+
+
+# 查询结果的版本：按标签查询时为筛选进度，否则为匹配up主的最大seq
+# 有新数据写入(或重新筛选)后版本变化，缓存随之失效
+def query_version(cursor, query, table_data, table_filtered):
+    if query['tags']:
+        cursor.execute(psycopg2.sql.SQL('SELECT last_seq FROM {state_table} WHERE table_filtered = %s').format(
+            state_table=psycopg2.sql.Identifier(FILTER_STATE_TABLE)), (table_filtered,))
+    elif query['uids']:
+        cursor.execute(psycopg2.sql.SQL('SELECT max(seq) FROM {table_data} WHERE up_uid = ANY(%s)').format(
+            table_data=psycopg2.sql.Identifier(table_data)), (list(query['uids']),))
+    elif query['ups']:
+        cursor.execute(psycopg2.sql.SQL('SELECT max(seq) FROM {table_data} WHERE up_name = ANY(%s)').format(
+            table_data=psycopg2.sql.Identifier(table_data)), (list(query['ups']),))
+    else:
+        cursor.execute(psycopg2.sql.SQL('SELECT max(seq) FROM {table_data}').format(
+            table_data=psycopg2.sql.Identifier(table_data)))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+# 只读取需要的行和列：按标签查询筛选表，否则查询数据表
+# 按pub_ts倒序(没有发布时间的行在最后)，单个up主/类型的最新limit条沿(up_uid, pub_ts)/(type, pub_ts)索引读取，不需要排序整张表
+def query_rows(connect, query, table_data, table_filtered):
+    conditions = []
+    params = []
+    if query['tags']:
+        table = table_filtered
+        conditions.append(psycopg2.sql.SQL('tags && %s'))
+        params.append(list(query['tags']))
+    else:
+        table = table_data
+    if query['ups']:
+        conditions.append(psycopg2.sql.SQL('up_name = ANY(%s)'))
+        params.append(list(query['ups']))
+    if query['uids']:
+        conditions.append(psycopg2.sql.SQL('up_uid = ANY(%s)'))
+        params.append(list(query['uids']))
+    if query['types']:
+        conditions.append(psycopg2.sql.SQL('type = ANY(%s)'))
+        params.append(list(query['types']))
+    if query['since']:
+        conditions.append(psycopg2.sql.SQL('pub_ts >= %s'))
+        params.append(parse_date(query['since']))
+    where = psycopg2.sql.SQL('WHERE ') + psycopg2.sql.SQL(' AND ').join(conditions) if conditions \
+        else psycopg2.sql.SQL('')
+    sql = psycopg2.sql.SQL('''
+        SELECT up_name, detail_url, title, time, text, pics, type, up_uid, pub_ts
+        FROM {table}
+        {where}
+        ORDER BY pub_ts DESC NULLS LAST, detail_url
+        LIMIT %s
+    ''').format(table=psycopg2.sql.Identifier(table), where=where)
+    with connect.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+        cursor.execute(sql, params + [query['limit']])
+        return cursor.fetchall()
+
+
+# 把查询结果渲染为rss
+def render_query_feed(rows, query, media=None):
+    description = '、'.join(query['ups'] + tuple(f'uid{uid}' for uid in query['uids']) + query['tags']) or '全部'
+    parts = [render_channel('B站动态查询', 'https://bilibili.com', f'{description}的B站动态',
+                            parse_and_format_date())]
+    parts.extend(render_item(get_row_entry(row, media)) for row in rows)
+    parts.append(RSS_TAIL)
+    return ''.join(parts).encode('utf-8')
+
+
+# 按查询条件缓存渲染好的rss，超过ttl秒或版本变化时失效，超过max_entries条时淘汰最久未使用的
+class QueryCache:
+    def __init__(self, max_entries=256, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry['version'] != version or entry['expires_at'] <= time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry['value']
+
+    def put(self, key, version, value):
+        with self.lock:
+            self.entries[key] = {'version': version, 'value': value, 'expires_at': time.monotonic() + self.ttl}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
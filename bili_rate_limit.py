@@ -0,0 +1,111 @@
+import asyncio
+import threading
+import time
+
+# 各接口默认的 (每秒请求数, 突发容量)
+# 专栏接口最容易触发风控，原先是每个专栏sleep(15)，这里默认每5秒一个、允许3个突发
+DEFAULT_RATE_LIMITS = {
+    'space': (5.0, 5),
+    'article': (0.2, 3),
+}
+# 风控时速率降到的下限
+MIN_RATE = 0.02
+
+
+# 被风控(HTTP 412 或 code -352/-412)且重试后仍未恢复
+class ThrottledError(Exception):
+    pass
+
+
+# 判断一次响应是否被风控
+def is_throttled(status_code, payload=None):
+    if status_code == 412:
+        return True
+    return isinstance(payload, dict) and payload.get('code') in (-352, -412)
+
+
+# 令牌桶，线程安全，支持同步和异步获取
+# 令牌不足时预约未来的令牌(tokens可为负)，等待者按先来后到依次放行
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # 预约一个令牌，返回需要等待的秒数
+    def reserve(self):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    # 不预约，只返回现在取令牌需要等待的秒数
+    def wait_time(self):
+        with self.lock:
+            tokens = min(self.capacity, self.tokens + (time.monotonic() - self.updated) * self.rate)
+            return 0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    async def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def acquire_sync(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    # 被风控：速率减半并清空存量令牌(乘性减)
+    def on_throttle(self):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = max(MIN_RATE, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    # 请求成功：速率逐步恢复到配置值(加性增)
+    def on_success(self):
+        if self.rate >= self.base_rate:
+            return
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = min(self.base_rate, self.rate + self.base_rate / 10)
+
+
+# 按接口区分的限流器，limits形如 {'article': (rate, capacity)}，未配置的接口使用默认值
+class RateLimiter:
+    def __init__(self, limits=None):
+        self.limits = dict(DEFAULT_RATE_LIMITS)
+        if limits:
+            self.limits.update(limits)
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, endpoint):
+        with self.lock:
+            if endpoint not in self.buckets:
+                rate, capacity = self.limits.get(endpoint, self.limits['space'])
+                self.buckets[endpoint] = TokenBucket(rate, capacity)
+            return self.buckets[endpoint]
+
+    async def acquire(self, endpoint):
+        await self.bucket(endpoint).acquire()
+
+    def acquire_sync(self, endpoint):
+        self.bucket(endpoint).acquire_sync()
+
+    # 根据响应结果调整速率
+    def report(self, endpoint, throttled):
+        if throttled:
+            self.bucket(endpoint).on_throttle()
+            print(f'{endpoint}接口触发风控，当前速率{self.bucket(endpoint).rate:.3f}/s')
+        else:
+            self.bucket(endpoint).on_success()
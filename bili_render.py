@@ -0,0 +1,43 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from bili_metrics import FEEDS, RENDER_SECONDS
+from bili_requests_functions import load_rss
+
+
+# 在子进程中依次生成一组up主的rss，返回 [(up_uid, 新增条目数, 耗时)]
+# 子进程里记录的指标不会回到主进程，耗时由render_feeds在主进程中记录
+def render_chunk(chunk, max_entries=100, fast=False, media=None):
+    results = []
+    for up_uid, dynamics in chunk:
+        start = time.perf_counter()
+        new_entries = load_rss(dynamics, up_uid, max_entries, fast, media)
+        results.append((up_uid, new_entries, time.perf_counter() - start))
+    return results
+
+
+def _record(results, new_entries):
+    for up_uid, count, seconds in results:
+        RENDER_SECONDS.observe(seconds, feed='up')
+        FEEDS.inc(feed='up', result='written' if count else 'unchanged')
+        new_entries[up_uid] = count
+
+
+# 用进程池并行生成每个up主的rss，up_dynamics为 {up_uid: Dynamic列表}，没有动态的up主跳过
+# 每chunk_size个up主作为一个任务，workers为进程数(默认为CPU核数)，为1时在当前进程中生成
+# media为bili_media.MediaProxy时图片使用代理地址，每个进程各自打开图片缓存；返回 {up_uid: 新增条目数}
+def render_feeds(up_dynamics, workers=None, chunk_size=16, max_entries=100, fast=False, media=None):
+    items = [(up_uid, dynamics) for up_uid, dynamics in up_dynamics.items() if dynamics]
+    chunks = [items[n:n + chunk_size] for n in range(0, len(items), chunk_size)]
+    workers = min(workers or os.cpu_count() or 1, len(chunks))
+    new_entries = {}
+    if workers <= 1:
+        for chunk in chunks:
+            _record(render_chunk(chunk, max_entries, fast, media), new_entries)
+        return new_entries
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(render_chunk, chunk, max_entries, fast, media) for chunk in chunks]
+        for future in futures:
+            _record(future.result(), new_entries)
+    return new_entries
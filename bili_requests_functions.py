@@ -1,268 +1,276 @@
 import os
-import re
 import time
-from datetime import datetime, timedelta
+from datetime import datetime
 
-import psycopg2
-import psycopg2.extras
-import psycopg2.sql
-import pytz
-import requests
-from fake_useragent import UserAgent
-from feedgen.entry import FeedEntry
-from feedgen.feed import FeedGenerator
+from bili_feed_files import (get_feed_guids, hash_entries, load_feed_hash, merge_feed, save_feed_hash,
+                             write_file_atomic)
+from bili_credentials import random_user_agent
+from bili_dates import SHANGHAI, format_rfc822, now_shanghai, parse_date
+from bili_http_cache import article_cache_key
+from bili_metrics import (DB_ROWS, DYNAMICS_PARSED, FEEDS, FILTER_ROWS, FILTER_SECONDS, HTTP_REQUEST_SECONDS,
+                          HTTP_REQUESTS, RENDER_SECONDS)
+from bili_models import Dynamic, get_mime_type
+from bili_rss import RSS_TAIL, render_channel, render_item
+from bili_rate_limit import RateLimiter, ThrottledError, is_throttled
 
+# psycopg2、requests、feedgen只在用到它们的函数里导入，只爬取或只生成rss时不需要加载数据库驱动和feedgen
 
-# 日期转化(适用于rss)
-def parse_and_format_date(date_str=None):
-    if date_str:
-        # 处理不同格式的日期字符串
-        if isinstance(date_str, int):
-            # 默认是时间戳
-            dt = datetime.fromtimestamp(date_str)
-        elif re.match(r'^\d{4}-\d{2}-\d{2}$', date_str):
-            # 格式: "2024-03-25"
-            input_format = '%Y-%m-%d'
-            dt = datetime.strptime(date_str, input_format)
-        elif re.match(r'^\d{4}年\d{2}月\d{2}日$', date_str):
-            # 格式: "2024年03月25日"
-            input_format = '%Y年%m月%d日'
-            dt = datetime.strptime(date_str, input_format)
-        elif re.match(r'^\d{2}月\d{2}日$', date_str):
-            # 格式: "03月25日"
-            current_year = datetime.now(pytz.timezone('Asia/Shanghai')).year
-            date_str = f"{current_year}年{date_str}"
-            input_format = '%Y年%m月%d日'
-            dt = datetime.strptime(date_str, input_format)
-        elif re.match(r'^\d+分钟前$', date_str):
-            # 格式: "n分钟前"
-            minutes = int(re.search(r'\d+', date_str).group())
-            dt = datetime.now(pytz.timezone('Asia/Shanghai')) - timedelta(minutes=minutes)
-        elif re.match(r'^\d+小时前$', date_str):
-            # 格式: "n小时前"
-            hours = int(re.search(r'\d+', date_str).group())
-            dt = datetime.now(pytz.timezone('Asia/Shanghai')) - timedelta(hours=hours)
-        elif re.match(r'^\d+天前$', date_str):
-            # 格式: "n天前"
-            days = int(re.search(r'\d+', date_str).group())
-            dt = datetime.now(pytz.timezone('Asia/Shanghai')) - timedelta(days=days)
-        elif re.match(r'^昨天\s+\d{2}:\d{2}$', date_str):
-            # 格式: "昨天 20:34"
-            # time_part = re.search(r'\d{2}:\d{2}', date_str).group()
-            # current_year = datetime.now(pytz.timezone('Asia/Shanghai')).year
-            # current_month = datetime.now(pytz.timezone('Asia/Shanghai')).month
-            # current_day = datetime.now(pytz.timezone('Asia/Shanghai')).day
-            # yesterday = datetime(current_year, current_month, current_day, 0, 0, 0, tzinfo=pytz.timezone('Asia/Shanghai')) - timedelta(days=1)
-            # input_format = '%Y-%m-%d %H:%M'
-            # dt = datetime.strptime(f"{yesterday.strftime('%Y-%m-%d')} {time_part}", input_format)
-            dt = datetime.now(pytz.timezone('Asia/Shanghai')) - timedelta(days=1)
-        else:
-            raise ValueError(f"无法解析的日期格式: {date_str}")
-    else:
-        # 直接获取当前时间（用于 lastBuildDate）
-        dt = datetime.now(pytz.timezone('Asia/Shanghai'))  # 北京时间
 
-    # 转换为 UTC 时间并格式化
-    dt_utc = dt.astimezone(pytz.utc)
-    return dt_utc.strftime('%a, %d %b %Y %H:%M:%S %z')
+# 日期转化(适用于rss)，解析见bili_dates.parse_date，不传参数时为当前时间
+def parse_and_format_date(date_str=None, now=None):
+    if date_str:
+        return format_rfc822(parse_date(date_str, now))
+    # 直接获取当前时间（用于 lastBuildDate）
+    return format_rfc822(now or now_shanghai())
 
 
-# 日期转化(在parse_and_format_date基础上，适用于sql里的date)
-def load_and_format_date(strf_time):
-    # 解析日期字符串为 datetime 对象
+# 日期转化(适用于sql里的date)，同时接受parse_and_format_date的输出
+def load_and_format_date(strf_time, now=None):
     try:
         # 尝试解析为 '%a, %d %b %Y %H:%M:%S %z' 格式
-        dt = datetime.strptime(strf_time, '%a, %d %b %Y %H:%M:%S %z')
-    except ValueError:
+        dt = datetime.strptime(strf_time, '%a, %d %b %Y %H:%M:%S %z').astimezone(SHANGHAI)
+    except (TypeError, ValueError):
         # 如果解析失败，尝试解析为其他格式
-        dt = parse_and_format_date(strf_time)
+        dt = parse_date(strf_time, now)
 
-    # 转换为 PostgreSQL 的 DATE 格式
+    # 转换为 PostgreSQL 的 DATE 格式(北京时间)
     return dt.date()
 
 
-# 拿到图片后缀，确定附件的解析方式(可能多余)
-def get_mime_type(url):
-    # 分析图片后缀
-    _, ext = os.path.splitext(url)
-    mime_types = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png', '.gif': 'image/gif',
-                  '.bmp': 'image/bmp', '.webp': 'image/webp'}
-    return mime_types.get(ext.lower(), 'application/octet-stream')
+# 接口地址，可替换为本地的测试服务
+API_BASE = 'https://api.bilibili.com'
+# 顺序爬取时共用的限流器
+rate_limiter = RateLimiter()
+# features可能因人而异
+SPACE_FEATURES = 'itemOpusStyle,listOnlyfans,opusBigCover,onlyfansVote,forwardListHidden,decorationCard,commentsNewVersion,onlyfansAssetsV2,ugcDelete,onlyfansQaCard'
+
+
+# 动态列表的请求地址
+def get_space_items_url(up_uid, offset='', api_base=API_BASE):
+    space_items_url = f'{api_base}/x/polymer/web-dynamic/v1/feed/space?offset={offset}&host_mid={up_uid}'
+    space_items_url = space_items_url + f'&features={SPACE_FEATURES}&timezone_offset=-480&platform=web'
+    space_items_url = space_items_url + '&x-bili-device-req-json={"platform":"web","device":"pc"}'
+    return space_items_url
 
 
-# 获取如函数名所示的各项数据的字典的列表
-def get_name_id_title_time_text_pics_list(up_uid, user_cookie):
-    # features可能因人而异
-    features = 'itemOpusStyle,listOnlyfans,opusBigCover,onlyfansVote,forwardListHidden,decorationCard,commentsNewVersion,onlyfansAssetsV2,ugcDelete,onlyfansQaCard'
+# 动态列表的请求头
+def get_space_headers(up_uid, user_cookie, user_agent=None):
     origin_url = 'https://space.bilibili.com'
     space_dynamic_url = f'https://space.bilibili.com/{up_uid}/dynamic'
-    space_items_url = f'https://api.bilibili.com/x/polymer/web-dynamic/v1/feed/space?offset=&host_mid={up_uid}'
-    space_items_url = space_items_url + f'&features={features}&timezone_offset=-480&platform=web'
-    space_items_url = space_items_url + '&x-bili-device-req-json={"platform":"web","device":"pc"}'
+    # 设置User-Agent
+    if user_agent is None:
+        user_agent = random_user_agent()
+    return {'User-Agent': user_agent, 'Referer': space_dynamic_url, 'Origin': origin_url, 'Cookie': user_cookie}
+
 
+# 专栏详情的请求地址
+def get_article_detail_url(data_id, api_base=API_BASE):
+    return f'{api_base}/x/article/view?id={data_id}&gaia_source=main_web'
+
+
+# 专栏详情的请求头
+def get_article_headers(data_id, user_cookie, user_agent=None):
+    article_origin_url = 'https://www.bilibili.com'
+    article_dynamic_url = f'https://www.bilibili.com/read/cv{data_id}/'
     # 设置User-Agent
-    user_agent = UserAgent().random
-    headers = {'User-Agent': user_agent, 'Referer': space_dynamic_url, 'Origin': origin_url, 'Cookie': user_cookie}
-    response = requests.get(space_items_url, headers=headers)
-    data = response.json()
-    up_name = data['data']['items'][0]['modules']['module_author']['name']
+    if user_agent is None:
+        user_agent = random_user_agent()
+    return {'User-Agent': user_agent, 'Referer': article_dynamic_url, 'Origin': article_origin_url,
+            'Cookie': user_cookie}
+
+
+# 解析单条动态为Dynamic，专栏需要重新请求详情，返回None交由parse_article_content处理
+# up_uid为None时取动态作者的mid
+def parse_dynamic_item(item, up_name, up_uid=None):
+    data_type = item['type']
+    data_time = item['modules']['module_author']['pub_time']
+    data_pub_ts = item['modules']['module_author'].get('pub_ts')
+    up_uid = up_uid or item['modules']['module_author'].get('mid')
+    # 处理图文以及纯文本
+    if data_type == 'DYNAMIC_TYPE_DRAW' or data_type == 'DYNAMIC_TYPE_WORD':
+        opus = item['modules']['module_dynamic']['major']['opus']
+        DYNAMICS_PARSED.inc(type=data_type)
+        print('获取了一条图文动态')
+        return Dynamic.create(up_name, data_type, item['id_str'], opus['title'], opus['summary']['text'],
+                              [pic['url'] for pic in opus['pics']], data_pub_ts, data_time, up_uid)
+    # 处理视频，简介作为正文，封面作为图片
+    elif data_type == 'DYNAMIC_TYPE_AV':
+        archive = item['modules']['module_dynamic']['major']['archive']
+        DYNAMICS_PARSED.inc(type=data_type)
+        print('获取了一条视频动态')
+        return Dynamic.create(up_name, data_type, archive['bvid'], archive['title'], archive['desc'],
+                              [archive['cover']], data_pub_ts, data_time, up_uid)
+    return None
+
+
+# 解析专栏详情接口返回的json为Dynamic
+def parse_article_content(up_name, data_id, data_type, content, up_uid=None):
+    content_title = content['data']['title']
+    content_time = content['data']['publish_time']
+    # 当专栏中有图片时
+    if 'opus' in content['data']:
+        content_text = ''
+        content_pics = []
+        for item in content['data']['opus']['content']['paragraphs']:
+            if item['para_type'] == 1:
+                content_text += item['text']['nodes'][0]['word']['words']
+            if item['para_type'] == 2:
+                content_pics.append(item['pic']['pics'][0]['url'])
+    # 纯文本专栏
+    else:
+        content_text = content['data']['content']
+        content_pics = []
+    DYNAMICS_PARSED.inc(type=data_type)
+    return Dynamic.create(up_name, data_type, data_id, content_title, content_text, content_pics, content_time,
+                          content_time, up_uid)
+
+
+# 经过响应缓存(bili_http_cache.ResponseCache)和限流的GET请求，被风控时降速重试，cache为None时不缓存
+def get_json(url, headers, endpoint, cache=None, cache_key=None, max_retries=3):
+    import requests
+    entry = None
+    if cache is not None:
+        cache_key = cache_key or url
+        entry = cache.lookup(cache_key)
+        if entry is not None and entry['fresh']:
+            HTTP_REQUESTS.inc(endpoint=endpoint, result='cached')
+            return entry['payload']
+        headers = cache.conditional_headers(entry, headers)
+    for _ in range(max_retries + 1):
+        rate_limiter.acquire_sync(endpoint)
+        try:
+            with HTTP_REQUEST_SECONDS.time(endpoint=endpoint):
+                response = requests.get(url, headers=headers)
+            payload = None if response.status_code in (304, 412) else response.json()
+        except Exception:
+            HTTP_REQUESTS.inc(endpoint=endpoint, result='error')
+            raise
+        if response.status_code == 304 and entry is not None:
+            HTTP_REQUESTS.inc(endpoint=endpoint, result='not_modified')
+            cache.refresh(cache_key, endpoint)
+            return entry['payload']
+        throttled = is_throttled(response.status_code, payload)
+        HTTP_REQUESTS.inc(endpoint=endpoint, result='throttled' if throttled else 'ok')
+        rate_limiter.report(endpoint, throttled)
+        if not throttled:
+            if cache is not None and payload.get('code') == 0:
+                cache.store(cache_key, endpoint, payload, response.headers.get('ETag'),
+                            response.headers.get('Last-Modified'))
+            return payload
+    raise ThrottledError(f'{url} 多次触发风控')
+
+
+# 获取一个up主的动态(Dynamic)列表
+def get_name_id_title_time_text_pics_list(up_uid, user_cookie, response_cache=None):
+    headers = get_space_headers(up_uid, user_cookie)
+    data = get_json(get_space_items_url(up_uid), headers, 'space', response_cache)
+    items = (data.get('data') or {}).get('items') or []
+    # 没有动态的up主
+    if not items:
+        return []
+    up_name = items[0]['modules']['module_author']['name']
     name_id_title_time_text_pics_type_list = []
-    for item in data['data']['items']:
+    for item in items:
         data_type = item['type']
-        # 处理图文以及纯文本
-        if data_type == 'DYNAMIC_TYPE_DRAW' or data_type == 'DYNAMIC_TYPE_WORD':
-            data_id = item['id_str']
-            data_title = item['modules']['module_dynamic']['major']['opus']['title']
-            data_time = item['modules']['module_author']['pub_time']
-            data_text = item['modules']['module_dynamic']['major']['opus']['summary']['text']
-            data_pics = item['modules']['module_dynamic']['major']['opus']['pics']
-            name_id_title_time_text_pics_type_list.append(
-                {'name': up_name, 'id': data_id, 'title': data_title, 'time': data_time, 'text': data_text,
-                 'pics': data_pics, 'type': data_type})
-            print('获取了一条图文动态')
-        # 处理视频
-        elif data_type == 'DYNAMIC_TYPE_AV':
-            data_title = item['modules']['module_dynamic']['major']['archive']['title']
-            data_time = item['modules']['module_author']['pub_time']
-            data_bvid = item['modules']['module_dynamic']['major']['archive']['bvid']
-            data_desc = item['modules']['module_dynamic']['major']['archive']['desc']
-            data_pic = item['modules']['module_dynamic']['major']['archive']['cover']
-            name_id_title_time_text_pics_type_list.append(
-                {'name': up_name, 'title': data_title, 'time': data_time, 'bvid': data_bvid, 'desc': data_desc,
-                 'pic': data_pic, 'type': data_type})
-            print('获取了一条视频动态')
         # 处理专栏
-        elif data_type == 'DYNAMIC_TYPE_ARTICLE':
+        if data_type == 'DYNAMIC_TYPE_ARTICLE':
             data_id = item['basic']['rid_str']
-            # 专栏板块需要重新请求
-            # 设置User-Agent
-            user_agent = UserAgent().random
-            article_origin_url = 'https://www.bilibili.com'
-            article_dynamic_url = f'https://www.bilibili.com/read/cv{data_id}/'
-            headers = {'User-Agent': user_agent, 'Referer': article_dynamic_url, 'Origin': article_origin_url,
-                       'Cookie': user_cookie}
-            article_detail_url = f'https://api.bilibili.com/x/article/view?id={data_id}&gaia_source=main_web'
-            response = requests.get(article_detail_url, headers=headers)
-            content = response.json()
-            content_title = content['data']['title']
-            content_time = content['data']['publish_time']
-            # 当专栏中有图片时
-            if 'opus' in content['data']:
-                content_text = ''
-                content_pics = []
-                for item in content['data']['opus']['content']['paragraphs']:
-                    if item['para_type'] == 1:
-                        content_text += item['text']['nodes'][0]['word']['words']
-                    if item['para_type'] == 2:
-                        content_pics.append(item['pic']['pics'][0]['url'])
-
-                name_id_title_time_text_pics_type_list.append(
-                    {'name': up_name, 'id': data_id, 'title': content_title, 'time': content_time, 'text': content_text,
-                     'pics': content_pics, 'type': data_type})  # 这里的pics只需要按顺序取出就行了，里面是字符串不是字典
-            # 纯文本专栏
-            else:
-                content_text = content['data']['content']
-                content_pics = []
-                name_id_title_time_text_pics_type_list.append(
-                    {'name': up_name, 'id': data_id, 'title': content_title, 'time': content_time, 'text': content_text,
-                     'pics': content_pics, 'type': data_type})
-            time.sleep(15)
-            print('获取了一个专栏动态\nsleeping···')
+            # 专栏板块需要重新请求，经令牌桶限流，被风控时降速重试
+            headers = get_article_headers(data_id, user_cookie)
+            content = get_json(get_article_detail_url(data_id), headers, 'article', response_cache,
+                               article_cache_key(data_id))
+            name_id_title_time_text_pics_type_list.append(parse_article_content(up_name, data_id, data_type, content,
+                                                                                up_uid))
+            print('获取了一个专栏动态')
+        # 处理图文、纯文本以及视频
+        else:
+            dynamic = parse_dynamic_item(item, up_name, up_uid)
+            if dynamic is not None:
+                name_id_title_time_text_pics_type_list.append(dynamic)
     return name_id_title_time_text_pics_type_list
 
 
 # 生成rss
-def load_rss(name_id_title_time_text_pics_list, up_uid):
-    # 初始化 RSS 生成器
-    fg = FeedGenerator()
-    fg.id(f'https://space.bilibili.com/{up_uid}')
-    fg.title(f'{name_id_title_time_text_pics_list[0]['name']}的B站动态')
-    fg.link(href=f'https://space.bilibili.com/{up_uid}')
-    fg.description(f'{name_id_title_time_text_pics_list[0]['name']}的B站动态')
-    fg.lastBuildDate(parse_and_format_date())
-
-    # 遍历动态数据
-    for item in name_id_title_time_text_pics_list:
-        # 图文或纯文本动态
-        if item['type'] == 'DYNAMIC_TYPE_DRAW' or item['type'] == 'DYNAMIC_TYPE_WORD':
-            entry = FeedEntry()
-            entry.id(f"https://www.bilibili.com/opus/{item['id']}")
-            entry.title(item['title'])
-            entry.link(href=f"https://www.bilibili.com/opus/{item['id']}")
-
-            # 在 description 中嵌入图片
-            description = item['text']
-            for pic in item['pics']:
-                description += f'<br><img src="{pic["url"]}">'
-            entry.description(description)
-
-            # 添加图片附件（保留 enclosure）
-            for pic in item['pics']:
-                entry.enclosure(pic['url'], 0, get_mime_type(pic['url']))
-
-            # 设置发布时间
-            entry.pubDate(parse_and_format_date(item['time']))
-
-            # 添加到 RSS
-            fg.add_entry(entry)
-        # 视频动态
-        elif item['type'] == 'DYNAMIC_TYPE_AV':
-            entry = FeedEntry()
-            entry.id(f"https://www.bilibili.com/video/{item['bvid']}")
-            entry.title(item['title'])
-            entry.link(href=f"https://www.bilibili.com/video/{item['bvid']}")
-
-            # 使用 iframe 嵌入视频播放器
-            player_url = f"https://player.bilibili.com/player.html?aid=&bvid={item['bvid']}&cid=&p=1&as_wide=1&high_quality=1&danmaku=0&t=0"
-            description = item['desc']
-            description += f'<br><iframe width="560" height="315" src="{player_url}" frameborder="0" allowfullscreen></iframe>'
-
-            # 获取封面图片链接
-            cover_image_url = item['pic']
-            description += f'<br><img src="{cover_image_url}">'
-
-            entry.description(description)
-
-            entry.pubDate(parse_and_format_date(item['time']))
-            fg.add_entry(entry)
-
-
-        # 专栏动态
-        elif item['type'] == 'DYNAMIC_TYPE_ARTICLE':
-            entry = FeedEntry()
-            entry.id(f"https://www.bilibili.com/read/cv{item['id']}")
-            entry.title(item['title'])
-            entry.link(href=f"https://www.bilibili.com/read/cv{item['id']}")
-
-            # 在 description 中嵌入图片
-            description = item['text']
-            for pic in item['pics']:
-                description += f'<br><img src="{pic}">'
-            entry.description(description)
-
-            # 添加图片附件（保留 enclosure）
-            for pic in item['pics']:
-                entry.enclosure(pic, 0, get_mime_type(pic))
-
-            # 设置发布时间
-            entry.pubDate(parse_and_format_date(item['time']))
-
-            # 添加到 RSS
-            fg.add_entry(entry)
-
+# 只把不在已有文件中的新条目合并进去，内容没有变化时不重建也不写文件，每个feed最多保留max_entries条
+# fast为True时不经过feedgen直接拼接xml，输出与feedgen相同；media见Dynamic.to_entry；返回新增的条目数
+def load_rss(name_id_title_time_text_pics_list, up_uid, max_entries=100, fast=False, media=None):
     # 确保输出目录存在
     output_dir = 'xml_files'
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
+    rss_output_path = os.path.join(output_dir, f'{up_uid}.xml')
+
+    now = now_shanghai()
+    # 哈希用不经过图片代理的条目计算，图片下载失败不会改变哈希；只给要写入的新条目下载图片
+    entries_hash = hash_entries([dynamic.to_entry(now) for dynamic in name_id_title_time_text_pics_list])
+    if entries_hash == load_feed_hash(rss_output_path):
+        print(f'{rss_output_path} 内容没有变化，跳过生成')
+        return 0
+    known_guids = get_feed_guids(rss_output_path)
+    new_entries = [dynamic.to_entry(now, media) for dynamic in name_id_title_time_text_pics_list
+                   if dynamic.url not in known_guids]
+    if not new_entries:
+        save_feed_hash(rss_output_path, entries_hash)
+        print(f'{rss_output_path} 没有新条目，跳过生成')
+        return 0
+
+    up_name = name_id_title_time_text_pics_list[0].up_name
+    rss_str = render_feed(f'https://space.bilibili.com/{up_uid}', f'{up_name}的B站动态', f'{up_name}的B站动态',
+                          format_rfc822(now), new_entries, fast)
 
     # 写入 RSS 到文件
-    rss_output_path = os.path.join(output_dir, f'{up_uid}.xml')
-    fg.rss_file(rss_output_path, pretty=True)  # 使用 rss_file 方法
-    print(f'RSS文件已输出到 {rss_output_path}')
+    write_file_atomic(rss_output_path, merge_feed(rss_output_path, rss_str, max_entries))
+    save_feed_hash(rss_output_path, entries_hash)
+    print(f'RSS文件已输出到 {rss_output_path}，新增{len(new_entries)}条')
+    return len(new_entries)
+
+
+# 由条目字段生成整个rss，返回bytes
+def render_feed(link, title, description, last_build_date, entries, fast=False):
+    if fast:
+        # 与feedgen相同，后添加的条目在前
+        parts = [render_channel(title, link, description, last_build_date)]
+        parts.extend(render_item(entry) for entry in reversed(entries))
+        parts.append(RSS_TAIL)
+        return ''.join(parts).encode('utf-8')
+    from feedgen.feed import FeedGenerator
+    # 初始化 RSS 生成器
+    fg = FeedGenerator()
+    fg.id(link)
+    fg.title(title)
+    fg.link(href=link)
+    fg.description(description)
+    fg.lastBuildDate(last_build_date)
+
+    # 添加到 RSS
+    for entry in entries:
+        fg.add_entry(get_feed_entry(entry))
+    return fg.rss_str(pretty=True)
+
+
+# 由数据库里的一行生成rss条目的各字段
+def get_row_entry(item, media=None):
+    return Dynamic.from_row(item).to_entry(media=media)
+
+
+# 由条目字段生成FeedEntry
+def get_feed_entry(fields):
+    from feedgen.entry import FeedEntry
+    entry = FeedEntry()
+    entry.id(fields['id'])
+    entry.title(fields['title'])
+    entry.link(href=fields['link'])
+    entry.description(fields['description'])
+    for url, length, mime_type in fields['enclosures']:
+        entry.enclosure(url, length, mime_type)
+    entry.pubDate(fields['pubDate'])
+    return entry
 
 
 # 生成rss(因为数据库里忘记放uid了，只好更新该函数)
-def reload_rss(name_id_title_time_text_pics_list):
+def reload_rss(name_id_title_time_text_pics_list, media=None):
+    from feedgen.feed import FeedGenerator
+    start = time.perf_counter()
     # 初始化 RSS 生成器
     fg = FeedGenerator()
     fg.id(f'https://bilibili.com')
@@ -272,91 +280,31 @@ def reload_rss(name_id_title_time_text_pics_list):
     fg.lastBuildDate(parse_and_format_date())
 
     # 遍历动态数据
-    for item in name_id_title_time_text_pics_list:
-        # 图文或纯文本动态
-        if item['type'] == 'DYNAMIC_TYPE_DRAW' or item['type'] == 'DYNAMIC_TYPE_WORD':
-            entry = FeedEntry()
-            entry.id(item['detail_url'])
-            entry.title(item['title'])
-            entry.link(href=item['detail_url'])
-
-            # 在 description 中嵌入图片
-            description = item['text']
-            for pic in item['pics']:
-                description += f'<br><img src="{pic}">'
-            entry.description(description)
-
-            # 添加图片附件（保留 enclosure）
-            for pic in item['pics']:
-                entry.enclosure(pic, 0, get_mime_type(pic))
-
-            # 设置发布时间
-            entry.pubDate(parse_and_format_date(str(item['time'])))
-
-            # 添加到 RSS
-            fg.add_entry(entry)
-        # 视频动态
-        elif item['type'] == 'DYNAMIC_TYPE_AV':
-            entry = FeedEntry()
-            entry.id(item['detail_url'])
-            entry.title(item['title'])
-            entry.link(href=item['detail_url'])
-
-            # 使用正则表达式匹配 bvid= 之后的内容
-            pattern = r"bvid=([^&]+)"
-            match = re.search(pattern, item['detail_url'])
-            bvid = match.group(1)
-            # 使用 iframe 嵌入视频播放器
-            player_url = f"https://player.bilibili.com/player.html?aid=&bvid={bvid}&cid=&p=1&as_wide=1&high_quality=1&danmaku=0&t=0"
-            description = item['desc']
-            description += f'<br><iframe width="560" height="315" src="{player_url}" frameborder="0" allowfullscreen></iframe>'
-
-            # 获取封面图片链接
-            cover_image_url = item['pics'][0]
-            description += f'<br><img src="{cover_image_url}">'
-
-            entry.description(description)
-
-            entry.pubDate(parse_and_format_date(str(item['time'])))
-            fg.add_entry(entry)
-
-
-        # 专栏动态
-        elif item['type'] == 'DYNAMIC_TYPE_ARTICLE':
-            entry = FeedEntry()
-            entry.id(item['detail_url'])
-            entry.title(item['title'])
-            entry.link(href=item['detail_url'])
-
-            # 在 description 中嵌入图片
-            description = item['text']
-            for pic in item['pics']:
-                description += f'<br><img src="{pic}">'
-            entry.description(description)
-
-            # 添加图片附件（保留 enclosure）
-            for pic in item['pics']:
-                entry.enclosure(pic, 0, get_mime_type(pic))
-
-            # 设置发布时间
-            entry.pubDate(parse_and_format_date(str(item['time'])))
-
-            # 添加到 RSS
-            fg.add_entry(entry)
-
-    # 确保输出目录存在
-    output_dir = 'xml_files'
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    items = [item for item in name_id_title_time_text_pics_list
+             if item['type'] in ('DYNAMIC_TYPE_DRAW', 'DYNAMIC_TYPE_WORD', 'DYNAMIC_TYPE_AV', 'DYNAMIC_TYPE_ARTICLE')]
+    rss_output_path = os.path.join('xml_files', 'filtered.xml')
+    # 与load_rss相同，哈希不经过图片代理，内容有变化时才下载图片
+    entries_hash = hash_entries([get_row_entry(item) for item in items])
+    if entries_hash == load_feed_hash(rss_output_path):
+        FEEDS.inc(feed='filtered', result='unchanged')
+        print(f'{rss_output_path} 内容没有变化，跳过生成')
+        return
+    for item in items:
+        # 添加到 RSS
+        fg.add_entry(get_feed_entry(get_row_entry(item, media)))
 
     # 写入 RSS 到文件
-    rss_output_path = os.path.join(output_dir, 'filtered.xml')
-    fg.rss_file(rss_output_path, pretty=True)  # 使用 rss_file 方法
+    write_file_atomic(rss_output_path, fg.rss_str(pretty=True))
+    save_feed_hash(rss_output_path, entries_hash)
+    RENDER_SECONDS.observe(time.perf_counter() - start, feed='filtered')
+    FEEDS.inc(feed='filtered', result='written')
     print(f'RSS文件已输出到 {rss_output_path}')
 
 
 # 获取组成RSS所需数据
 def fetch_all_data(database, user, password, host, port, table):
+    import psycopg2.extras
+    import psycopg2.sql
     # 连接到数据库
     connect = psycopg2.connect(database=database, user=user, password=password, host=host, port=port)
     cursor = connect.cursor(cursor_factory=psycopg2.extras.DictCursor)
@@ -370,25 +318,111 @@ def fetch_all_data(database, user, password, host, port, table):
     dict_list = [dict(row) for row in rows]
     cursor.close()
     connect.close()
-    print('数据库字典获取成功')
-    print(dict_list)
+    print(f'数据库字典获取成功，共{len(dict_list)}条')
     return dict_list
 
 
+# 建表语句，数据表的seq按插入顺序递增，供增量筛选使用；pub_ts为带时区的发布时间，time为其北京时间的日期
+# 为psycopg2.sql.SQL的模板，使用时包装后format表名
+CREATE_TABLE_DATA_SQL = '''CREATE TABLE IF NOT EXISTS {table_data} (
+    up_name CHARACTER VARYING,
+    detail_url CHARACTER VARYING PRIMARY KEY,
+    title TEXT,
+    time DATE,
+    text TEXT,
+    pics TEXT[],
+    type CHARACTER VARYING,
+    seq BIGSERIAL,
+    up_uid CHARACTER VARYING,
+    pub_ts TIMESTAMPTZ
+);'''
+CREATE_TABLE_TAGS_SQL = '''CREATE TABLE IF NOT EXISTS {table_tags} (
+    tag CHARACTER VARYING PRIMARY KEY
+);'''
+CREATE_TABLE_FILTERED_SQL = '''CREATE TABLE IF NOT EXISTS {table_filtered} (
+    up_name CHARACTER VARYING,
+    detail_url CHARACTER VARYING PRIMARY KEY,
+    title TEXT,
+    time DATE,
+    text TEXT,
+    pics TEXT[],
+    type CHARACTER VARYING,
+    tags TEXT[],
+    up_uid CHARACTER VARYING,
+    pub_ts TIMESTAMPTZ
+);'''
+# 按up主、按类型读取最新动态用的索引，(索引名后缀, 列)
+# 与查询的ORDER BY pub_ts DESC NULLS LAST一致，没有发布时间的旧行排在最后
+UID_INDEXES = (
+    ('up_uid_pub_ts_nl_idx', '(up_uid, pub_ts DESC NULLS LAST)'),
+    ('type_pub_ts_nl_idx', '(type, pub_ts DESC NULLS LAST)'),
+    ('pub_ts_nl_idx', '(pub_ts DESC NULLS LAST)'),
+)
+# NULL排在前面的旧索引，与查询的排序不一致，建表时删除
+OLD_UID_INDEXES = ('up_uid_pub_ts_idx', 'type_pub_ts_idx', 'pub_ts_idx')
+
+
+# 给旧的数据表/筛选表补上up_uid和pub_ts列及其索引，返回是否补上了列(旧数据需要回填)
+def ensure_uid_columns(cursor, table):
+    import psycopg2.sql
+    cursor.execute('''SELECT count(*) FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND column_name IN ('up_uid', 'pub_ts')''',
+                   (table,))
+    added = cursor.fetchone()[0] < 2
+    cursor.execute(psycopg2.sql.SQL('''ALTER TABLE {table}
+        ADD COLUMN IF NOT EXISTS up_uid CHARACTER VARYING,
+        ADD COLUMN IF NOT EXISTS pub_ts TIMESTAMPTZ''').format(table=psycopg2.sql.Identifier(table)))
+    for suffix in OLD_UID_INDEXES:
+        cursor.execute(psycopg2.sql.SQL('DROP INDEX IF EXISTS {index}').format(
+            index=psycopg2.sql.Identifier(f'{table}_{suffix}')))
+    for suffix, columns in UID_INDEXES:
+        cursor.execute(psycopg2.sql.SQL('CREATE INDEX IF NOT EXISTS {index} ON {table} {columns}').format(
+            index=psycopg2.sql.Identifier(f'{table}_{suffix}'), table=psycopg2.sql.Identifier(table),
+            columns=psycopg2.sql.SQL(columns)))
+    return added
+
+
+# 回填旧数据，返回回填的行数：pub_ts取time当天0点(北京时间)；up_uid取同名up主在新数据里的uid
+# (写入新动态之后用migrate子命令再执行一次即可补上)；筛选表按detail_url从数据表回填
+def backfill_uid_columns(cursor, table_data, table_filtered=None):
+    import psycopg2.sql
+    table_data = psycopg2.sql.Identifier(table_data)
+    cursor.execute(psycopg2.sql.SQL('''
+        UPDATE {table_data} SET pub_ts = time::timestamp AT TIME ZONE 'Asia/Shanghai'
+        WHERE pub_ts IS NULL AND time IS NOT NULL
+    ''').format(table_data=table_data))
+    backfilled = cursor.rowcount
+    cursor.execute(psycopg2.sql.SQL('''
+        UPDATE {table_data} AS d SET up_uid = u.up_uid
+        FROM (
+            SELECT DISTINCT ON (up_name) up_name, up_uid
+            FROM {table_data}
+            WHERE up_uid IS NOT NULL
+            ORDER BY up_name, pub_ts DESC NULLS LAST
+        ) AS u
+        WHERE d.up_uid IS NULL AND d.up_name = u.up_name
+    ''').format(table_data=table_data))
+    backfilled += cursor.rowcount
+    if table_filtered:
+        cursor.execute(psycopg2.sql.SQL('''
+            UPDATE {table_filtered} AS f
+            SET up_uid = COALESCE(f.up_uid, d.up_uid), pub_ts = COALESCE(f.pub_ts, d.pub_ts)
+            FROM {table_data} AS d
+            WHERE f.detail_url = d.detail_url
+                AND (f.up_uid IS NULL AND d.up_uid IS NOT NULL OR f.pub_ts IS NULL AND d.pub_ts IS NOT NULL)
+        ''').format(table_filtered=psycopg2.sql.Identifier(table_filtered), table_data=table_data))
+        backfilled += cursor.rowcount
+    return backfilled
+
+
 # 建表
 def create_table_data(database, user, password, host, port, table_data):
+    import psycopg2.sql
     connect = psycopg2.connect(database=database, user=user, password=password, host=host, port=port)
     cursor = connect.cursor()
-    sql = psycopg2.sql.SQL('''CREATE TABLE IF NOT EXISTS {table_data} (
-        up_name CHARACTER VARYING, 
-        detail_url CHARACTER VARYING PRIMARY KEY,
-        title TEXT,
-        time DATE,
-        text TEXT,
-        pics TEXT[],
-        type CHARACTER VARYING
-    );''').format(table_data=psycopg2.sql.Identifier(table_data))
+    sql = psycopg2.sql.SQL(CREATE_TABLE_DATA_SQL).format(table_data=psycopg2.sql.Identifier(table_data))
     cursor.execute(sql)
+    ensure_uid_columns(cursor, table_data)
     connect.commit()
     cursor.close()
     connect.close()
@@ -396,11 +430,10 @@ def create_table_data(database, user, password, host, port, table_data):
 
 
 def create_table_tags(database, user, password, host, port, table_tags):
+    import psycopg2.sql
     connect = psycopg2.connect(database=database, user=user, password=password, host=host, port=port)
     cursor = connect.cursor()
-    sql = psycopg2.sql.SQL('''CREATE TABLE IF NOT EXISTS {table_tags} (
-        tag CHARACTER VARYING  PRIMARY KEY
-    );''').format(table_tags=psycopg2.sql.Identifier(table_tags))
+    sql = psycopg2.sql.SQL(CREATE_TABLE_TAGS_SQL).format(table_tags=psycopg2.sql.Identifier(table_tags))
     cursor.execute(sql)
     connect.commit()
     cursor.close()
@@ -409,21 +442,13 @@ def create_table_tags(database, user, password, host, port, table_tags):
 
 
 def create_table_filtered(database, user, password, host, port, table_filtered):
+    import psycopg2.sql
     connect = psycopg2.connect(database=database, user=user, password=password, host=host, port=port)
     cursor = connect.cursor()
-    sql = psycopg2.sql.SQL("""
-        CREATE TABLE IF NOT EXISTS {table_filtered} (
-            up_name CHARACTER VARYING, 
-            detail_url CHARACTER VARYING PRIMARY KEY,
-            title TEXT,
-            time DATE,
-            text TEXT,
-            pics TEXT[],
-            type CHARACTER VARYING,
-            tags TEXT[]
-        );
-    """).format(table_filtered=psycopg2.sql.Identifier(table_filtered))
+    sql = psycopg2.sql.SQL(CREATE_TABLE_FILTERED_SQL).format(
+        table_filtered=psycopg2.sql.Identifier(table_filtered))
     cursor.execute(sql)
+    ensure_uid_columns(cursor, table_filtered)
     connect.commit()
     cursor.close()
     connect.close()
@@ -432,46 +457,20 @@ def create_table_filtered(database, user, password, host, port, table_filtered):
 
 # 写数据
 def write_bili_dynamics_table(name_id_title_time_text_pics_type_list):
+    import psycopg2
+    from bili_filter import lock_seq_shared
     connect = psycopg2.connect(database='reouo', user='postgres', password='12345', host='127.0.0.1', port='5432')
     cursor = connect.cursor()
+    lock_seq_shared(cursor, 'bili_dynamics')
     insert_sql = '''
-            INSERT INTO bili_dynamics (up_name, detail_url, title, time, text, pics, type)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            INSERT INTO bili_dynamics (up_name, detail_url, title, time, text, pics, type, up_uid, pub_ts)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
             ON CONFLICT (detail_url) DO NOTHING;
             '''
-    for item in name_id_title_time_text_pics_type_list:
-        if item['type'] == 'DYNAMIC_TYPE_DRAW' or item['type'] == 'DYNAMIC_TYPE_WORD':
-            up_name = item['name']
-            detail_url = f'https://www.bilibili.com/opus/{item['id']}'
-            title = item['title']
-            time = load_and_format_date(parse_and_format_date(item['time']))
-            text = item['text']
-            pics = []
-            for pic in item['pics']:
-                pics.append(pic['url'])
-            type = item['type']
-            cursor.execute(insert_sql, (up_name, detail_url, title, time, text, pics, type))
-        elif item['type'] == 'DYNAMIC_TYPE_AV':
-            up_name = item['name']
-            detail_url = f'https://www.bilibili.com/video/{item['bvid']}'
-            title = item['title']
-            time = load_and_format_date(parse_and_format_date(item['time']))
-            text = item['desc']
-            pics = []
-            pics.append(item['pic'])
-            type = item['type']
-            cursor.execute(insert_sql, (up_name, detail_url, title, time, text, pics, type))
-        elif item['type'] == 'DYNAMIC_TYPE_ARTICLE':
-            up_name = item['name']
-            detail_url = f'https://www.bilibili.com/read/cv{item['id']}'
-            title = item['title']
-            time = load_and_format_date(parse_and_format_date(item['time']))
-            text = item['text']
-            pics = []
-            for pic in item['pics']:
-                pics.append(pic)
-            type = item['type']
-            cursor.execute(insert_sql, (up_name, detail_url, title, time, text, pics, type))
+    now = now_shanghai()
+    for dynamic in name_id_title_time_text_pics_type_list:
+        cursor.execute(insert_sql, dynamic.to_row(now))
+        DB_ROWS.inc(result='inserted' if cursor.rowcount else 'conflicted')
     connect.commit()
     cursor.close()
     connect.close()
@@ -479,15 +478,21 @@ def write_bili_dynamics_table(name_id_title_time_text_pics_type_list):
 
 
 def filter_data(database, user, password, host, port, table_data, table_tags, table_filtered):
+    import psycopg2.extras
+    import psycopg2.sql
+    start = time.perf_counter()
     connect = psycopg2.connect(database=database, user=user, password=password, host=host, port=port)
     cursor = connect.cursor()
+    ensure_uid_columns(cursor, table_data)
+    ensure_uid_columns(cursor, table_filtered)
 
     # SQL 查询，用于匹配 tags 表中的 tag 与 bili_dynamics 表中的 text 和 title，并获取匹配的 tag
     sql = psycopg2.sql.SQL("""
-        SELECT bd.up_name, bd.detail_url, bd.title, bd.time, bd.text, bd.pics, bd.type, array_agg(t.tag) AS tags
+        SELECT bd.up_name, bd.detail_url, bd.title, bd.time, bd.text, bd.pics, bd.type, bd.up_uid, bd.pub_ts,
+            array_agg(t.tag) AS tags
         FROM {table_data} bd
         JOIN {table_tags} t ON bd.text LIKE '%' || t.tag || '%' OR bd.title LIKE '%' || t.tag || '%'
-        GROUP BY bd.up_name, bd.detail_url, bd.title, bd.time, bd.text, bd.pics, bd.type
+        GROUP BY bd.up_name, bd.detail_url, bd.title, bd.time, bd.text, bd.pics, bd.type, bd.up_uid, bd.pub_ts
     """).format(table_data=psycopg2.sql.Identifier(table_data), table_tags=psycopg2.sql.Identifier(table_tags))
 
     cursor.execute(sql)
@@ -495,8 +500,8 @@ def filter_data(database, user, password, host, port, table_data, table_tags, ta
 
     # 批量插入筛选结果到新表，使用 ON CONFLICT DO UPDATE 来处理重复键
     insert_sql = psycopg2.sql.SQL("""
-        INSERT INTO {table_filtered} (up_name, detail_url, title, time, text, pics, type, tags)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        INSERT INTO {table_filtered} (up_name, detail_url, title, time, text, pics, type, up_uid, pub_ts, tags)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
         ON CONFLICT (detail_url) DO UPDATE SET
             up_name = EXCLUDED.up_name,
             title = EXCLUDED.title,
@@ -504,6 +509,8 @@ def filter_data(database, user, password, host, port, table_data, table_tags, ta
             text = EXCLUDED.text,
             pics = EXCLUDED.pics,
             type = EXCLUDED.type,
+            up_uid = EXCLUDED.up_uid,
+            pub_ts = EXCLUDED.pub_ts,
             tags = EXCLUDED.tags;
     """).format(table_filtered=psycopg2.sql.Identifier(table_filtered))
 
@@ -513,10 +520,13 @@ def filter_data(database, user, password, host, port, table_data, table_tags, ta
     connect.commit()
     cursor.close()
     connect.close()
+    FILTER_SECONDS.observe(time.perf_counter() - start, mode='full')
+    FILTER_ROWS.inc(len(results), result='matched')
     print('筛选数据已插入到新表')
 
 
 def clean_table(database, user, password, host, port, table):
+    import psycopg2.sql
     try:
         connect = psycopg2.connect(database=database, user=user, password=password, host=host, port=port)
     except:
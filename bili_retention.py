@@ -0,0 +1,250 @@
+import gzip
+import json
+import os
+from datetime import date, datetime, timedelta
+
+from bili_dates import SHANGHAI, now_shanghai
+from bili_filter import ensure_filter_schema
+from bili_metrics import ARCHIVED_ROWS
+from bili_requests_functions import backfill_uid_columns, ensure_uid_columns
+
+# 冷数据归档：超过保留期的行按发布月份写入 archive/<表名>/<YYYY-MM>.<归档时间>.jsonl.gz，然后从表里删除
+# 每次归档都写新文件；文件写完并fsync之后才提交删除，中途失败时表里的数据不变，最多产生重复的归档行
+ARCHIVE_DIR = 'archive'
+
+# 按月分区的数据表(psycopg2.sql.SQL的模板)，pub_ts不能为空；分区表的唯一约束必须包含分区键，主键为(detail_url, pub_ts)
+CREATE_TABLE_DATA_PARTITIONED_SQL = '''CREATE TABLE IF NOT EXISTS {table_data} (
+    up_name CHARACTER VARYING,
+    detail_url CHARACTER VARYING,
+    title TEXT,
+    time DATE,
+    text TEXT,
+    pics TEXT[],
+    type CHARACTER VARYING,
+    seq BIGSERIAL,
+    up_uid CHARACTER VARYING,
+    pub_ts TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (detail_url, pub_ts)
+) PARTITION BY RANGE (pub_ts);'''
+# pub_ts可能由"n小时前"这类相对时间推算，同一条动态每次爬取的pub_ts不一定相同，不能只靠分区表的主键去重；
+# 另建不分区的 <数据表>_urls 记录写入过的detail_url，写入数据表前先插入这张表，只写入其中新增的detail_url
+# 归档时不删除这里的记录，已归档的动态再次爬到时也不会重新写入；普通表和SQLite(见SqliteStorage)也同样去重
+CREATE_TABLE_URLS_SQL = '''CREATE TABLE IF NOT EXISTS {table_urls} (
+    detail_url CHARACTER VARYING PRIMARY KEY
+);'''
+
+
+def urls_table(table_data):
+    return f'{table_data}_urls'
+
+
+# 建立数据表的detail_url表，新建时从数据表导入已有的detail_url
+def ensure_urls_table(cursor, table_data):
+    import psycopg2.sql
+    table_urls = urls_table(table_data)
+    cursor.execute('SELECT to_regclass(%s)', (psycopg2.sql.Identifier(table_urls).as_string(cursor),))
+    if cursor.fetchone()[0] is not None:
+        return
+    cursor.execute(psycopg2.sql.SQL(CREATE_TABLE_URLS_SQL).format(table_urls=psycopg2.sql.Identifier(table_urls)))
+    cursor.execute(psycopg2.sql.SQL('''
+        INSERT INTO {table_urls} (detail_url) SELECT detail_url FROM {table_data} ON CONFLICT DO NOTHING
+    ''').format(table_urls=psycopg2.sql.Identifier(table_urls), table_data=psycopg2.sql.Identifier(table_data)))
+
+
+# 保留期的起点(北京时间当天0点)，pub_ts早于它的行被归档
+def retention_cutoff(retention_days, now=None):
+    now = now or now_shanghai()
+    return (now - timedelta(days=retention_days)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+# 所在月份的第一天0点(北京时间)
+def month_start(dt):
+    return dt.astimezone(SHANGHAI).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(dt):
+    return (dt + timedelta(days=32)).replace(day=1)
+
+
+def partition_name(table, month):
+    return f'{table}_p{month:%Y%m}'
+
+
+def _json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f'无法序列化的类型: {type(value).__name__}')
+
+
+# 一张表一次归档的输出，每个月份一个gzip文件，写完之前使用临时文件名
+class ArchiveWriter:
+    def __init__(self, table, directory=ARCHIVE_DIR):
+        self.directory = os.path.join(directory, table)
+        self.run = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+        self.files = {}
+        self.count = 0
+
+    # row为字段字典，按pub_ts所在月份分文件
+    def write(self, row):
+        month = f'{row["pub_ts"].astimezone(SHANGHAI):%Y-%m}' if row.get('pub_ts') else 'unknown'
+        files = self.files.get(month)
+        if files is None:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f'{month}.{self.run}.jsonl.gz')
+            raw = open(f'{path}.tmp', 'wb')
+            files = self.files[month] = (path, raw, gzip.GzipFile(filename='', mode='wb', fileobj=raw))
+        line = json.dumps(dict(row), ensure_ascii=False, default=_json_default) + '\n'
+        files[2].write(line.encode('utf-8'))
+        self.count += 1
+
+    # 写完后fsync并换成正式文件名，返回写入的文件
+    def close(self):
+        paths = []
+        for path, raw, gz in self.files.values():
+            gz.close()
+            raw.flush()
+            os.fsync(raw.fileno())
+            raw.close()
+            os.replace(f'{path}.tmp', path)
+            paths.append(path)
+        self.files = {}
+        return paths
+
+    # 归档失败时删除临时文件
+    def discard(self):
+        for path, raw, gz in self.files.values():
+            gz.close()
+            raw.close()
+            os.remove(f'{path}.tmp')
+        self.files = {}
+
+
+# 为months中的每个月建立分区(已存在时跳过)
+def ensure_partitions(cursor, table, months):
+    import psycopg2.sql
+    for month in months:
+        cursor.execute(psycopg2.sql.SQL('''
+            CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)
+        ''').format(partition=psycopg2.sql.Identifier(partition_name(table, month)),
+                    table=psycopg2.sql.Identifier(table)), (month, next_month(month)))
+
+
+def is_partitioned(cursor, table):
+    import psycopg2.sql
+    cursor.execute('SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)',
+                   (psycopg2.sql.Identifier(table).as_string(cursor),))
+    return cursor.fetchone() is not None
+
+
+# 分区表的各个分区 {月份: 分区名}，只识别按partition_name命名的分区
+def list_partitions(cursor, table):
+    import psycopg2.sql
+    cursor.execute('''
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+    ''', (psycopg2.sql.Identifier(table).as_string(cursor),))
+    partitions = {}
+    prefix = f'{table}_p'
+    for name, in cursor.fetchall():
+        suffix = name[len(prefix):]
+        if name.startswith(prefix) and len(suffix) == 6 and suffix.isdigit():
+            partitions[datetime(int(suffix[:4]), int(suffix[4:]), 1, tzinfo=SHANGHAI)] = name
+    return partitions
+
+
+# 把已有的普通数据表转为按月分区的表，seq保持不变(增量筛选和全文索引的进度仍然有效)
+# 在一个事务里完成：旧表改名，建分区表和所需的分区，复制数据后删除旧表；没有pub_ts的行按time回填
+def convert_to_partitioned(connect, table_data):
+    import psycopg2.sql
+    old_table = f'{table_data}_unpartitioned'
+    with connect.cursor() as cursor:
+        ensure_filter_schema(cursor, table_data)
+        # 刚补上up_uid/pub_ts列的旧表先回填，转换后ensure_schema看到的是已有这两列的新表
+        if ensure_uid_columns(cursor, table_data):
+            backfill_uid_columns(cursor, table_data)
+        cursor.execute(psycopg2.sql.SQL('ALTER TABLE {table} RENAME TO {old_table}').format(
+            table=psycopg2.sql.Identifier(table_data), old_table=psycopg2.sql.Identifier(old_table)))
+        # 主键约束的名字在新表里还要用
+        cursor.execute(psycopg2.sql.SQL('ALTER TABLE {old_table} RENAME CONSTRAINT {pkey} TO {old_pkey}').format(
+            old_table=psycopg2.sql.Identifier(old_table), pkey=psycopg2.sql.Identifier(f'{table_data}_pkey'),
+            old_pkey=psycopg2.sql.Identifier(f'{old_table}_pkey')))
+        cursor.execute(psycopg2.sql.SQL(CREATE_TABLE_DATA_PARTITIONED_SQL).format(
+            table_data=psycopg2.sql.Identifier(table_data)))
+        pub_ts = psycopg2.sql.SQL("COALESCE(pub_ts, time::timestamp AT TIME ZONE 'Asia/Shanghai', now())")
+        cursor.execute(psycopg2.sql.SQL('SELECT DISTINCT {pub_ts} FROM {old_table}').format(
+            pub_ts=psycopg2.sql.SQL("date_trunc('month', {pub_ts}, 'Asia/Shanghai')").format(pub_ts=pub_ts),
+            old_table=psycopg2.sql.Identifier(old_table)))
+        ensure_partitions(cursor, table_data, sorted(month_start(row[0]) for row in cursor.fetchall()))
+        cursor.execute(psycopg2.sql.SQL('''
+            INSERT INTO {table} (up_name, detail_url, title, time, text, pics, type, seq, up_uid, pub_ts)
+            SELECT up_name, detail_url, title, time, text, pics, type, seq, up_uid, {pub_ts}
+            FROM {old_table}
+        ''').format(table=psycopg2.sql.Identifier(table_data), pub_ts=pub_ts,
+                    old_table=psycopg2.sql.Identifier(old_table)))
+        moved = cursor.rowcount
+        cursor.execute(psycopg2.sql.SQL('''
+            SELECT setval(pg_get_serial_sequence(%s, 'seq'), GREATEST(COALESCE(MAX(seq), 0), 1)) FROM {table}
+        ''').format(table=psycopg2.sql.Identifier(table_data)),
+            (psycopg2.sql.Identifier(table_data).as_string(cursor),))
+        cursor.execute(psycopg2.sql.SQL('DROP TABLE {old_table}').format(old_table=psycopg2.sql.Identifier(old_table)))
+        # 旧表的索引随旧表删除，在新表上重建
+        ensure_filter_schema(cursor, table_data)
+        ensure_uid_columns(cursor, table_data)
+    connect.commit()
+    print(f'{table_data} 已转为按月分区，共{moved}行')
+    return moved
+
+
+# 把table里pub_ts早于cutoff的行归档后移出，返回归档的行数；connect为psycopg2连接
+# 分区表整月归档后直接删除分区(cutoff向前取整到月初，没有逐行删除的开销)，普通表按detail_url分批删除
+def archive_table(connect, table, cutoff, directory=ARCHIVE_DIR, batch_size=5000):
+    import psycopg2.sql
+    with connect.cursor() as cursor:
+        partitioned = is_partitioned(cursor, table)
+        partitions = list_partitions(cursor, table) if partitioned else {}
+    writer = ArchiveWriter(table, directory)
+    try:
+        if partitioned:
+            expired = [name for month, name in sorted(partitions.items()) if next_month(month) <= cutoff]
+            for name in expired:
+                _archive_rows(connect, writer, name, None, batch_size)
+            with connect.cursor() as cursor:
+                for name in expired:
+                    cursor.execute(psycopg2.sql.SQL('DROP TABLE {partition}').format(
+                        partition=psycopg2.sql.Identifier(name)))
+        else:
+            _archive_rows(connect, writer, table, cutoff, batch_size, delete=True)
+        paths = writer.close()
+        connect.commit()
+    except BaseException:
+        connect.rollback()
+        writer.discard()
+        raise
+    ARCHIVED_ROWS.inc(writer.count, table=table)
+    if writer.count:
+        print(f'{table} 归档了{writer.count}行到 {", ".join(paths)}')
+    return writer.count
+
+
+# 服务端游标读出要归档的行，cutoff为None时读出整张表；delete为True时每批写入后按detail_url删除
+def _archive_rows(connect, writer, table, cutoff, batch_size, delete=False):
+    import psycopg2.extras
+    import psycopg2.sql
+    where = psycopg2.sql.SQL('WHERE pub_ts < %s') if cutoff is not None else psycopg2.sql.SQL('')
+    reader = connect.cursor(name=f'{table}_archive_reader', cursor_factory=psycopg2.extras.RealDictCursor)
+    reader.itersize = batch_size
+    reader.execute(psycopg2.sql.SQL('SELECT * FROM {table} {where} ORDER BY pub_ts').format(
+        table=psycopg2.sql.Identifier(table), where=where), (cutoff,) if cutoff is not None else None)
+    try:
+        with connect.cursor() as cursor:
+            while True:
+                rows = reader.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    writer.write(row)
+                if delete:
+                    cursor.execute(psycopg2.sql.SQL('DELETE FROM {table} WHERE detail_url = ANY(%s)').format(
+                        table=psycopg2.sql.Identifier(table)), ([row['detail_url'] for row in rows],))
+    finally:
+        reader.close()
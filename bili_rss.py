@@ -0,0 +1,130 @@
+import hashlib
+import os
+import re
+import time
+
+from bili_dates import format_rfc822, now_shanghai
+from bili_feed_files import AtomicFile, hash_entries, load_feed_hash, save_feed_hash
+from bili_metrics import FEEDS, RENDER_SECONDS
+from bili_models import Dynamic
+
+# 与feedgen输出一致的频道固定字段
+RSS_DOCS = 'http://www.rssboard.org/rss-specification'
+RSS_GENERATOR = 'python-feedgen'
+RSS_HEAD = ("<?xml version='1.0' encoding='UTF-8'?>\n"
+            '<rss xmlns:atom="http://www.w3.org/2005/Atom" xmlns:content="http://purl.org/rss/1.0/modules/content/"'
+            ' version="2.0">\n'
+            '  <channel>\n')
+RSS_TAIL = '  </channel>\n</rss>\n'
+
+# XML 1.0不允许的控制字符，直接去掉
+_INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+
+# 转义方式与lxml序列化一致
+def escape_text(value):
+    value = _INVALID_XML_CHARS.sub('', str(value))
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('\r', '&#13;')
+
+
+def escape_attr(value):
+    value = escape_text(value).replace('"', '&quot;')
+    return value.replace('\n', '&#10;').replace('\t', '&#9;')
+
+
+# 频道头部，写在所有条目之前
+def render_channel(title, link, description, last_build_date):
+    return (f'{RSS_HEAD}'
+            f'    <title>{escape_text(title)}</title>\n'
+            f'    <link>{escape_text(link)}</link>\n'
+            f'    <description>{escape_text(description)}</description>\n'
+            f'    <docs>{RSS_DOCS}</docs>\n'
+            f'    <generator>{RSS_GENERATOR}</generator>\n'
+            f'    <lastBuildDate>{escape_text(last_build_date)}</lastBuildDate>\n')
+
+
+# 单个条目，字段见Dynamic.to_entry；与feedgen相同，空字段不输出，附件只保留最后一个
+def render_item(entry):
+    parts = ['    <item>\n']
+    if entry['title']:
+        parts.append(f'      <title>{escape_text(entry['title'])}</title>\n')
+    if entry['link']:
+        parts.append(f'      <link>{escape_text(entry['link'])}</link>\n')
+    if entry['description']:
+        parts.append(f'      <description>{escape_text(entry['description'])}</description>\n')
+    if entry['id']:
+        parts.append(f'      <guid isPermaLink="false">{escape_text(entry['id'])}</guid>\n')
+    if entry['enclosures']:
+        url, length, mime_type = entry['enclosures'][-1]
+        parts.append(f'      <enclosure url="{escape_attr(url)}" length="{escape_attr(length)}"'
+                     f' type="{escape_attr(mime_type)}"/>\n')
+    if entry['pubDate']:
+        parts.append(f'      <pubDate>{escape_text(entry['pubDate'])}</pubDate>\n')
+    parts.append('    </item>\n')
+    return ''.join(parts)
+
+
+# 逐条写入rss，entries可以是生成器，不需要一次性放进内存
+def write_rss_stream(f, title, link, description, entries, last_build_date=None):
+    f.write(render_channel(title, link, description, last_build_date or format_rfc822(now_shanghai())))
+    count = 0
+    for entry in entries:
+        f.write(render_item(entry))
+        count += 1
+    f.write(RSS_TAIL)
+    return count
+
+
+# 流式生成筛选后的rss：服务端游标按时间倒序读取最新的limit条，边读边写，内存占用与表大小无关
+# media见Dynamic.to_entry
+def stream_rss(database, user, password, host, port, table, limit=200, output_name='filtered.xml', itersize=100,
+               title='筛选后的B站动态', link='https://bilibili.com', description='经tags筛选后的的B站动态',
+               media=None):
+    # 只有这里需要数据库，生成rss的其他函数不导入psycopg2
+    import psycopg2.extras
+    import psycopg2.sql
+    connect = psycopg2.connect(database=database, user=user, password=password, host=host, port=port)
+    try:
+        cursor = connect.cursor(name=f'{table}_rss_reader', cursor_factory=psycopg2.extras.RealDictCursor)
+        cursor.itersize = itersize
+        cursor.execute(psycopg2.sql.SQL('''
+            SELECT up_name, detail_url, title, time, text, pics, type, up_uid, pub_ts
+            FROM {table}
+            ORDER BY pub_ts DESC NULLS LAST, detail_url
+            LIMIT %s
+        ''').format(table=psycopg2.sql.Identifier(table)), (limit,))
+        return write_rss_rows(cursor, output_name, title, link, description, media)
+    finally:
+        connect.close()
+
+
+# 把数据库的行逐条写成rss文件，rows可以是游标或生成器；各存储后端(见bili_storage)共用
+def write_rss_rows(rows, output_name='filtered.xml', title='筛选后的B站动态', link='https://bilibili.com',
+                   description='经tags筛选后的的B站动态', media=None):
+    start = time.perf_counter()
+    output_dir = 'xml_files'
+
+    # 先写临时文件，同时计算条目哈希；条目没有变化时丢弃临时文件，否则替换原文件
+    rss_output_path = os.path.join(output_dir, output_name)
+    entries_hash = hashlib.sha256()
+
+    # 与load_rss相同，哈希用不经过图片代理的条目计算，图片下载失败不会改变哈希
+    def hashed_entries():
+        for row in rows:
+            dynamic = Dynamic.from_row(row)
+            entry = dynamic.to_entry()
+            entries_hash.update(hash_entries(entry).encode('ascii'))
+            yield entry if media is None else dynamic.to_entry(media=media)
+
+    with AtomicFile(rss_output_path, 'w', encoding='utf-8', newline='') as output:
+        count = write_rss_stream(output.file, title, link, description, hashed_entries())
+        if entries_hash.hexdigest() == load_feed_hash(rss_output_path):
+            output.discard()
+            FEEDS.inc(feed='filtered', result='unchanged')
+            print(f'{rss_output_path} 内容没有变化，跳过生成')
+            return count
+    save_feed_hash(rss_output_path, entries_hash.hexdigest())
+    RENDER_SECONDS.observe(time.perf_counter() - start, feed='filtered')
+    FEEDS.inc(feed='filtered', result='written')
+    print(f'RSS文件已输出到 {rss_output_path}，共{count}条')
+    return count
@@ -0,0 +1,227 @@
+import asyncio
+import heapq
+import json
+import os
+import queue
+import signal
+import threading
+import time
+
+from bili_crawler import Crawler
+from bili_cursors import CURSORS_PATH, load_cursors, save_cursors
+from bili_filter import filter_data_incremental
+from bili_metrics import write_metrics_file
+from bili_credentials import CredentialPool
+from bili_render import render_feeds
+from bili_requests_functions import API_BASE
+from bili_retention import ARCHIVE_DIR
+from bili_rss import stream_rss
+
+# 每个up主的轮询状态，形如 {up_uid: {'rate': 每秒发帖数, 'interval': 秒, 'last_poll': 时间戳, 'next_due': 时间戳}}
+SCHEDULE_PATH = os.path.join('state', 'schedule.json')
+
+
+def load_schedule(path=SCHEDULE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+# 与save_cursors相同，先写临时文件再替换
+def save_schedule(schedule, path=SCHEDULE_PATH):
+    output_dir = os.path.dirname(path)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(schedule, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+# 常驻的调度进程：按下次到期时间维护up主的优先队列，到期的up主成批并发爬取
+# 每个up主的轮询间隔按观察到的发帖频率调整(期望每次轮询约有一条新动态)，限制在[min_interval, max_interval]之间
+# 爬取结果交给后台线程依次写库、生成rss、筛选，爬取不等待这些步骤完成
+# writer为DynamicsWriter或bili_storage的存储后端，为None时不写库，由调用方关闭；render为True时为每个有新动态的up主生成rss
+# filter_config为数据库参数和表名(database/user/password/host/port/table_data/table_tags/table_filtered)，
+# 提供时写库后每隔filter_interval秒增量筛选一次并流式生成筛选后的rss；filter_storage为存储后端时代替filter_config，
+# 使用该后端筛选和生成rss；media见render_feeds
+# retention_days不为None时(writer需为bili_storage的存储后端)每隔archive_interval秒把超过保留期的行归档到archive_dir
+# 指标写入state/metrics/<metrics_name>.prom，同时运行的多个进程使用不同的名字
+class Scheduler:
+    def __init__(self, up_uids, user_cookie, writer=None, render=False, render_workers=None, fast_render=True,
+                 filter_config=None, filter_interval=600, rss_limit=200, min_interval=300, max_interval=6 * 3600,
+                 batch_size=50, smoothing=0.3, max_concurrency=16, per_host_concurrency=8, api_base=API_BASE,
+                 rate_limits=None, article_workers=4, response_cache=None, cursors_path=CURSORS_PATH,
+                 schedule_path=SCHEDULE_PATH, media=None, filter_storage=None, retention_days=None,
+                 archive_dir=ARCHIVE_DIR, archive_interval=24 * 3600, metrics_name='scheduler'):
+        self.writer = writer
+        self.render = render
+        self.render_workers = render_workers
+        self.fast_render = fast_render
+        self.media = media
+        self.filter_config = filter_config
+        self.filter_storage = filter_storage
+        self.filter_interval = filter_interval
+        self.rss_limit = rss_limit
+        self.retention_days = retention_days
+        self.archive_dir = archive_dir
+        self.archive_interval = archive_interval
+        self.metrics_name = metrics_name
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.batch_size = batch_size
+        self.smoothing = smoothing
+        self.crawler_options = {'max_concurrency': max_concurrency, 'per_host_concurrency': per_host_concurrency,
+                                'api_base': api_base, 'article_workers': article_workers,
+                                'response_cache': response_cache}
+        # cookie池在各批之间共用，保留自适应后的速率和各cookie的冷却状态
+        self.credentials = CredentialPool(user_cookie, rate_limits)
+        self.cursors_path = cursors_path
+        self.schedule_path = schedule_path
+        # cursors随爬取推进；committed_cursors只在后续步骤完成后更新并保存，中途退出时下次重新爬取
+        self.committed_cursors = load_cursors(self.cursors_path)
+        self.cursors = dict(self.committed_cursors)
+        self.schedule = load_schedule(self.schedule_path)
+        now = time.time()
+        self.heap = [(self.schedule.get(up_uid, {}).get('next_due', now), up_uid)
+                     for up_uid in dict.fromkeys(up_uids)]
+        heapq.heapify(self.heap)
+        self.results = queue.Queue(maxsize=4)
+        self.stop_event = threading.Event()
+        self.last_filter = 0.0
+        self.pending_filter = False
+        self.last_archive = None
+
+    def stop(self, *args):
+        self.stop_event.set()
+
+    # 取出已经到期的up主，最多batch_size个
+    def pop_due(self, now):
+        due = []
+        while self.heap and self.heap[0][0] <= now and len(due) < self.batch_size:
+            due.append(heapq.heappop(self.heap)[1])
+        return due
+
+    # 根据本次爬到的新动态数更新发帖频率，返回下次轮询间隔
+    def observe(self, up_uid, dynamics, now):
+        state = self.schedule.setdefault(up_uid, {})
+        last_poll = state.get('last_poll')
+        if last_poll is None:
+            # 首次轮询，按第一页动态的时间跨度估计
+            stamps = [dynamic.pub_ts for dynamic in dynamics if dynamic.pub_ts]
+            rate = (len(stamps) - 1) / max(now - min(stamps), 1) if len(stamps) > 1 else 0.0
+        else:
+            observed = len(dynamics) / max(now - last_poll, 1)
+            rate = (1 - self.smoothing) * state.get('rate', observed) + self.smoothing * observed
+        interval = min(max(1 / rate if rate > 0 else self.max_interval, self.min_interval), self.max_interval)
+        state.update({'rate': rate, 'interval': interval, 'last_poll': now, 'next_due': now + interval})
+        return interval
+
+    # 爬取一批到期的up主，按结果重新排期后交给后台线程
+    def crawl_batch(self, up_uids):
+        crawler = Crawler(None, credentials=self.credentials, cursors=self.cursors, **self.crawler_options)
+        up_dynamics = asyncio.run(crawler.crawl(up_uids))
+        now = time.time()
+        for up_uid in up_uids:
+            if up_uid in up_dynamics:
+                next_due = now + self.observe(up_uid, up_dynamics[up_uid], now)
+            else:
+                # 爬取失败，不更新频率，min_interval秒后重试
+                next_due = now + self.min_interval
+                self.schedule.setdefault(up_uid, {})['next_due'] = next_due
+            heapq.heappush(self.heap, (next_due, up_uid))
+        save_schedule(self.schedule, self.schedule_path)
+        write_metrics_file(self.metrics_name)
+        self.results.put((up_dynamics, {up_uid: self.cursors.get(up_uid) for up_uid in up_dynamics}))
+
+    # 后台线程：写库、生成rss、筛选
+    def process_results(self):
+        while True:
+            try:
+                item = self.results.get(timeout=self.filter_interval)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                self.process_batch(*item)
+            if self.pending_filter and time.monotonic() - self.last_filter >= self.filter_interval:
+                self.run_filter()
+            if self.retention_days is not None and self.writer is not None and (
+                    self.last_archive is None or time.monotonic() - self.last_archive >= self.archive_interval):
+                self.run_archive()
+            write_metrics_file(self.metrics_name)
+        if self.pending_filter:
+            self.run_filter()
+
+    def process_batch(self, up_dynamics, batch_cursors):
+        new_dynamics = {up_uid: dynamics for up_uid, dynamics in up_dynamics.items() if dynamics}
+        try:
+            if self.writer is not None:
+                for dynamics in new_dynamics.values():
+                    self.writer.add(dynamics)
+                # 写入数据库后才保存游标，否则进程退出或写入失败时缓冲区里的动态会丢失
+                self.writer.flush()
+                self.pending_filter = self.pending_filter or bool(
+                    new_dynamics and (self.filter_config or self.filter_storage is not None))
+            if self.render and new_dynamics:
+                render_feeds(new_dynamics, workers=self.render_workers, fast=self.fast_render, media=self.media)
+        except Exception as e:
+            # 回退游标，下次轮询时重新爬取这些动态
+            print(f'处理爬取结果失败: {e!r}')
+            for up_uid in batch_cursors:
+                self.cursors[up_uid] = self.committed_cursors.get(up_uid)
+            return
+        self.committed_cursors.update(batch_cursors)
+        save_cursors(self.committed_cursors, self.cursors_path)
+
+    def run_filter(self):
+        config = self.filter_config
+        try:
+            if self.filter_storage is not None:
+                self.filter_storage.filter()
+                self.filter_storage.stream_rss(limit=self.rss_limit, media=self.media)
+            else:
+                # 先把缓冲区写入，筛选才能看到这些行
+                self.writer.flush()
+                filter_data_incremental(config['database'], config['user'], config['password'], config['host'],
+                                        config['port'], config['table_data'], config['table_tags'],
+                                        config['table_filtered'])
+                stream_rss(config['database'], config['user'], config['password'], config['host'],
+                           config['port'], config['table_filtered'], limit=self.rss_limit, media=self.media)
+        except Exception as e:
+            print(f'筛选失败: {e!r}')
+            return
+        self.pending_filter = False
+        self.last_filter = time.monotonic()
+
+    # 失败时只打印，过archive_interval秒后再试
+    def run_archive(self):
+        self.last_archive = time.monotonic()
+        try:
+            self.writer.archive(self.retention_days, self.archive_dir)
+        except Exception as e:
+            print(f'归档失败: {e!r}')
+
+    # 一直运行到stop()、SIGTERM或Ctrl+C；max_batches用于测试，爬完指定批数后退出
+    def run(self, max_batches=None):
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+        worker = threading.Thread(target=self.process_results, name='bili-scheduler-pipeline')
+        worker.start()
+        batches = 0
+        try:
+            while not self.stop_event.is_set() and self.heap and (max_batches is None or batches < max_batches):
+                due = self.pop_due(time.time())
+                if not due:
+                    self.stop_event.wait(min(self.heap[0][0] - time.time(), 60))
+                    continue
+                print(f'开始爬取{len(due)}个up主')
+                self.crawl_batch(due)
+                batches += 1
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.results.put(None)
+            worker.join()
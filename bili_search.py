@@ -0,0 +1,204 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+
+from bili_filter import committed_seq
+from bili_requests_functions import get_row_entry, parse_and_format_date
+from bili_rss import RSS_TAIL, render_channel, render_item
+
+# 全文索引：本地的sqlite FTS5文件，按数据表的seq增量同步
+SEARCH_PATH = os.path.join('state', 'search.sqlite3')
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+# 标题的权重高于正文
+TITLE_WEIGHT = 3.0
+
+# 中日韩文字没有空格分词，按相邻两个字(bigram)切分；其他文字按单词切分
+_CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'
+_TOKEN_PATTERN = re.compile(f'([{_CJK}]+)|([^\\W{_CJK}]+)')
+
+
+# 把文本切分为FTS5使用的词，连续的中文"哔哩哔哩"得到"哔哩 哩哔 哔哩 哩"
+# 每段中文最后再加上末尾的单字，这样任何一个字都是某个词的开头，单字搜索可以用前缀匹配
+# 切分搜索词时trailing为False，搜索词末尾的中文不加单字，才能匹配到后面还有其他字的原文
+def tokenize(text, trailing=True):
+    matches = _TOKEN_PATTERN.findall(text or '')
+    tokens = []
+    for n, (cjk, word) in enumerate(matches):
+        if word:
+            tokens.append(word.lower())
+        elif len(cjk) == 1:
+            tokens.append(cjk)
+        else:
+            tokens.extend(cjk[k:k + 2] for k in range(len(cjk) - 1))
+            if trailing or n < len(matches) - 1:
+                tokens.append(cjk[-1])
+    return tokens
+
+
+# 把搜索词转为FTS5查询：空格分隔的各个词都要出现，每个词切分后作为短语匹配(bigram相邻即原文连续)
+# 单个汉字按前缀匹配；没有可搜索的词时抛出ValueError
+def build_match_query(query):
+    phrases = []
+    for term in query.split():
+        tokens = tokenize(term, trailing=False)
+        if not tokens:
+            continue
+        if len(tokens) == 1 and len(tokens[0]) == 1:
+            phrases.append(f'"{tokens[0]}" *')
+        else:
+            phrases.append('"' + ' '.join(tokens) + '"')
+    if not phrases:
+        raise ValueError('搜索词为空')
+    return ' AND '.join(phrases)
+
+
+# 把请求参数整理成规范的搜索条件，参数不合法时抛出ValueError
+def normalize_search(args):
+    q = ' '.join(args.get('q', '').split())
+    match = build_match_query(q)
+    limit = int(args.get('limit', DEFAULT_LIMIT))
+    if not 0 < limit <= MAX_LIMIT:
+        raise ValueError(f'limit需要在1到{MAX_LIMIT}之间')
+    return {'q': q, 'match': match, 'ups': tuple(sorted(set(args.getlist('up')))), 'limit': limit}
+
+
+def search_cache_key(search):
+    return ('search', search['q'], search['ups'], search['limit'])
+
+
+# 数据表的全文索引，dynamics保存原始字段用于生成rss，docs为切分后的标题和正文
+# 爬取进程写入、flask读取，sqlite使用WAL，读写互不阻塞
+class SearchIndex:
+    def __init__(self, path=SEARCH_PATH):
+        output_dir = os.path.dirname(path)
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        self.lock = threading.Lock()
+        self.connect = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.connect.execute('PRAGMA journal_mode=WAL')
+        self.connect.execute('PRAGMA synchronous=NORMAL')
+        self.connect.execute('''CREATE TABLE IF NOT EXISTS dynamics (
+            id INTEGER PRIMARY KEY,
+            up_name TEXT,
+            detail_url TEXT UNIQUE,
+            title TEXT,
+            time TEXT,
+            text TEXT,
+            pics TEXT,
+            type TEXT
+        )''')
+        self.connect.execute('CREATE INDEX IF NOT EXISTS dynamics_up_name ON dynamics (up_name)')
+        self.connect.execute("CREATE VIRTUAL TABLE IF NOT EXISTS docs USING fts5(title, text, tokenize='unicode61')")
+        # 每张数据表已经同步到的seq
+        self.connect.execute('CREATE TABLE IF NOT EXISTS search_state (table_data TEXT PRIMARY KEY, last_seq INTEGER)')
+
+    def last_seq(self, table_data):
+        row = self.connect.execute('SELECT last_seq FROM search_state WHERE table_data = ?', (table_data,)).fetchone()
+        return row[0] if row else 0
+
+    # 加入一批 (up_name, detail_url, title, time, text, pics, type)，已存在的detail_url跳过
+    def add_rows(self, rows):
+        added = 0
+        for up_name, detail_url, title, date, text, pics, type in rows:
+            cursor = self.connect.execute(
+                'INSERT OR IGNORE INTO dynamics (up_name, detail_url, title, time, text, pics, type) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (up_name, detail_url, title, str(date), text, json.dumps(list(pics or ()), ensure_ascii=False), type))
+            if cursor.rowcount:
+                self.connect.execute('INSERT INTO docs (rowid, title, text) VALUES (?, ?, ?)',
+                                     (cursor.lastrowid, ' '.join(tokenize(title)), ' '.join(tokenize(text))))
+                added += 1
+        return added
+
+    # 从Postgres数据表同步seq之后的新行，connect为psycopg2连接；返回新加入索引的行数
+    # 数据表的seq列由DynamicsWriter.ensure_schema建立
+    def sync(self, connect, table_data, batch_size=5000):
+        import psycopg2.sql
+
+        def read_batches(last_seq):
+            with connect.cursor() as cursor:
+                upper_seq = committed_seq(cursor, table_data)
+            reader = connect.cursor(name=f'{table_data}_search_reader')
+            reader.itersize = batch_size
+            reader.execute(psycopg2.sql.SQL('''
+                SELECT seq, up_name, detail_url, title, time, text, pics, type
+                FROM {table_data}
+                WHERE seq > %s AND seq <= %s
+                ORDER BY seq
+            ''').format(table_data=psycopg2.sql.Identifier(table_data)), (last_seq, upper_seq))
+            try:
+                while True:
+                    rows = reader.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield rows
+            finally:
+                reader.close()
+                connect.rollback()
+
+        return self.sync_batches(table_data, read_batches)
+
+    # 按seq同步新行，read_batches(last_seq)逐批返回 (seq, up_name, detail_url, title, time, text, pics, type)
+    # 不同的存储后端(见bili_storage)各自提供读取方式
+    def sync_batches(self, table_data, read_batches):
+        added = 0
+        with self.lock:
+            batches = read_batches(self.last_seq(table_data))
+            try:
+                for rows in batches:
+                    # 每批在一个事务里写入，连同同步进度
+                    self.connect.execute('BEGIN')
+                    try:
+                        added += self.add_rows(row[1:] for row in rows)
+                        self.connect.execute('INSERT OR REPLACE INTO search_state (table_data, last_seq) '
+                                             'VALUES (?, ?)', (table_data, rows[-1][0]))
+                        self.connect.execute('COMMIT')
+                    except BaseException:
+                        self.connect.execute('ROLLBACK')
+                        raise
+            finally:
+                batches.close()
+        if added:
+            print(f'全文索引新增{added}条')
+        return added
+
+    # 索引的版本，有新行加入后变化，用于让缓存失效
+    def version(self):
+        with self.lock:
+            return self.connect.execute('SELECT COALESCE(MAX(id), 0) FROM dynamics').fetchone()[0]
+
+    # 按相关度(bm25)排序的搜索结果，返回与数据表字段相同的字典，可直接用于get_row_entry
+    def search(self, match, ups=(), limit=DEFAULT_LIMIT):
+        where = ''
+        params = [match]
+        if ups:
+            where = f' AND d.up_name IN ({", ".join("?" * len(ups))})'
+            params.extend(ups)
+        params.append(limit)
+        with self.lock:
+            rows = self.connect.execute(f'''
+                SELECT d.up_name, d.detail_url, d.title, d.time, d.text, d.pics, d.type
+                FROM docs JOIN dynamics d ON d.id = docs.rowid
+                WHERE docs MATCH ?{where}
+                ORDER BY bm25(docs, {TITLE_WEIGHT}, 1.0)
+                LIMIT ?
+            ''', params).fetchall()
+        return [{'up_name': up_name, 'detail_url': detail_url, 'title': title, 'time': date, 'text': text,
+                 'pics': json.loads(pics), 'type': type}
+                for up_name, detail_url, title, date, text, pics, type in rows]
+
+    def close(self):
+        with self.lock:
+            self.connect.close()
+
+
+# 把搜索结果按相关度顺序渲染为rss
+def render_search_feed(rows, search, media=None):
+    parts = [render_channel('B站动态搜索', 'https://bilibili.com', f'搜索"{search["q"]}"的B站动态',
+                            parse_and_format_date())]
+    parts.extend(render_item(get_row_entry(row, media)) for row in rows)
+    parts.append(RSS_TAIL)
+    return ''.join(parts).encode('utf-8')
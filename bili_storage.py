@@ -0,0 +1,482 @@
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import date, datetime
+
+from bili_dates import SHANGHAI
+from bili_db_writer import BufferedWriter, DynamicsWriter
+from bili_filter import FILTER_STATE_TABLE, AhoCorasick, filter_data_incremental
+from bili_metrics import ARCHIVED_ROWS, FILTER_ROWS, FILTER_SECONDS
+from bili_requests_functions import fetch_all_data
+from bili_retention import ARCHIVE_DIR, ArchiveWriter, archive_table, retention_cutoff, urls_table
+from bili_rss import write_rss_rows
+
+# 存储后端：Postgres，或单机部署用的嵌入式SQLite(不需要数据库服务，写入没有网络往返)
+# 两者的接口相同：ensure_schema/add/flush/close为攒批写入(见BufferedWriter)，set_tags写入标签，
+# filter为增量筛选，fetch_all读出整张表，iter_latest按时间倒序逐行读取最新的limit条，stream_rss生成筛选后的rss，
+# clean清空一张表，archive把超过保留期的行归档后移出数据表和筛选表(见bili_retention)，migrate回填旧数据的up_uid/pub_ts
+STORAGE_BACKENDS = ('postgres', 'sqlite')
+STORAGE_PATH = os.path.join('state', 'bili.sqlite3')
+
+
+# 按配置打开存储后端，sqlite只使用path，不需要数据库参数
+def open_storage(backend, database, user, password, host, port, table_data, table_tags, table_filtered,
+                 path=STORAGE_PATH, **kwargs):
+    if backend == 'postgres':
+        return PostgresStorage(database, user, password, host, port, table_data, table_tags, table_filtered,
+                               **kwargs)
+    if backend == 'sqlite':
+        return SqliteStorage(table_data, table_tags, table_filtered, path, **kwargs)
+    raise ValueError(f'未知的存储后端: {backend}，可选 {", ".join(STORAGE_BACKENDS)}')
+
+
+# Postgres后端，写入见DynamicsWriter，筛选见filter_data_incremental
+class PostgresStorage(DynamicsWriter):
+    def __init__(self, database, user, password, host, port, table_data, table_tags, table_filtered,
+                 batch_size=1000, flush_interval=5.0, minconn=1, maxconn=4, search_index=None, partitioned=False):
+        super().__init__(database, user, password, host, port, table_data, batch_size, flush_interval, minconn,
+                         maxconn, search_index, partitioned)
+        self.db = (database, user, password, host, port)
+        self.table_tags = table_tags
+        self.table_filtered = table_filtered
+
+    def ensure_schema(self, table_tags=None, table_filtered=None):
+        super().ensure_schema(table_tags or self.table_tags, table_filtered or self.table_filtered)
+
+    def migrate(self, table_filtered=None):
+        return super().migrate(table_filtered or self.table_filtered)
+
+    # 用tags替换标签表的全部内容
+    def set_tags(self, tags):
+        import psycopg2.extras
+        import psycopg2.sql
+        connect = self.pool.getconn()
+        try:
+            with connect.cursor() as cursor:
+                table_tags = psycopg2.sql.Identifier(self.table_tags)
+                cursor.execute(psycopg2.sql.SQL('DELETE FROM {table_tags}').format(table_tags=table_tags))
+                psycopg2.extras.execute_values(cursor, psycopg2.sql.SQL(
+                    'INSERT INTO {table_tags} (tag) VALUES %s ON CONFLICT DO NOTHING').format(table_tags=table_tags),
+                    [(tag,) for tag in tags])
+            connect.commit()
+        except Exception:
+            connect.rollback()
+            raise
+        finally:
+            self.pool.putconn(connect)
+
+    # 先写入缓冲区，筛选才能看到这些行
+    def filter(self):
+        self.flush()
+        return filter_data_incremental(*self.db, self.table_data, self.table_tags, self.table_filtered)
+
+    def fetch_all(self, table=None):
+        return fetch_all_data(*self.db, table or self.table_filtered)
+
+    # 服务端游标边读边返回，默认读筛选表
+    def iter_latest(self, limit, table=None, itersize=100):
+        import psycopg2.extras
+        import psycopg2.sql
+        table = table or self.table_filtered
+        connect = self.pool.getconn()
+        try:
+            cursor = connect.cursor(name=f'{table}_latest_reader', cursor_factory=psycopg2.extras.RealDictCursor)
+            cursor.itersize = itersize
+            cursor.execute(psycopg2.sql.SQL('''
+                SELECT up_name, detail_url, title, time, text, pics, type, up_uid, pub_ts
+                FROM {table}
+                ORDER BY pub_ts DESC NULLS LAST, detail_url
+                LIMIT %s
+            ''').format(table=psycopg2.sql.Identifier(table)), (limit,))
+            yield from cursor
+            cursor.close()
+        finally:
+            connect.rollback()
+            self.pool.putconn(connect)
+
+    def stream_rss(self, limit=200, output_name='filtered.xml', media=None):
+        return write_rss_rows(self.iter_latest(limit), output_name, media=media)
+
+    def clean(self, table):
+        import psycopg2.sql
+        connect = self.pool.getconn()
+        try:
+            with connect.cursor() as cursor:
+                cursor.execute(psycopg2.sql.SQL('DELETE FROM {table}').format(table=psycopg2.sql.Identifier(table)))
+            connect.commit()
+        except Exception:
+            connect.rollback()
+            raise
+        finally:
+            self.pool.putconn(connect)
+        print('数据成功清除')
+
+    # 数据表是分区表时整月删除过期的分区，筛选表逐行删除；返回归档的行数
+    def archive(self, retention_days, directory=ARCHIVE_DIR):
+        cutoff = retention_cutoff(retention_days)
+        archived = 0
+        connect = self.pool.getconn()
+        try:
+            for table in (self.table_data, self.table_filtered):
+                archived += archive_table(connect, table, cutoff, directory)
+        finally:
+            self.pool.putconn(connect)
+            # 删除的分区在下次写入到该月时重新建立
+            self.partition_months.clear()
+        return archived
+
+
+# SQLite的表名
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+# SQLite里time存为ISO格式的日期，pub_ts存为时间戳，pics和tags存为json，读出时还原为与Postgres相同的类型
+def _row_dict(row):
+    row = dict(row)
+    if row.get('time') is not None:
+        row['time'] = date.fromisoformat(row['time'])
+    if row.get('pub_ts') is not None:
+        row['pub_ts'] = datetime.fromtimestamp(row['pub_ts'], SHANGHAI)
+    row['pics'] = json.loads(row['pics']) if row.get('pics') else []
+    if 'tags' in row:
+        row['tags'] = json.loads(row['tags']) if row['tags'] else []
+    return row
+
+
+# 嵌入式SQLite后端，所有表在同一个数据库文件里
+# WAL模式，每批写入一个事务；sqlite3会缓存编译好的语句，同一条插入语句只编译一次
+# 写入共用一个连接(加锁)，读取各自打开只读连接，WAL下读写互不阻塞
+class SqliteStorage(BufferedWriter):
+    def __init__(self, table_data, table_tags, table_filtered, path=STORAGE_PATH, batch_size=1000,
+                 flush_interval=5.0, search_index=None):
+        output_dir = os.path.dirname(path)
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        self.path = path
+        self.table_tags = table_tags
+        self.table_filtered = table_filtered
+        self.connect_lock = threading.Lock()
+        self.connect = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.connect.execute('PRAGMA journal_mode=WAL')
+        self.connect.execute('PRAGMA synchronous=NORMAL')
+        data, filtered, urls = _quote(table_data), _quote(table_filtered), _quote(urls_table(table_data))
+        # 与Postgres相同，detail_url表里已有的动态(包括已归档的)不再写入，写入后记下detail_url
+        self.insert_sql = (f'INSERT OR IGNORE INTO {data} '
+                           f'(up_name, detail_url, title, time, text, pics, type, up_uid, pub_ts) '
+                           f'SELECT ?1, ?2, ?3, ?4, ?5, ?6, ?7, ?8, ?9 '
+                           f'WHERE NOT EXISTS (SELECT 1 FROM {urls} WHERE detail_url = ?2)')
+        self.insert_url_sql = f'INSERT OR IGNORE INTO {urls} (detail_url) VALUES (?)'
+        # 内容没有变化的行不更新
+        self.upsert_filtered_sql = f'''
+            INSERT INTO {filtered} (up_name, detail_url, title, time, text, pics, type, up_uid, pub_ts, tags)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (detail_url) DO UPDATE SET
+                up_name = excluded.up_name,
+                title = excluded.title,
+                time = excluded.time,
+                text = excluded.text,
+                pics = excluded.pics,
+                type = excluded.type,
+                up_uid = excluded.up_uid,
+                pub_ts = excluded.pub_ts,
+                tags = excluded.tags
+            WHERE ({filtered}.up_name, {filtered}.title, {filtered}.time, {filtered}.text, {filtered}.pics,
+                   {filtered}.type, {filtered}.up_uid, {filtered}.pub_ts, {filtered}.tags)
+                IS NOT (excluded.up_name, excluded.title, excluded.time, excluded.text, excluded.pics,
+                        excluded.type, excluded.up_uid, excluded.pub_ts, excluded.tags)
+        '''
+        super().__init__(table_data, batch_size, flush_interval, search_index)
+
+    # 一个写事务，BEGIN IMMEDIATE在开始时就拿到写锁，避免与其他进程的写入互相升级锁失败
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.connect_lock:
+            self.connect.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.connect
+                self.connect.execute('COMMIT')
+            except BaseException:
+                self.connect.execute('ROLLBACK')
+                raise
+
+    # 只读连接，用完关闭
+    def reader(self):
+        connect = sqlite3.connect(self.path, timeout=30)
+        connect.row_factory = sqlite3.Row
+        return contextlib.closing(connect)
+
+    # 建表和索引；数据表的seq只增不减(AUTOINCREMENT，删除的行不会被复用)，供增量筛选和全文索引使用
+    # 旧表补上up_uid和pub_ts列，只在刚补上列时回填一次(见migrate)
+    def ensure_schema(self, table_tags=None, table_filtered=None):
+        table_filtered = table_filtered or self.table_filtered
+        data = _quote(self.table_data)
+        tags = _quote(table_tags or self.table_tags)
+        filtered = _quote(table_filtered)
+        with self.transaction() as connect:
+            connect.execute(f'''CREATE TABLE IF NOT EXISTS {data} (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                up_name TEXT,
+                detail_url TEXT NOT NULL UNIQUE,
+                title TEXT,
+                time TEXT,
+                text TEXT,
+                pics TEXT,
+                type TEXT,
+                up_uid TEXT,
+                pub_ts INTEGER
+            )''')
+            connect.execute(f'CREATE TABLE IF NOT EXISTS {tags} (tag TEXT PRIMARY KEY)')
+            connect.execute(f'''CREATE TABLE IF NOT EXISTS {filtered} (
+                up_name TEXT,
+                detail_url TEXT PRIMARY KEY,
+                title TEXT,
+                time TEXT,
+                text TEXT,
+                pics TEXT,
+                type TEXT,
+                tags TEXT,
+                up_uid TEXT,
+                pub_ts INTEGER
+            )''')
+            # detail_url由唯一约束建索引；按发布时间倒序读取最新的数据，按up主名、uid、类型查询
+            added = False
+            for table in (self.table_data, table_filtered):
+                columns = {row[1] for row in connect.execute(f'PRAGMA table_info({_quote(table)})')}
+                for column, column_type in (('up_uid', 'TEXT'), ('pub_ts', 'INTEGER')):
+                    if column not in columns:
+                        connect.execute(f'ALTER TABLE {_quote(table)} ADD COLUMN {column} {column_type}')
+                        added = True
+                # 按time排序的旧索引已经用不到
+                for index in (f'{table}_time_idx', f'{table}_up_name_idx'):
+                    connect.execute(f'DROP INDEX IF EXISTS {_quote(index)}')
+                for suffix, columns in (('pub_ts_idx', '(pub_ts DESC, detail_url)'),
+                                        ('up_name_pub_ts_idx', '(up_name, pub_ts DESC)'),
+                                        ('up_uid_pub_ts_idx', '(up_uid, pub_ts DESC)'),
+                                        ('type_pub_ts_idx', '(type, pub_ts)')):
+                    connect.execute(f'CREATE INDEX IF NOT EXISTS {_quote(f"{table}_{suffix}")} '
+                                    f'ON {_quote(table)} {columns}')
+            if added:
+                backfilled = self._backfill_uid_columns(connect, table_filtered)
+                print(f'旧数据回填了up_uid/pub_ts，共{backfilled}条')
+            connect.execute(f'''CREATE TABLE IF NOT EXISTS {_quote(FILTER_STATE_TABLE)} (
+                table_filtered TEXT PRIMARY KEY,
+                last_seq INTEGER,
+                tags_hash TEXT
+            )''')
+            # 去重用的detail_url表(见bili_retention.CREATE_TABLE_URLS_SQL)，新建时导入数据表已有的detail_url
+            urls = urls_table(self.table_data)
+            exists = connect.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (urls,))
+            if exists.fetchone() is None:
+                connect.execute(f'CREATE TABLE {_quote(urls)} (detail_url TEXT PRIMARY KEY)')
+                connect.execute(f'INSERT OR IGNORE INTO {_quote(urls)} (detail_url) SELECT detail_url FROM {data}')
+        print('数据表创建成功/已存在')
+
+    # 回填旧数据的up_uid/pub_ts，与backfill_uid_columns相同，写入新动态后旧数据能对应上uid时执行
+    def migrate(self, table_filtered=None):
+        with self.transaction() as connect:
+            backfilled = self._backfill_uid_columns(connect, table_filtered or self.table_filtered)
+        print(f'旧数据回填了up_uid/pub_ts，共{backfilled}条')
+        return backfilled
+
+    # 全表UPDATE，返回回填的行数
+    def _backfill_uid_columns(self, connect, table_filtered):
+        data = _quote(self.table_data)
+        filtered = _quote(table_filtered)
+        # time为北京时间的日期，当天0点的时间戳要减去8小时
+        backfilled = connect.execute(f'''
+            UPDATE {data} SET pub_ts = CAST(strftime('%s', time) AS INTEGER) - 8 * 3600
+            WHERE pub_ts IS NULL AND time IS NOT NULL
+        ''').rowcount
+        backfilled += connect.execute(f'''
+            UPDATE {data} SET up_uid = (
+                SELECT u.up_uid FROM {data} AS u
+                WHERE u.up_name = {data}.up_name AND u.up_uid IS NOT NULL
+                ORDER BY u.pub_ts DESC
+                LIMIT 1
+            )
+            WHERE up_uid IS NULL
+                AND EXISTS (SELECT 1 FROM {data} AS u WHERE u.up_name = {data}.up_name AND u.up_uid IS NOT NULL)
+        ''').rowcount
+        backfilled += connect.execute(f'''
+            UPDATE {filtered} SET (up_uid, pub_ts) = (
+                SELECT COALESCE({filtered}.up_uid, d.up_uid), COALESCE({filtered}.pub_ts, d.pub_ts)
+                FROM {data} AS d
+                WHERE d.detail_url = {filtered}.detail_url
+            )
+            WHERE EXISTS (
+                SELECT 1 FROM {data} AS d
+                WHERE d.detail_url = {filtered}.detail_url
+                    AND ({filtered}.up_uid IS NULL AND d.up_uid IS NOT NULL
+                         OR {filtered}.pub_ts IS NULL AND d.pub_ts IS NOT NULL)
+            )
+        ''').rowcount
+        return backfilled
+
+    def insert_rows(self, rows):
+        with self.transaction() as connect:
+            before = connect.total_changes
+            connect.executemany(self.insert_sql, [
+                (up_name, detail_url, title, date.isoformat(), text, json.dumps(list(pics), ensure_ascii=False), type,
+                 up_uid, int(pub_ts.timestamp()))
+                for up_name, detail_url, title, date, text, pics, type, up_uid, pub_ts in rows])
+            inserted = connect.total_changes - before
+            connect.executemany(self.insert_url_sql, [(row[1],) for row in rows])
+            return inserted
+
+    # 把数据表的新行同步到全文索引，失败时只打印，下次写入时会从上次的进度继续
+    def sync_search_index(self):
+        try:
+            self.search_index.sync_batches(self.table_data, self.read_new_rows)
+        except Exception as e:
+            print(f'同步全文索引失败: {e!r}')
+
+    # 逐批读取seq之后的新行 (seq, up_name, detail_url, title, time, text, pics, type)
+    def read_new_rows(self, last_seq, batch_size=5000):
+        with self.reader() as connect:
+            while True:
+                rows = connect.execute(f'''
+                    SELECT seq, up_name, detail_url, title, time, text, pics, type
+                    FROM {_quote(self.table_data)}
+                    WHERE seq > ?
+                    ORDER BY seq
+                    LIMIT ?
+                ''', (last_seq, batch_size)).fetchall()
+                if not rows:
+                    break
+                last_seq = rows[-1][0]
+                yield [(seq, up_name, detail_url, title, date, text, json.loads(pics), type)
+                       for seq, up_name, detail_url, title, date, text, pics, type in rows]
+
+    # 用tags替换标签表的全部内容
+    def set_tags(self, tags):
+        table_tags = _quote(self.table_tags)
+        with self.transaction() as connect:
+            connect.execute(f'DELETE FROM {table_tags}')
+            connect.executemany(f'INSERT OR IGNORE INTO {table_tags} (tag) VALUES (?)', [(tag,) for tag in tags])
+
+    # 与filter_data_incremental相同：只处理上次筛选之后新插入的行，标签表变化时重新筛选全部数据
+    # 整个筛选在一个事务里完成，数据表按seq分批读取
+    def filter(self, batch_size=5000):
+        self.flush()
+        start = time.perf_counter()
+        data, filtered = _quote(self.table_data), _quote(self.table_filtered)
+        state_table = _quote(FILTER_STATE_TABLE)
+        with self.transaction() as connect:
+            tags = sorted(row[0] for row in connect.execute(f'SELECT tag FROM {_quote(self.table_tags)}'))
+            tags_hash = hashlib.sha1('\n'.join(tags).encode('utf-8')).hexdigest()
+            state = connect.execute(f'SELECT last_seq, tags_hash FROM {state_table} WHERE table_filtered = ?',
+                                    (self.table_filtered,)).fetchone()
+            state_matches = state is not None and state[1] == tags_hash
+            if state_matches:
+                last_seq = state[0]
+            else:
+                # 首次筛选或标签变化，清空筛选表后全部重新筛选
+                last_seq = 0
+                connect.execute(f'DELETE FROM {filtered}')
+                print('标签有变化，重新筛选全部数据')
+            automaton = AhoCorasick(tags)
+            scanned = 0
+            matched_rows = 0
+            while True:
+                rows = connect.execute(f'''
+                    SELECT seq, up_name, detail_url, title, time, text, pics, type, up_uid, pub_ts
+                    FROM {data}
+                    WHERE seq > ?
+                    ORDER BY seq
+                    LIMIT ?
+                ''', (last_seq, batch_size)).fetchall()
+                if not rows:
+                    break
+                scanned += len(rows)
+                last_seq = rows[-1][0]
+                results = []
+                for seq, up_name, detail_url, title, day, text, pics, type, up_uid, pub_ts in rows:
+                    matched = automaton.find(text, automaton.find(title))
+                    if matched:
+                        results.append((up_name, detail_url, title, day, text, pics, type, up_uid, pub_ts,
+                                        json.dumps(sorted(matched), ensure_ascii=False)))
+                connect.executemany(self.upsert_filtered_sql, results)
+                matched_rows += len(results)
+            connect.execute(f'INSERT OR REPLACE INTO {state_table} (table_filtered, last_seq, tags_hash) '
+                            f'VALUES (?, ?, ?)', (self.table_filtered, last_seq, tags_hash))
+        FILTER_SECONDS.observe(time.perf_counter() - start, mode='incremental' if state_matches else 'full')
+        FILTER_ROWS.inc(scanned, result='scanned')
+        FILTER_ROWS.inc(matched_rows, result='matched')
+        print(f'筛选数据已插入到新表，扫描{scanned}条，命中{matched_rows}条')
+        return matched_rows
+
+    # 读出整张表，格式与fetch_all_data的结果一致，默认读筛选表
+    def fetch_all(self, table=None):
+        with self.reader() as connect:
+            rows = [_row_dict(row) for row in connect.execute(f'SELECT * FROM {_quote(table or self.table_filtered)}')]
+        print(f'数据库字典获取成功，共{len(rows)}条')
+        return rows
+
+    # 边读边返回，默认读筛选表
+    def iter_latest(self, limit, table=None):
+        with self.reader() as connect:
+            for row in connect.execute(f'''
+                SELECT up_name, detail_url, title, time, text, pics, type, up_uid, pub_ts
+                FROM {_quote(table or self.table_filtered)}
+                ORDER BY pub_ts DESC NULLS LAST, detail_url
+                LIMIT ?
+            ''', (limit,)):
+                yield _row_dict(row)
+
+    def stream_rss(self, limit=200, output_name='filtered.xml', media=None):
+        return write_rss_rows(self.iter_latest(limit), output_name, media=media)
+
+    def clean(self, table):
+        with self.transaction() as connect:
+            connect.execute(f'DELETE FROM {_quote(table)}')
+        print('数据成功清除')
+
+    # 数据表和筛选表各在一个写事务里按rowid分批读出过期的行写入归档，再一次删除；返回归档的行数
+    def archive(self, retention_days, directory=ARCHIVE_DIR, batch_size=5000):
+        cutoff = int(retention_cutoff(retention_days).timestamp())
+        archived = 0
+        for table in (self.table_data, self.table_filtered):
+            writer = ArchiveWriter(table, directory)
+            try:
+                with self.transaction() as connect:
+                    cursor = connect.cursor()
+                    cursor.row_factory = sqlite3.Row
+                    last_rowid = 0
+                    while True:
+                        rows = cursor.execute(f'''
+                            SELECT rowid AS archive_rowid, * FROM {_quote(table)}
+                            WHERE rowid > ? AND pub_ts < ?
+                            ORDER BY rowid
+                            LIMIT ?
+                        ''', (last_rowid, cutoff, batch_size)).fetchall()
+                        if not rows:
+                            break
+                        last_rowid = rows[-1]['archive_rowid']
+                        for row in rows:
+                            row = _row_dict(row)
+                            del row['archive_rowid']
+                            writer.write(row)
+                    connect.execute(f'DELETE FROM {_quote(table)} WHERE pub_ts < ?', (cutoff,))
+                    # 归档文件落盘之后才提交删除
+                    paths = writer.close()
+            except BaseException:
+                writer.discard()
+                raise
+            ARCHIVED_ROWS.inc(writer.count, table=table)
+            if writer.count:
+                print(f'{table} 归档了{writer.count}行到 {", ".join(paths)}')
+            archived += writer.count
+        return archived
+
+    # 写入剩余数据并关闭连接
+    def close(self):
+        try:
+            super().close()
+        finally:
+            with self.connect_lock:
+                self.connect.close()
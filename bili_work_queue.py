@@ -0,0 +1,178 @@
+import os
+import sqlite3
+import threading
+import time
+
+from bili_metrics import WORK_QUEUE_TASKS
+
+# 一次性爬取的任务队列，每个up主一个任务，状态保存在sqlite里，进程中途退出后下次运行从未完成的up主继续
+# 任务状态：pending(等待爬取，next_attempt之前不会被取出)、running(已取出)、done(本轮已完成)、
+# dead(连续失败max_attempts次，进入死信列表，之后的运行跳过，直到start_run时用requeue_dead放回)
+# work_queue_run记录当前一轮的状态：start_run时为running，所有批次处理完后end_run记为finished
+WORK_QUEUE_PATH = os.path.join('state', 'work_queue.sqlite3')
+
+
+class WorkQueue:
+    def __init__(self, path=WORK_QUEUE_PATH, max_attempts=5, base_delay=30, max_delay=3600):
+        output_dir = os.path.dirname(path)
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.connect = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.connect.execute('PRAGMA journal_mode=WAL')
+        self.connect.execute('''CREATE TABLE IF NOT EXISTS work_queue (
+            up_uid TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt REAL NOT NULL DEFAULT 0,
+            last_error TEXT,
+            updated_at REAL
+        )''')
+        self.connect.execute('CREATE INDEX IF NOT EXISTS work_queue_due ON work_queue (state, next_attempt)')
+        self.connect.execute('''CREATE TABLE IF NOT EXISTS work_queue_run (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            state TEXT NOT NULL,
+            started_at REAL,
+            finished_at REAL
+        )''')
+
+    # 开始一轮爬取：上一轮没有执行到end_run(进程中途退出)或留下了running的任务时继续上一轮，已完成的up主不再爬取；
+    # 否则开始新的一轮，把已完成的任务全部重新排队，等待重试的任务保留失败次数和next_attempt
+    # 上次退出时正在爬取的任务放回队列，不计入失败次数；不在up_uids里的任务删除；返回是否继续了上一轮
+    # requeue_dead为True(全部)或up_uid列表时把死信列表中的这些up主放回队列，失败次数清零
+    def start_run(self, up_uids, requeue_dead=False):
+        up_uids = list(dict.fromkeys(up_uids))
+        now = time.time()
+        with self.lock:
+            self.connect.execute('BEGIN IMMEDIATE')
+            try:
+                run = self.connect.execute('SELECT state FROM work_queue_run WHERE id = 1').fetchone()
+                running = self.connect.execute("SELECT COUNT(*) FROM work_queue WHERE state = 'running'").fetchone()[0]
+                resumed = running > 0 or run is not None and run[0] == 'running'
+                self.connect.execute("UPDATE work_queue SET state = 'pending' WHERE state = 'running'")
+                removed = {row[0] for row in self.connect.execute('SELECT up_uid FROM work_queue')} - set(up_uids)
+                self.connect.executemany('DELETE FROM work_queue WHERE up_uid = ?', [(up_uid,) for up_uid in removed])
+                if not resumed:
+                    self.connect.execute('''
+                        UPDATE work_queue SET state = 'pending', attempts = 0, next_attempt = 0, last_error = NULL,
+                            updated_at = ?
+                        WHERE state = 'done'
+                    ''', (now,))
+                if requeue_dead:
+                    dead = [row[0] for row in self.connect.execute(
+                        "SELECT up_uid FROM work_queue WHERE state = 'dead'")]
+                    if requeue_dead is not True:
+                        requeue_dead = set(requeue_dead)
+                        dead = [up_uid for up_uid in dead if up_uid in requeue_dead]
+                    self.connect.executemany('''
+                        UPDATE work_queue SET state = 'pending', attempts = 0, next_attempt = 0, updated_at = ?
+                        WHERE up_uid = ?
+                    ''', [(now, up_uid) for up_uid in dead])
+                self.connect.executemany('''
+                    INSERT OR IGNORE INTO work_queue (up_uid, state, updated_at) VALUES (?, 'pending', ?)
+                ''', [(up_uid, now) for up_uid in up_uids])
+                if not resumed:
+                    self.connect.execute('''
+                        INSERT OR REPLACE INTO work_queue_run (id, state, started_at) VALUES (1, 'running', ?)
+                    ''', (now,))
+                self.connect.execute('COMMIT')
+            except BaseException:
+                self.connect.execute('ROLLBACK')
+                raise
+        dead = self.dead_letters()
+        if resumed:
+            print(f'继续上一轮未完成的爬取，剩余{self.stats().get("pending", 0)}个up主')
+        if dead:
+            print(f'死信列表中有{len(dead)}个up主被跳过: {", ".join(row["up_uid"] for row in dead)}')
+        return resumed
+
+    # 取出最多limit个到期的任务并标记为running，按到期时间和加入顺序
+    def claim(self, limit, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.connect.execute('BEGIN IMMEDIATE')
+            try:
+                up_uids = [row[0] for row in self.connect.execute('''
+                    SELECT up_uid FROM work_queue
+                    WHERE state = 'pending' AND next_attempt <= ?
+                    ORDER BY next_attempt, rowid
+                    LIMIT ?
+                ''', (now, limit))]
+                self.connect.executemany("UPDATE work_queue SET state = 'running', updated_at = ? WHERE up_uid = ?",
+                                         [(now, up_uid) for up_uid in up_uids])
+                self.connect.execute('COMMIT')
+            except BaseException:
+                self.connect.execute('ROLLBACK')
+                raise
+        return up_uids
+
+    # 一轮的所有批次处理完成，下次start_run开始新的一轮
+    def end_run(self):
+        with self.lock:
+            self.connect.execute("UPDATE work_queue_run SET state = 'finished', finished_at = ? WHERE id = 1",
+                                 (time.time(),))
+
+    # 逐批取出到期的任务，调用方处理完一批后调用finish；一次性流程不等待退避中的任务，留到下次运行
+    # (失败的up主在同一次运行里的重试由常驻调度bili_scheduler负责)
+    def batches(self, batch_size):
+        while True:
+            up_uids = self.claim(batch_size)
+            if not up_uids:
+                break
+            yield up_uids
+        pending = self.stats().get('pending', 0)
+        if pending:
+            print(f'{pending}个up主等待重试，留到下次运行')
+
+    # 一批任务处理完成，errors为{up_uid: 异常}，其余的up_uid标记为完成
+    def finish(self, up_uids, errors):
+        now = time.time()
+        done = [up_uid for up_uid in up_uids if up_uid not in errors]
+        with self.lock:
+            self.connect.executemany('''
+                UPDATE work_queue SET state = 'done', attempts = 0, next_attempt = 0, last_error = NULL, updated_at = ?
+                WHERE up_uid = ?
+            ''', [(now, up_uid) for up_uid in done])
+        WORK_QUEUE_TASKS.inc(len(done), result='done')
+        for up_uid, error in errors.items():
+            self.fail(up_uid, error, now)
+
+    # 失败的任务按指数退避重新排队(base_delay * 2^(失败次数-1)，最多max_delay秒)，失败max_attempts次后进入死信列表
+    def fail(self, up_uid, error, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            row = self.connect.execute('SELECT attempts FROM work_queue WHERE up_uid = ?', (up_uid,)).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            state = 'dead' if attempts >= self.max_attempts else 'pending'
+            next_attempt = now + min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+            self.connect.execute('''
+                UPDATE work_queue SET state = ?, attempts = ?, next_attempt = ?, last_error = ?, updated_at = ?
+                WHERE up_uid = ?
+            ''', (state, attempts, next_attempt, repr(error), now, up_uid))
+        WORK_QUEUE_TASKS.inc(result='dead' if state == 'dead' else 'retry')
+        if state == 'dead':
+            print(f'{up_uid}连续失败{attempts}次，移入死信列表: {error!r}')
+        else:
+            print(f'{up_uid}第{attempts}次失败，{next_attempt - now:.0f}秒后重试: {error!r}')
+        return state
+
+    # 死信列表 [{'up_uid', 'attempts', 'last_error', 'updated_at'}]
+    def dead_letters(self):
+        with self.lock:
+            rows = self.connect.execute('''
+                SELECT up_uid, attempts, last_error, updated_at FROM work_queue WHERE state = 'dead' ORDER BY rowid
+            ''').fetchall()
+        return [{'up_uid': up_uid, 'attempts': attempts, 'last_error': last_error, 'updated_at': updated_at}
+                for up_uid, attempts, last_error, updated_at in rows]
+
+    # 各状态的任务数
+    def stats(self):
+        with self.lock:
+            return dict(self.connect.execute('SELECT state, COUNT(*) FROM work_queue GROUP BY state').fetchall())
+
+    def close(self):
+        with self.lock:
+            self.connect.close()
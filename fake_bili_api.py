@@ -0,0 +1,261 @@
+import argparse
+import copy
+import json
+import os
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+# 本地模拟的B站接口，用于在不请求真实接口的情况下测量爬虫性能
+# 每个up主的动态按 图文、视频、纯文本、专栏、转发 循环生成，转发动态会被爬虫忽略
+ITEM_TYPES = ['DYNAMIC_TYPE_DRAW', 'DYNAMIC_TYPE_AV', 'DYNAMIC_TYPE_WORD', 'DYNAMIC_TYPE_ARTICLE',
+              'DYNAMIC_TYPE_FORWARD']
+PAGE_SIZE = 12
+BASE_TS = 1735660800  # 2025-01-01 00:00:00 +0800
+# 录制的真实接口响应，space_<up_uid>.json为动态列表第一页，article_<id>.json为专栏详情
+FIXTURES_DIR = 'fixtures'
+
+
+# 生成某个up主第index条动态(index越大越旧)
+def make_item(up_uid, index, item_types=ITEM_TYPES):
+    data_type = item_types[index % len(item_types)]
+    pub_ts = BASE_TS - index * 3600 - int(up_uid) % 3600
+    id_str = str(int(up_uid) * 1000000 + (999999 - index))
+    rid_str = str(int(up_uid) * 1000 + index % 1000)
+    author = {'name': f'up{up_uid}', 'mid': int(up_uid), 'pub_ts': pub_ts,
+              'pub_time': time.strftime('%Y年%m月%d日', time.localtime(pub_ts))}
+    if data_type in ('DYNAMIC_TYPE_DRAW', 'DYNAMIC_TYPE_WORD'):
+        pics = [] if data_type == 'DYNAMIC_TYPE_WORD' else [
+            {'url': f'https://i0.hdslb.com/bfs/new_dyn/{id_str}_{n}.jpg', 'width': 1080, 'height': 1080}
+            for n in range(3)]
+        major = {'type': 'MAJOR_TYPE_OPUS',
+                 'opus': {'title': f'动态{id_str}', 'summary': {'text': f'up{up_uid}的第{index}条动态 测试文本'},
+                          'pics': pics}}
+    elif data_type == 'DYNAMIC_TYPE_AV':
+        major = {'type': 'MAJOR_TYPE_ARCHIVE',
+                 'archive': {'title': f'视频{id_str}', 'bvid': f'BV1{id_str[-9:]}', 'desc': f'视频简介{index}',
+                             'cover': f'https://i0.hdslb.com/bfs/archive/{id_str}.jpg'}}
+    elif data_type == 'DYNAMIC_TYPE_ARTICLE':
+        major = {'type': 'MAJOR_TYPE_OPUS', 'opus': {'title': f'专栏{rid_str}', 'summary': {'text': ''}, 'pics': []}}
+    else:
+        major = None
+    return {'id_str': id_str, 'type': data_type, 'basic': {'rid_str': rid_str},
+            'modules': {'module_author': author, 'module_dynamic': {'major': major}}}
+
+
+# 专栏详情，偶数id带图片(opus)，奇数id为纯文本
+def make_article(rid_str):
+    data = {'title': f'专栏{rid_str}', 'publish_time': BASE_TS - int(rid_str) % 100000,
+            'content': f'<p>专栏{rid_str}的正文</p>'}
+    if int(rid_str) % 2 == 0:
+        data['opus'] = {'content': {'paragraphs': [
+            {'para_type': 1, 'text': {'nodes': [{'word': {'words': f'专栏{rid_str}第一段'}}]}},
+            {'para_type': 2, 'pic': {'pics': [{'url': f'https://i0.hdslb.com/bfs/article/{rid_str}.png'}]}},
+            {'para_type': 1, 'text': {'nodes': [{'word': {'words': '第二段'}}]}},
+        ]}}
+    return {'code': 0, 'message': '0', 'data': data}
+
+
+# 录制真实接口的响应作为模拟接口的样本：每个up主的第一页动态，以及其中专栏的详情
+# 专栏接口容易触发风控，每个专栏之间等待article_interval秒
+def record_fixtures(up_uids, user_cookie, directory=FIXTURES_DIR, article_interval=15):
+    import requests
+    from bili_requests_functions import (get_article_detail_url, get_article_headers, get_space_headers,
+                                         get_space_items_url)
+
+    os.makedirs(directory, exist_ok=True)
+
+    def save(name, payload):
+        with open(os.path.join(directory, name), 'w', encoding='utf-8') as f:
+            json.dump(payload, f, ensure_ascii=False, indent=2)
+
+    for up_uid in up_uids:
+        payload = requests.get(get_space_items_url(up_uid), headers=get_space_headers(up_uid, user_cookie),
+                               timeout=10).json()
+        save(f'space_{up_uid}.json', payload)
+        items = (payload.get('data') or {}).get('items') or []
+        print(f'{up_uid}: 录制了{len(items)}条动态')
+        for item in items:
+            if item['type'] != 'DYNAMIC_TYPE_ARTICLE':
+                continue
+            rid_str = item['basic']['rid_str']
+            time.sleep(article_interval)
+            save(f'article_{rid_str}.json', requests.get(get_article_detail_url(rid_str),
+                                                         headers=get_article_headers(rid_str, user_cookie),
+                                                         timeout=10).json())
+            print(f'{up_uid}: 录制了专栏{rid_str}')
+
+
+# 读取录制的样本，返回(动态模板列表, 专栏模板列表)；转发以外的类型至少要有一条
+def load_fixtures(directory=FIXTURES_DIR):
+    item_templates = []
+    article_templates = []
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name), 'r', encoding='utf-8') as f:
+            payload = json.load(f)
+        if payload.get('code') != 0:
+            continue
+        if name.startswith('space_'):
+            item_templates.extend(item for item in payload['data'].get('items') or []
+                                  if not (item['modules'].get('module_tag') or {}).get('text'))
+        elif name.startswith('article_'):
+            article_templates.append(payload)
+    if not item_templates:
+        raise ValueError(f'{directory} 中没有录制的动态')
+    return item_templates, article_templates
+
+
+# 用录制的动态作为模板生成某个up主第index条动态，改写id、作者和发布时间，保证不同up主的动态不重复
+def make_fixture_item(item_templates, up_uid, index):
+    item = copy.deepcopy(item_templates[index % len(item_templates)])
+    pub_ts = BASE_TS - index * 3600 - int(up_uid) % 3600
+    item['id_str'] = str(int(up_uid) * 1000000 + (999999 - index))
+    author = item['modules']['module_author']
+    author.update({'name': f'up{up_uid}', 'mid': int(up_uid), 'pub_ts': pub_ts,
+                   'pub_time': time.strftime('%Y年%m月%d日', time.localtime(pub_ts))})
+    if item['type'] == 'DYNAMIC_TYPE_ARTICLE':
+        item['basic']['rid_str'] = str(int(up_uid) * 1000 + index % 1000)
+    elif item['type'] == 'DYNAMIC_TYPE_AV':
+        item['modules']['module_dynamic']['major']['archive']['bvid'] = f'BV1{item["id_str"][-9:]}'
+    return item
+
+
+# 服务端令牌桶，超过速率时按B站的方式返回-352
+class ServerBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class FakeBiliHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query, keep_blank_values=True)
+        with server.stats_lock:
+            server.stats[parts.path] = server.stats.get(parts.path, 0) + 1
+        if server.latency:
+            time.sleep(server.latency + random.uniform(0, server.jitter))
+        if parts.path == '/x/polymer/web-dynamic/v1/feed/space':
+            up_uid = query['host_mid'][0]
+            offset = query.get('offset', [''])[0]
+            start = 0
+            if offset:
+                start = 999999 - int(offset) % 1000000 + 1
+            end = min(start + PAGE_SIZE, server.items_per_up)
+            items = [server.make_item(up_uid, index) for index in range(start, end)]
+            self.send_json(200, {'code': 0, 'message': '0', 'data': {
+                'items': items, 'has_more': end < server.items_per_up,
+                'offset': items[-1]['id_str'] if items else ''}})
+        elif parts.path == '/x/article/view':
+            if server.article_rate and not server.article_bucket(self.headers.get('Cookie', '')).take():
+                with server.stats_lock:
+                    server.stats['throttled'] = server.stats.get('throttled', 0) + 1
+                if server.throttle_status == 412:
+                    self.send_json(412, {'code': -412, 'message': '请求被拦截'})
+                else:
+                    self.send_json(200, {'code': -352, 'message': '风控校验失败'})
+                return
+            self.send_json(200, server.make_article(query['id'][0]))
+        else:
+            self.send_json(404, {'code': -404, 'message': '啥都木有'})
+
+
+# 与B站相同，专栏接口按cookie分别限流
+# 加载了录制的样本时用样本作为模板生成响应，否则使用make_item/make_article
+class FakeBiliServer(ThreadingHTTPServer):
+    daemon_threads = True
+    item_templates = None
+    article_templates = None
+
+    def make_item(self, up_uid, index):
+        if self.item_templates:
+            return make_fixture_item(self.item_templates, up_uid, index)
+        return make_item(up_uid, index)
+
+    def make_article(self, rid_str):
+        if self.article_templates:
+            return self.article_templates[int(rid_str) % len(self.article_templates)]
+        return make_article(rid_str)
+
+    def article_bucket(self, cookie):
+        with self.stats_lock:
+            if cookie not in self.article_buckets:
+                self.article_buckets[cookie] = ServerBucket(self.article_rate, self.article_burst)
+            return self.article_buckets[cookie]
+
+
+# 在后台线程启动模拟接口，返回(server, api_base)
+# article_rate为None时专栏接口不限流，否则每个cookie超过速率时返回-352(throttle_status=412时返回HTTP 412)
+# fixtures为录制样本的目录，为None时生成合成数据
+def start_fake_api(latency=0.05, jitter=0.0, items_per_up=12, article_rate=None, article_burst=3,
+                   throttle_status=200, host='127.0.0.1', port=0, fixtures=None):
+    server = FakeBiliServer((host, port), FakeBiliHandler)
+    if fixtures is not None:
+        server.item_templates, server.article_templates = load_fixtures(fixtures)
+    server.latency = latency
+    server.jitter = jitter
+    server.items_per_up = items_per_up
+    server.article_rate = article_rate
+    server.article_burst = article_burst
+    server.article_buckets = {}
+    server.throttle_status = throttle_status
+    server.stats = {}
+    server.stats_lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f'http://{host}:{server.server_address[1]}'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='本地模拟的B站接口')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--items-per-up', type=int, default=12)
+    # 每个cookie每秒允许的专栏请求数，不提供时不限流
+    parser.add_argument('--article-rate', type=float)
+    parser.add_argument('--fixtures', help='录制样本的目录')
+    # 录制模式：请求真实接口保存样本后退出
+    parser.add_argument('--record', nargs='+', metavar='UP_UID')
+    parser.add_argument('--cookie', default='')
+    args = parser.parse_args()
+    if args.record:
+        record_fixtures(args.record, args.cookie, args.fixtures or FIXTURES_DIR)
+        raise SystemExit
+    server, api_base = start_fake_api(latency=args.latency, jitter=args.jitter, items_per_up=args.items_per_up,
+                                      article_rate=args.article_rate, port=args.port, fixtures=args.fixtures)
+    print(f'模拟接口已启动: {api_base}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,11 +1,237 @@
-from flask import Flask
+import gzip
+import hashlib
+import os
+import threading
+import time
+from email.utils import formatdate
+
+import psycopg2.pool
+import requests
+from flask import Flask, Response, abort, request, send_file
+from werkzeug.security import safe_join
+
+from bili_media import MediaCache, MediaProxy, is_allowed_url, media_source_url
+from bili_metrics import (FEED_RESPONSES, MEDIA_RESPONSES, QUERY_CACHE, RENDER_SECONDS, merge_metrics,
+                          read_metrics_files, render_metrics)
+from bili_query import QueryCache, normalize_query, query_cache_key, query_rows, query_version, render_query_feed
+from bili_search import SEARCH_PATH, SearchIndex, normalize_search, render_search_feed, search_cache_key
+
+# brotli为可选依赖，没有安装时只提供gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask(__name__, static_folder='xml_files')
 
+# 动态查询接口使用的数据库，从环境变量读取
+DB_CONFIG = {
+    'database': os.environ.get('BILI_DB_NAME', ''),
+    'user': os.environ.get('BILI_DB_USER', ''),
+    'password': os.environ.get('BILI_DB_PASSWORD', ''),
+    'host': os.environ.get('BILI_DB_HOST', ''),
+    'port': os.environ.get('BILI_DB_PORT', ''),
+}
+TABLE_DATA = os.environ.get('BILI_TABLE_DATA', 'bili_dynamics')
+TABLE_FILTERED = os.environ.get('BILI_TABLE_FILTERED', 'bili_dynamics_filtered')
+# 查询结果缓存：最多缓存的查询数和有效期(秒)
+query_cache = QueryCache(max_entries=int(os.environ.get('BILI_QUERY_CACHE_SIZE', 256)),
+                         ttl=int(os.environ.get('BILI_QUERY_CACHE_TTL', 300)))
+_db_pool = None
+_db_pool_lock = threading.Lock()
+# 全文索引文件，由爬取进程写库时同步(见bili_search)
+SEARCH_INDEX_PATH = os.environ.get('BILI_SEARCH_INDEX', SEARCH_PATH)
+_search_index = None
+_search_index_lock = threading.Lock()
+
+# 图片代理：设置BILI_MEDIA_BASE_URL(本服务对外的地址)时启用/media，查询接口生成的rss也使用代理地址
+# 查询接口不等待下载，只使用已缓存图片的大小和类型
+MEDIA_BASE_URL = os.environ.get('BILI_MEDIA_BASE_URL', '')
+media_cache = None
+query_media = None
+if MEDIA_BASE_URL:
+    media_cache = MediaCache(max_bytes=int(os.environ.get('BILI_MEDIA_CACHE_MB', 1024)) * 1024 * 1024)
+    query_media = MediaProxy(MEDIA_BASE_URL, prefetch=False, cache=media_cache)
+
+# 内存中的feed缓存 {filename: {...}}，文件的mtime或大小变化时重新读取并压缩
+_feed_cache = {}
+_feed_cache_lock = threading.Lock()
+
+
+# 读取feed并预先压缩，文件没有变化时直接使用缓存
+def load_feed(filename):
+    path = safe_join(app.static_folder, filename)
+    # 以.开头的是正在写入的临时文件
+    if path is None or os.path.basename(path).startswith('.'):
+        abort(404)
+    try:
+        stat = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        with _feed_cache_lock:
+            _feed_cache.pop(filename, None)
+        abort(404)
+    version = (stat.st_mtime_ns, stat.st_size)
+    feed = _feed_cache.get(filename)
+    if feed is not None and feed['version'] == version:
+        return feed
+    with open(path, 'rb') as f:
+        feed = make_feed(f.read(), stat.st_mtime)
+    feed['version'] = version
+    with _feed_cache_lock:
+        _feed_cache[filename] = feed
+    return feed
+
+
+# 计算ETag并预先压缩
+def make_feed(body, mtime):
+    feed = {
+        'etag': hashlib.sha256(body).hexdigest()[:32],
+        'last_modified': formatdate(mtime, usegmt=True),
+        'mtime': int(mtime),
+        'bodies': {'identity': body, 'gzip': gzip.compress(body, compresslevel=9, mtime=0)},
+    }
+    if brotli is not None:
+        feed['bodies']['br'] = brotli.compress(body)
+    return feed
+
+
+# 按Accept-Encoding选择压缩方式
+def choose_encoding(feed):
+    for encoding in ('br', 'gzip'):
+        if encoding in feed['bodies'] and request.accept_encodings[encoding]:
+            return encoding
+    return 'identity'
+
+
+# 客户端的缓存仍然有效时返回True
+def is_not_modified(feed):
+    # 不同压缩方式的ETag带有后缀，比较时忽略
+    if request.if_none_match:
+        return any(tag.split('-', 1)[0] == feed['etag'] for tag in request.if_none_match.as_set()) or \
+            request.if_none_match.star_tag
+    if request.if_modified_since:
+        return int(request.if_modified_since.timestamp()) >= feed['mtime']
+    return False
+
+
+# 带ETag/Last-Modified的响应，客户端缓存有效时返回304
+def feed_response(feed):
+    encoding = choose_encoding(feed)
+    etag = feed['etag'] if encoding == 'identity' else f"{feed['etag']}-{encoding}"
+    if is_not_modified(feed):
+        response = Response(status=304)
+    else:
+        response = Response(feed['bodies'][encoding], mimetype='application/xml')
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.headers['ETag'] = f'"{etag}"'
+    response.headers['Last-Modified'] = feed['last_modified']
+    response.headers['Cache-Control'] = 'public, max-age=60'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
 
 @app.route('/rss/<path:filename>')
 def serve_static(filename):
-    return app.send_static_file(filename)
+    response = feed_response(load_feed(filename))
+    FEED_RESPONSES.inc(route='static', status=response.status_code)
+    return response
+
+
+# 第一次查询时建立连接池；表和查询用的索引由写库时的DynamicsWriter.ensure_schema建立，这里不执行DDL
+def get_db_pool():
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None:
+            _db_pool = psycopg2.pool.ThreadedConnectionPool(1, 8, **DB_CONFIG)
+        return _db_pool
+
+
+# 按条件即时生成rss，例如 /rss/query?up=某up主&type=DYNAMIC_TYPE_AV&tag=某标签&since=2025-01-01&limit=50
+# 也可以按up主的uid查询(uid=123)；up/uid/type/tag可以重复多次；结果按查询条件缓存，匹配的up主有新数据写入后失效
+@app.route('/rss/query')
+def serve_query():
+    try:
+        query = normalize_query(request.args)
+    except ValueError as e:
+        return Response(f'参数错误: {e}', status=400, mimetype='text/plain')
+    key = query_cache_key(query)
+    pool = get_db_pool()
+    connect = pool.getconn()
+    try:
+        with connect.cursor() as cursor:
+            version = query_version(cursor, query, TABLE_DATA, TABLE_FILTERED)
+        feed = query_cache.get(key, version)
+        QUERY_CACHE.inc(result='miss' if feed is None else 'hit')
+        if feed is None:
+            with RENDER_SECONDS.time(feed='query'):
+                rows = query_rows(connect, query, TABLE_DATA, TABLE_FILTERED)
+                feed = make_feed(render_query_feed(rows, query, query_media), time.time())
+            query_cache.put(key, version, feed)
+        connect.rollback()
+    finally:
+        pool.putconn(connect)
+    response = feed_response(feed)
+    FEED_RESPONSES.inc(route='query', status=response.status_code)
+    return response
+
+
+def get_search_index():
+    global _search_index
+    with _search_index_lock:
+        if _search_index is None:
+            _search_index = SearchIndex(SEARCH_INDEX_PATH)
+        return _search_index
+
+
+# 全文搜索，按相关度排序返回rss，例如 /rss/search?q=原神 抽卡&up=某up主&limit=50
+# 空格分隔的词都要出现；结果按搜索条件缓存，索引有新数据后失效
+@app.route('/rss/search')
+def serve_search():
+    try:
+        search = normalize_search(request.args)
+    except ValueError as e:
+        return Response(f'参数错误: {e}', status=400, mimetype='text/plain')
+    index = get_search_index()
+    key = search_cache_key(search)
+    version = index.version()
+    feed = query_cache.get(key, version)
+    QUERY_CACHE.inc(result='miss' if feed is None else 'hit')
+    if feed is None:
+        with RENDER_SECONDS.time(feed='search'):
+            rows = index.search(search['match'], search['ups'], search['limit'])
+            feed = make_feed(render_search_feed(rows, search, query_media), time.time())
+        query_cache.put(key, version, feed)
+    response = feed_response(feed)
+    FEED_RESPONSES.inc(route='search', status=response.status_code)
+    return response
+
+
+# 图片代理：第一次请求时带Referer从B站图床下载并按内容缓存，之后直接从磁盘返回
+# 同一地址的内容不会变化，允许客户端长期缓存
+@app.route('/media/<path:path>')
+def serve_media(path):
+    url = media_source_url(path)
+    if media_cache is None or not is_allowed_url(url):
+        abort(404)
+    try:
+        media = media_cache.get(url)
+    except requests.RequestException as e:
+        MEDIA_RESPONSES.inc(result='error')
+        status = getattr(e.response, 'status_code', None)
+        abort(404 if status == 404 else 502)
+    MEDIA_RESPONSES.inc(result='hit' if media['cached'] else 'miss')
+    response = send_file(media['path'], mimetype=media['mime_type'], etag=media['digest'], conditional=True,
+                         max_age=365 * 24 * 3600)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+# Prometheus格式的指标：本进程(flask)的指标，加上爬取等进程写入state/metrics的指标
+@app.route('/metrics')
+def serve_metrics():
+    return Response(merge_metrics(render_metrics(), *read_metrics_files()),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 if __name__ == '__main__':
@@ -1,51 +1,270 @@
-from bili_requests_functions import *
+import argparse
+import os
+import sys
+
+from bili_config import env_name, load_config
+
+# 命令行入口，配置见bili_config(配置文件或环境变量)，例如：
+#   python main.py crawl              爬取所有up主，直接为每个up主生成rss
+#   python main.py store              爬取所有up主并写入数据库
+#   python main.py filter             增量筛选，生成筛选后的rss
+#   python main.py render             由筛选表重新生成rss
+#   python main.py migrate            回填旧数据的up_uid/pub_ts
+#   python main.py serve              启动flask_demo.py的rss服务
+#   python main.py bench pipeline     性能测试，参数见benchmarks.py
+# crawl/store加 --daemon 时以常驻调度运行(bili_scheduler)
+# 各子命令只在执行时导入自己用到的模块，cron定时执行的短命令不需要加载数据库驱动、feedgen、flask等
+
+
+def open_media(config):
+    if not config['media_base_url']:
+        return None
+    from bili_media import MediaProxy
+    return MediaProxy(config['media_base_url'])
+
+
+def open_writer(config, search=None):
+    from bili_storage import STORAGE_PATH, open_storage
+    options = {'search_index': search}
+    if config['storage_backend'] == 'postgres':
+        options['partitioned'] = config['partition_data']
+    return open_storage(config['storage_backend'], config['database'], config['user'], config['password'],
+                        config['host'], config['port'], config['table_data'], config['table_tags'],
+                        config['table_filtered'], config['sqlite_path'] or STORAGE_PATH, **options)
+
+
+# 没有配置cookie时不带cookie请求(与原先的user_cookie = ''相同)
+def anonymous_cookies(config):
+    return config['user_cookies'] or ['']
+
+
+# 爬取全部up主：writer不为None时写库，render为True时为有新动态的up主直接生成rss
+# resumable时按批从任务队列取出up主，每批写库并保存游标后才标记完成，中途退出时下次运行只爬取未完成的up主
+def crawl_all(config, response_cache, writer=None, render=False, media=None):
+    up_uids = config['up_uids']
+    user_cookies = anonymous_cookies(config)
+    concurrent_crawl = config['concurrent_crawl']
+    incremental = concurrent_crawl and config['incremental']
+    api_options = {'api_base': config['api_base']} if config['api_base'] else {}
+    if concurrent_crawl:
+        from bili_credentials import CredentialPool
+        from bili_crawler import crawl_up_uids
+        from bili_cursors import load_cursors, save_cursors
+        cursors = load_cursors() if incremental else None
+        credentials = CredentialPool(user_cookies)
+    else:
+        from bili_requests_functions import get_name_id_title_time_text_pics_list
+    if render:
+        from bili_render import render_feeds
+    if config['resumable']:
+        from bili_work_queue import WorkQueue
+        work_queue = WorkQueue(max_attempts=config['max_attempts'])
+        work_queue.start_run(up_uids, requeue_dead=config['retry_dead_letters'])
+        batches = work_queue.batches(config['crawl_batch_size'])
+    else:
+        work_queue = None
+        batches = [up_uids]
+    try:
+        for batch in batches:
+            # 爬取失败的up主 {up_uid: 异常}，不影响同一批的其他up主
+            errors = {}
+            if concurrent_crawl:
+                up_dynamics = crawl_up_uids(batch, user_cookies, config['max_concurrency'],
+                                            config['per_host_concurrency'], cursors=cursors,
+                                            backfill=config['backfill'], response_cache=response_cache,
+                                            credentials=credentials, errors=errors, **api_options)
+            else:
+                up_dynamics = {}
+                for up_uid in batch:
+                    try:
+                        up_dynamics[up_uid] = get_name_id_title_time_text_pics_list(up_uid, user_cookies[0],
+                                                                                    response_cache)
+                    except Exception as e:
+                        print(f'{up_uid}爬取失败: {e!r}')
+                        errors[up_uid] = e
+            # 增量爬取时没有新动态的up主跳过后续步骤
+            new_dynamics = {up_uid: dynamics for up_uid, dynamics in up_dynamics.items() if dynamics}
+            if writer is not None:
+                for dynamics in new_dynamics.values():
+                    writer.add(dynamics)
+                # 写入这一批的数据后再保存游标，中途失败时下次仍会重新爬取这些动态
+                writer.flush()
+            # 一批up主爬完后用进程池统一生成
+            if render and new_dynamics:
+                render_feeds(new_dynamics, workers=config['render_workers'], fast=config['fast_render'], media=media)
+            if incremental:
+                save_cursors(cursors)
+            if work_queue is not None:
+                work_queue.finish(batch, errors)
+        # 所有批次都处理完才算这一轮结束，中途退出时下次运行继续这一轮
+        if work_queue is not None:
+            work_queue.end_run()
+    finally:
+        if concurrent_crawl:
+            print(f'cookie使用情况: {credentials.stats()}')
+        if work_queue is not None:
+            print(f'爬取任务: {work_queue.stats()}')
+            work_queue.close()
+
+
+# 常驻调度：按各up主的发帖频率自动安排轮询，爬取、写库、筛选、生成rss流水线进行
+def run_scheduler(config, response_cache, writer=None, render=False, media=None, metrics_name='scheduler'):
+    from bili_retention import ARCHIVE_DIR
+    from bili_scheduler import Scheduler
+    api_options = {'api_base': config['api_base']} if config['api_base'] else {}
+    scheduler = Scheduler(config['up_uids'], anonymous_cookies(config), writer=writer, render=render,
+                          render_workers=config['render_workers'], fast_render=config['fast_render'],
+                          filter_storage=writer if writer is not None and config['scheduler_filter'] else None,
+                          rss_limit=config['rss_limit'], min_interval=config['min_interval'],
+                          max_interval=config['max_interval'], max_concurrency=config['max_concurrency'],
+                          per_host_concurrency=config['per_host_concurrency'], response_cache=response_cache,
+                          media=media, retention_days=config['retention_days'],
+                          archive_dir=config['archive_dir'] or ARCHIVE_DIR, metrics_name=metrics_name,
+                          **api_options)
+    scheduler.run()
+
+
+# 爬取或写库，store为True时写库(所有up主的动态攒批写入，整个进程共用一个连接池)并按保留期归档
+def crawl_command(config, args, store=False):
+    response_cache = None
+    if config['use_response_cache']:
+        from bili_http_cache import ResponseCache
+        response_cache = ResponseCache()
+    media = open_media(config)
+    search = None
+    writer = None
+    try:
+        if store:
+            if config['use_search_index']:
+                from bili_search import SearchIndex
+                search = SearchIndex()
+            writer = open_writer(config, search)
+            # 建立数据表、标签表、筛选表，每个进程只执行一次
+            writer.ensure_schema()
+        if args.daemon:
+            run_scheduler(config, response_cache, writer, args.render, media, metrics_file_name(args))
+        else:
+            crawl_all(config, response_cache, writer, args.render, media)
+            # 归档超过保留期的数据
+            if writer is not None and config['retention_days'] is not None:
+                from bili_retention import ARCHIVE_DIR
+                writer.archive(config['retention_days'], config['archive_dir'] or ARCHIVE_DIR)
+    finally:
+        if writer is not None:
+            writer.close()
+        if response_cache is not None:
+            print(f'接口缓存: {response_cache.stats()}')
+            response_cache.close()
+        if search is not None:
+            search.close()
+
+
+def cmd_crawl(config, args):
+    crawl_command(config, args)
+
+
+def cmd_store(config, args):
+    crawl_command(config, args, store=True)
+
+
+# 筛选(增量，只处理上次筛选后新写入的数据)，然后生成筛选后的rss
+def cmd_filter(config, args):
+    writer = open_writer(config)
+    try:
+        writer.ensure_schema()
+        writer.filter()
+        if not args.no_rss:
+            writer.stream_rss(limit=config['rss_limit'], media=open_media(config))
+    finally:
+        writer.close()
+
+
+# 用筛选表生成rss：流式读取最新的rss_limit条，边读边写；--full时一次性读出整张筛选表经feedgen生成
+def cmd_render(config, args):
+    writer = open_writer(config)
+    try:
+        if args.full:
+            from bili_requests_functions import reload_rss
+            reload_rss(writer.fetch_all(), open_media(config))
+        else:
+            writer.stream_rss(limit=config['rss_limit'], media=open_media(config))
+    finally:
+        writer.close()
+
+
+# 回填旧数据的up_uid/pub_ts：建表时只在刚补上这两列时回填一次，
+# 之后写入了新动态、旧数据能按up主名对应上uid时再执行
+def cmd_migrate(config, args):
+    writer = open_writer(config)
+    try:
+        writer.ensure_schema()
+        writer.migrate()
+    finally:
+        writer.close()
+
+
+# flask_demo.py从环境变量读取数据库和图片代理的配置，导入前按配置设置
+def cmd_serve(config, args):
+    for key in ('database', 'user', 'password', 'host', 'port', 'table_data', 'table_filtered', 'media_base_url'):
+        os.environ[env_name(key)] = str(config[key])
+    from flask_demo import app
+    app.run(host=config['serve_host'], port=config['serve_port'])
+
+
+def cmd_bench(config, args):
+    import benchmarks
+    benchmarks.main(args.args)
+
+
+# 每个子命令的指标写入各自的文件(见bili_metrics.write_metrics_file)，由/metrics合并，互不覆盖
+def metrics_file_name(args):
+    return f'{args.command}_daemon' if getattr(args, 'daemon', False) else args.command
+
+
+COMMANDS = {
+    'crawl': cmd_crawl,
+    'store': cmd_store,
+    'filter': cmd_filter,
+    'render': cmd_render,
+    'migrate': cmd_migrate,
+    'serve': cmd_serve,
+    'bench': cmd_bench,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='BiliUPRss')
+    parser.add_argument('-c', '--config', help='json配置文件，默认读取BILI_CONFIG环境变量或当前目录下的bili.json')
+    commands = parser.add_subparsers(dest='command', required=True)
+    crawl = commands.add_parser('crawl', help='爬取所有up主并直接生成rss')
+    crawl.add_argument('--daemon', action='store_true', help='常驻调度')
+    crawl.set_defaults(render=True)
+    store = commands.add_parser('store', help='爬取所有up主并写入数据库')
+    store.add_argument('--daemon', action='store_true', help='常驻调度')
+    store.add_argument('--render', action='store_true', help='同时为有新动态的up主直接生成rss')
+    filter_parser = commands.add_parser('filter', help='增量筛选并生成筛选后的rss')
+    filter_parser.add_argument('--no-rss', action='store_true', help='只筛选，不生成rss')
+    render = commands.add_parser('render', help='由筛选表生成rss')
+    render.add_argument('--full', action='store_true', help='读出整张筛选表，经feedgen生成')
+    commands.add_parser('migrate', help='回填旧数据的up_uid/pub_ts')
+    commands.add_parser('serve', help='启动rss服务')
+    bench = commands.add_parser('bench', help='性能测试', add_help=False)
+    bench.add_argument('args', nargs=argparse.REMAINDER)
+    # bench之后的参数(包括--help)原样交给benchmarks.py
+    args, unknown = parser.parse_known_args(argv)
+    if args.command == 'bench':
+        args.args += unknown
+    elif unknown:
+        parser.error(f'unrecognized arguments: {" ".join(unknown)}')
+    config = load_config(args.config)
+    try:
+        COMMANDS[args.command](config, args)
+    finally:
+        # 各阶段的耗时和计数，由flask_demo.py的/metrics接口输出
+        if args.command in ('crawl', 'store', 'filter', 'render'):
+            from bili_metrics import write_metrics_file
+            write_metrics_file(metrics_file_name(args))
+
 
 if __name__ == '__main__':
-    # 爬虫用
-    up_uids = ['', ]
-    user_cookie = ''
-    # 数据库用
-    database = ''
-    user = ''
-    password = ''
-    host = ''
-    port = ''
-    table_data = ''
-    table_tags = ''
-    table_filtered = ''
-    # 以下实行功能
-    for up_uid in up_uids:
-        # 爬取数据
-        if True:
-            name_id_title_time_text_pics_list = get_name_id_title_time_text_pics_list(up_uid, user_cookie)
-        # 直接写rss
-        if False:
-            load_rss(name_id_title_time_text_pics_list, up_uid)
-        # 建立数据表，存储爬取下来的数据
-        if True:
-            create_table_data(database, user, password, host, port, table_data)
-        # 建立标签表，存储筛选用的标签
-        if True:
-            create_table_tags(database, user, password, host, port, table_tags)
-        # 建立筛选表，存储筛选后的数据
-        if True:
-            create_table_filtered(database, user, password, host, port, table_filtered)
-        # 存数据
-        if True:
-            write_bili_dynamics_table(name_id_title_time_text_pics_list)
-        # 筛选
-        if False:
-            filter_data(database, user, password, host, port, table_data, table_tags, table_filtered)
-        # 用筛选后的数据生成rss
-        if False:
-            dic = fetch_all_data(database, user, password, host, port, table_filtered)
-            load_rss(dic)
-    # name_id_title_time_text_pics_type_list = get_name_id_title_time_text_pics_list(up_uid, user_cookie)
-    # write_bili_dynamics_table(name_id_title_time_text_pics_type_list)
-    # filter_data(database, user, password, host, port, table_data, table_tags, table_filtered)
-    # dict = fetch_all_data(database, user, password, host, port, table_filtered)
-    # reload_rss(dict)
-    # create_bili_dynamics_table_data(database, user, password, host, port,table_data)
-    # create_bili_dynamics_table_tags(database, user, password, host, port,table_tags)
-    # create_table_filtered(database, user, password, host, port, table_filtered)
-    # clean_table(database, user, password, host, port,table)
+    main(sys.argv[1:])